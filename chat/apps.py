@@ -1,6 +1,23 @@
+import logging
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from chat import metrics, signals  # noqa: F401
+
+        metrics.configure()
+
+        if getattr(settings, 'MONGODB_ENSURE_INDEXES', False):
+            from chat.indexes import ensure_indexes
+            try:
+                ensure_indexes()
+            except Exception as e:
+                # Never block startup on Mongo; the management command reports it.
+                logger.error(f"Index bootstrap failed: {str(e)}")
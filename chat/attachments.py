@@ -0,0 +1,270 @@
+# chat/attachments.py
+"""Out-of-band storage for message attachments.
+
+Messages only carry a reference (``file_id`` plus filename, size and
+content type); the bytes live in GridFS, or on the local filesystem for
+tests and single-node development. Both backends read and write in chunks
+so an upload or download never holds a whole file in memory; downloads are
+read through ``aopen()`` so they can be streamed from the event loop.
+"""
+import asyncio
+import json
+import os
+import re
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs import AsyncGridFSBucket, GridFSBucket
+from gridfs.errors import NoFile
+from chat.conf import chat_setting
+from chat.mongo_utils import get_async_mongodb_connection, get_mongodb_connection
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+class AttachmentNotFound(Exception):
+    pass
+
+
+def _file_info(file_id, filename, size, content_type, owner):
+    return {
+        "file_id": str(file_id),
+        "filename": filename,
+        "size": size,
+        "content_type": content_type or DEFAULT_CONTENT_TYPE,
+        "owner": owner,
+    }
+
+
+class GridFSAttachmentStorage:
+    """Attachments stored in a GridFS bucket next to the messages collection."""
+
+    def __init__(self, bucket_name="attachments"):
+        self.bucket_name = bucket_name
+
+    def _bucket(self):
+        return GridFSBucket(get_mongodb_connection(), bucket_name=self.bucket_name)
+
+    def _async_bucket(self):
+        return AsyncGridFSBucket(
+            get_async_mongodb_connection(), bucket_name=self.bucket_name
+        )
+
+    def save(self, stream, filename, content_type, owner):
+        """Upload a file-like object chunk by chunk and return its info."""
+        bucket = self._bucket()
+        file_id = bucket.upload_from_stream(
+            filename,
+            stream,
+            chunk_size_bytes=chat_setting("ATTACHMENT_CHUNK_SIZE"),
+            metadata={"content_type": content_type, "owner": owner},
+        )
+        return self.describe(file_id)
+
+    async def asave(self, data, filename, content_type, owner):
+        file_id = await self._async_bucket().upload_from_stream(
+            filename,
+            data,
+            chunk_size_bytes=chat_setting("ATTACHMENT_CHUNK_SIZE"),
+            metadata={"content_type": content_type, "owner": owner},
+        )
+        return await self.adescribe(str(file_id))
+
+    @staticmethod
+    def _info_from_doc(doc):
+        metadata = doc.get("metadata") or {}
+        return _file_info(
+            doc["_id"],
+            doc["filename"],
+            doc["length"],
+            metadata.get("content_type"),
+            metadata.get("owner"),
+        )
+
+    def describe(self, file_id):
+        doc = get_mongodb_connection()[f"{self.bucket_name}.files"].find_one(
+            {"_id": _object_id(file_id)}
+        )
+        if not doc:
+            raise AttachmentNotFound(file_id)
+        return self._info_from_doc(doc)
+
+    async def adescribe(self, file_id):
+        doc = await get_async_mongodb_connection()[
+            f"{self.bucket_name}.files"
+        ].find_one({"_id": _object_id(file_id)})
+        if not doc:
+            raise AttachmentNotFound(file_id)
+        return self._info_from_doc(doc)
+
+    async def aopen(self, file_id):
+        """An AsyncGridOut for the file; its seek/read/close are coroutines."""
+        try:
+            return await self._async_bucket().open_download_stream(
+                _object_id(file_id)
+            )
+        except NoFile:
+            raise AttachmentNotFound(file_id)
+
+    def delete(self, file_id):
+        try:
+            self._bucket().delete(_object_id(file_id))
+        except NoFile:
+            raise AttachmentNotFound(file_id)
+
+
+class LocalAttachmentStorage:
+    """Attachments stored as plain files under ``root`` (tests, local dev)."""
+
+    def __init__(self, root):
+        self.root = str(root)
+
+    def _paths(self, file_id):
+        file_id = str(_object_id(file_id))
+        data_path = os.path.join(self.root, file_id)
+        return data_path, f"{data_path}.json"
+
+    def _write_info(self, file_id, filename, size, content_type, owner):
+        info = _file_info(file_id, filename, size, content_type, owner)
+        with open(self._paths(file_id)[1], "w") as meta_file:
+            json.dump(info, meta_file)
+        return info
+
+    def save(self, stream, filename, content_type, owner):
+        os.makedirs(self.root, exist_ok=True)
+        file_id = str(ObjectId())
+        chunk_size = chat_setting("ATTACHMENT_CHUNK_SIZE")
+        size = 0
+        with open(self._paths(file_id)[0], "wb") as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+                size += len(chunk)
+        return self._write_info(file_id, filename, size, content_type, owner)
+
+    def _save_bytes(self, data, filename, content_type, owner):
+        os.makedirs(self.root, exist_ok=True)
+        file_id = str(ObjectId())
+        with open(self._paths(file_id)[0], "wb") as out:
+            out.write(data)
+        return self._write_info(file_id, filename, len(data), content_type, owner)
+
+    async def asave(self, data, filename, content_type, owner):
+        return await asyncio.to_thread(
+            self._save_bytes, data, filename, content_type, owner
+        )
+
+    def describe(self, file_id):
+        try:
+            with open(self._paths(file_id)[1]) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            raise AttachmentNotFound(file_id)
+
+    async def adescribe(self, file_id):
+        return await asyncio.to_thread(self.describe, file_id)
+
+    async def aopen(self, file_id):
+        try:
+            stream = await asyncio.to_thread(open, self._paths(file_id)[0], "rb")
+        except FileNotFoundError:
+            raise AttachmentNotFound(file_id)
+        return _AsyncFile(stream)
+
+    def delete(self, file_id):
+        info = self.describe(file_id)
+        for path in self._paths(info["file_id"]):
+            os.remove(path)
+
+
+class _AsyncFile:
+    """Local file whose blocking calls run in the default executor."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def seek(self, pos):
+        return await asyncio.to_thread(self._stream.seek, pos)
+
+    async def read(self, size=-1):
+        return await asyncio.to_thread(self._stream.read, size)
+
+    async def close(self):
+        await asyncio.to_thread(self._stream.close)
+
+
+def _object_id(file_id):
+    try:
+        return ObjectId(file_id)
+    except (InvalidId, TypeError):
+        raise AttachmentNotFound(file_id)
+
+
+_storage = None
+
+
+def get_attachment_storage():
+    global _storage
+    if _storage is None:
+        if chat_setting("ATTACHMENT_STORAGE") == "local":
+            _storage = LocalAttachmentStorage(chat_setting("ATTACHMENT_ROOT"))
+        else:
+            _storage = GridFSAttachmentStorage(chat_setting("ATTACHMENT_BUCKET"))
+    return _storage
+
+
+def message_file_info(info):
+    """The attachment reference embedded in a message document."""
+    return {
+        "file_id": info["file_id"],
+        "filename": info["filename"],
+        "size": info["size"],
+        "content_type": info["content_type"],
+    }
+
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, length):
+    """Parse a single-range ``Range`` header into inclusive ``(start, end)``.
+
+    Returns None when the header is absent or not a single byte range (the
+    whole file is served) and raises ValueError when it is unsatisfiable.
+    """
+    match = _RANGE_RE.match((header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), length - 1) if last else length - 1
+    else:
+        # Suffix range: the last N bytes.
+        start = max(length - int(last), 0)
+        end = length - 1
+
+    if start >= length or start > end:
+        raise ValueError("Requested range not satisfiable")
+    return start, end
+
+
+async def iter_file(storage, file_id, start, end, chunk_size):
+    """Async iterator over bytes ``start..end`` (inclusive) of an attachment.
+
+    The file is opened on first iteration, on the loop serving the response.
+    """
+    stream = await storage.aopen(file_id)
+    try:
+        await stream.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await stream.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await stream.close()
@@ -1,18 +1,217 @@
-# chat/authentication.py
-from rest_framework.authentication import TokenAuthentication
-from rest_framework import exceptions
-
-class BearerTokenAuthentication(TokenAuthentication):
-    keyword = 'Bearer'
-
-    def authenticate_credentials(self, key):
-        model = self.get_model()
-        try:
-            token = model.objects.select_related('user').get(key=key)
-        except model.DoesNotExist:
-            raise exceptions.AuthenticationFailed('Invalid token')
-
-        if not token.user.is_active:
-            raise exceptions.AuthenticationFailed('User inactive or deleted')
-
-        return (token.user, token)
\ No newline at end of file
+# chat/authentication.py
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from jwt import decode as jwt_decode
+from jwt.exceptions import InvalidTokenError
+from rest_framework.authentication import TokenAuthentication
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from chat.conf import chat_setting
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+
+class BearerTokenAuthentication(TokenAuthentication):
+    keyword = 'Bearer'
+
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user').get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token')
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted')
+
+        return (token.user, token)
+
+
+USER_VERSION_KEY = 'auth_user_version:{}'
+
+
+def _user_version_key(user_id):
+    return USER_VERSION_KEY.format(user_id)
+
+
+def get_user_version(user_id):
+    """The user's revocation version in the shared cache, or None if unreadable."""
+    try:
+        return cache.get(_user_version_key(user_id), 0)
+    except Exception as e:
+        logger.warning(f"Auth version lookup failed: {str(e)}")
+        return None
+
+
+async def aget_user_version(user_id):
+    try:
+        return await cache.aget(_user_version_key(user_id), 0)
+    except Exception as e:
+        logger.warning(f"Auth version lookup failed: {str(e)}")
+        return None
+
+
+def bump_user_version(user_id):
+    """Revoke every process's cached verifications for ``user_id``.
+
+    Never raises: a user save must not fail because the cache is down.
+    """
+    key = _user_version_key(user_id)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+    except Exception as e:
+        logger.error(f"Auth version bump failed for user {user_id}: {str(e)}")
+
+
+def auth_state(user):
+    """The fields whose changes revoke a user's cached verifications."""
+    return user.__dict__.get('password'), user.__dict__.get('is_active')
+
+
+class TokenUserCache:
+    """Bounded LRU of verified token -> user snapshots.
+
+    Entries are keyed by a hash of the raw token (never the token itself)
+    and expire at the token's ``exp`` or after ``ttl`` seconds, whichever is
+    first. Each entry records the user's revocation version from the shared
+    cache at verification time; callers compare it with the current one on
+    every hit, so ``bump_user_version()`` (wired to user saves/deletes in
+    chat.signals) revokes entries in every process. ``invalidate_user()``
+    additionally frees this process's entries right away. Hits return a
+    shallow copy so callers cannot mutate the cached instance.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(namespace, token):
+        return hashlib.sha256(f'{namespace}:{token}'.encode()).hexdigest()
+
+    def get(self, key):
+        """``(user, extra, version)`` for a live entry, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, user, extra, version = entry
+            if expires_at <= time.time():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+        return copy.copy(user), extra, version
+
+    def set(self, key, user, exp, extra=None, version=None):
+        if version is None:
+            # Without a readable version the entry could not be revoked.
+            return
+        expires_at = min(exp, time.time() + self.ttl) if exp else time.time() + self.ttl
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (expires_at, user, extra, version)
+            self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys_by_user.get(entry[1].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[entry[1].pk]
+
+
+token_user_cache = TokenUserCache(
+    chat_setting('AUTH_CACHE_SIZE'), chat_setting('AUTH_CACHE_TTL')
+)
+
+
+async def aget_user_for_jwt(token):
+    """Verify a WebSocket JWT and return its active user.
+
+    Raises InvalidTokenError or User.DoesNotExist. Cache hits skip both the
+    signature check and the database, at the cost of one shared-cache read
+    to check that the user has not been revoked since.
+    """
+    key = TokenUserCache.key('ws', token)
+    cached = token_user_cache.get(key)
+    if cached is not None:
+        user, _, version = cached
+        if version == await aget_user_version(user.pk):
+            return user
+        token_user_cache.discard(key)
+
+    payload = jwt_decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+    # Read before the user so a change racing this lookup revokes the entry.
+    version = await aget_user_version(payload['user_id'])
+    user = await User.objects.aget(id=payload['user_id'])
+    if not user.is_active:
+        raise InvalidTokenError('User account is disabled')
+
+    token_user_cache.set(key, user, payload.get('exp'), version=version)
+    return user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """simplejwt authentication backed by token_user_cache."""
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        if isinstance(raw_token, bytes):
+            raw_token = raw_token.decode()
+        key = TokenUserCache.key('drf', raw_token)
+        cached = token_user_cache.get(key)
+        if cached is not None:
+            user, validated_token, version = cached
+            if version == get_user_version(user.pk):
+                return user, validated_token
+            token_user_cache.discard(key)
+
+        validated_token = self.get_validated_token(raw_token)
+        version = get_user_version(validated_token.get(jwt_settings.USER_ID_CLAIM))
+        user = self.get_user(validated_token)
+        token_user_cache.set(
+            key, user, validated_token.get('exp'), validated_token, version
+        )
+        return user, validated_token
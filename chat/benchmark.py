@@ -0,0 +1,644 @@
+# chat/benchmark.py
+"""Local load generation for the WebSocket and REST APIs.
+
+Everything runs in one process: the project's ASGI application is driven
+through asgiref's ApplicationCommunicator, the channel layer is the
+in-memory one, and Mongo is either mongomock (wrapped to look like the
+sync and async pymongo clients) or a throwaway ``<db>_bench`` database on
+the configured mongod. Each simulated client is a closed loop: it issues
+one operation, waits for the answer, then picks the next one from the mix.
+
+A third phase, ``run_dispatch_bench()``, times what ``ChatConsumer.receive``
+does to every frame before its handler runs -- source peek, decoding,
+handler lookup and schema validation -- in a tight loop per frame type.
+
+``run_benchmark()`` returns a JSON-serialisable result; ``compare()``
+checks it against a stored baseline. The bench_chat management command is
+the CLI for both.
+"""
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from urllib.parse import urlencode
+from asgiref.testing import ApplicationCommunicator
+from chat import mongo_utils
+from chat.consumers import ChatConsumer
+from chat.protocol import JSON
+
+# Seconds to wait for any single response before counting an error.
+RESPONSE_TIMEOUT = 10
+
+DEFAULT_MIX = {"send": 50, "list": 20, "read": 20, "type": 10}
+DEFAULT_REST_MIX = {"create": 40, "history": 30, "conversations": 30}
+
+# Frames timed by run_dispatch_bench().
+DISPATCH_FRAMES = {
+    "message.send": {
+        "room_id": "bench-0",
+        "sender": "bench0",
+        "receiver": "bench1",
+        "message": "benchmark message from bench0",
+    },
+    "message.list": {"room_id": "bench-0", "page_size": 50},
+    "message.read": {
+        "message_ids": ["65f0c0ffee0000000000%04x" % i for i in range(20)]
+    },
+    "message.type": {"room_id": "bench-0", "receiver": "bench1", "is_typing": True},
+    "ping": None,
+}
+
+
+def parse_mix(value, default):
+    """``"send=50,list=20"`` -> ``{"send": 50, "list": 20}``."""
+    if not value:
+        return dict(default)
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in default:
+            raise ValueError(f"Unknown operation {name.strip()!r}")
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+def percentiles(samples):
+    """p50/p95/p99 in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    if len(samples) == 1:
+        cuts = samples * 99
+    else:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+class BenchError(Exception):
+    pass
+
+
+class WebSocketClient:
+    """One simulated chat user on an in-process WebSocket."""
+
+    def __init__(self, application, username, token, partner, room_id):
+        self.username = username
+        self.partner = partner
+        self.room_id = room_id
+        self.unread = []
+        self.communicator = ApplicationCommunicator(
+            application,
+            {
+                "type": "websocket",
+                "path": "/api/chat/",
+                "query_string": urlencode({"token": token}).encode(),
+                "headers": [(b"host", b"localhost")],
+                "subprotocols": [],
+            },
+        )
+        self._waiter = None
+        self._reader = None
+
+    async def connect(self):
+        await self.communicator.send_input({"type": "websocket.connect"})
+        message = await self._next_output()
+        if message["type"] != "websocket.accept":
+            raise BenchError(f"{self.username}: connection refused")
+        self._reader = asyncio.create_task(self._read())
+        await self._request(None, "connection")
+
+    async def close(self):
+        await self.communicator.send_input(
+            {"type": "websocket.disconnect", "code": 1000}
+        )
+        if self._reader is not None:
+            self._reader.cancel()
+        try:
+            await self.communicator.wait(timeout=RESPONSE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+
+    async def _next_output(self):
+        # receive_output() cancels the application on timeout; read the
+        # queue directly so a slow frame only fails this request.
+        return await asyncio.wait_for(
+            self.communicator.output_queue.get(), RESPONSE_TIMEOUT
+        )
+
+    async def _read(self):
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message["type"] != "websocket.send":
+                continue
+            frame = json.loads(message["text"])
+            frames = frame["data"] if frame.get("source") == "batch" else [frame]
+            for frame in frames:
+                self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        source = frame.get("source")
+        data = frame.get("data") or {}
+        if source == "message.send" and data.get("sender") != self.username:
+            self.unread.append(data["message_id"])
+        if self._waiter is None:
+            return
+        expected, match, future = self._waiter
+        if future.done():
+            return
+        if source == "error":
+            future.set_exception(BenchError(frame["error"]["message"]))
+        elif source == expected and match(data):
+            future.set_result(frame)
+
+    async def _request(self, payload, source, match=lambda data: True):
+        future = asyncio.get_running_loop().create_future()
+        self._waiter = (source, match, future)
+        try:
+            if payload is not None:
+                await self.communicator.send_input(
+                    {"type": "websocket.receive", "text": json.dumps(payload)}
+                )
+            return await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        finally:
+            self._waiter = None
+
+    async def op_send(self):
+        await self._request(
+            {
+                "source": "message.send",
+                "data": {
+                    "room_id": self.room_id,
+                    "sender": self.username,
+                    "receiver": self.partner,
+                    "message": f"benchmark message from {self.username}",
+                },
+            },
+            "message.send",
+            lambda data: data.get("sender") == self.username,
+        )
+
+    async def op_list(self):
+        await self._request(
+            {"source": "message.list", "data": {"room_id": self.room_id}},
+            "message.list",
+        )
+
+    async def op_read(self):
+        if not self.unread:
+            return await self.op_send()
+        message_ids, self.unread = self.unread[:100], self.unread[100:]
+        await self._request(
+            {"source": "message.read", "data": {"message_ids": message_ids}},
+            "message.read",
+            lambda data: data.get("reader") == self.username,
+        )
+
+    async def op_type(self):
+        # Typing indicators have no reply; this measures hand-off only.
+        await self.communicator.send_input(
+            {
+                "type": "websocket.receive",
+                "text": json.dumps(
+                    {
+                        "source": "message.type",
+                        "data": {"room_id": self.room_id, "receiver": self.partner},
+                    }
+                ),
+            }
+        )
+
+
+async def http_request(application, method, path, token, body=None):
+    """Issue one request to the ASGI app; returns ``(status, body bytes)``."""
+    path, _, query_string = path.partition("?")
+    headers = [(b"host", b"localhost"), (b"authorization", f"Bearer {token}".encode())]
+    payload = b""
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(payload)).encode()))
+    communicator = ApplicationCommunicator(
+        application,
+        {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query_string.encode(),
+            "headers": headers,
+            "scheme": "http",
+            "server": ("localhost", 80),
+            "client": ("127.0.0.1", 0),
+        },
+    )
+    await communicator.send_input({"type": "http.request", "body": payload})
+    start = await communicator.receive_output(RESPONSE_TIMEOUT)
+    chunks = []
+    while True:
+        message = await communicator.receive_output(RESPONSE_TIMEOUT)
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    await communicator.wait(RESPONSE_TIMEOUT)
+    return start["status"], b"".join(chunks)
+
+
+def _pairs(users):
+    """(username, token, partner, room_id) with users paired off by index."""
+    clients = []
+    for index, (username, token) in enumerate(users):
+        partner_index = index ^ 1 if index ^ 1 < len(users) else index
+        partner = users[partner_index][0]
+        clients.append((username, token, partner, f"bench-{min(index, partner_index)}"))
+    return clients
+
+
+async def _run_clients(clients, ops_per_client, mix, seed):
+    samples = {name: [] for name in mix}
+    errors = []
+    names, weights = list(mix), list(mix.values())
+
+    async def run(index, client):
+        rng = random.Random(seed + index)
+        for _ in range(ops_per_client):
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                await getattr(client, f"op_{name}")()
+            except (BenchError, asyncio.TimeoutError) as e:
+                errors.append(f"{name}: {e or 'timeout'}")
+                continue
+            samples[name].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(index, client) for index, client in enumerate(clients)))
+    return samples, errors, time.perf_counter() - start
+
+
+async def run_websocket_bench(application, users, ops_per_client, mix, seed):
+    clients = [WebSocketClient(application, *spec) for spec in _pairs(users)]
+
+    # Memory is traced only while connecting; tracing would skew latencies.
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for client in clients:
+        await client.connect()
+    await asyncio.sleep(0.1)  # Let pending-delivery tasks settle.
+    gc.collect()
+    connected = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    samples, errors, elapsed = await _run_clients(clients, ops_per_client, mix, seed)
+    for client in clients:
+        await client.close()
+
+    total_ops = sum(len(durations) for durations in samples.values())
+    return {
+        "ops": {name: percentiles(durations) for name, durations in samples.items()},
+        "ops_per_sec": round(total_ops / elapsed, 1),
+        "messages_per_sec": round(len(samples.get("send", ())) / elapsed, 1),
+        "memory_per_connection_kib": round(
+            (connected - baseline) / len(clients) / 1024, 1
+        ),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+    }
+
+
+async def run_rest_bench(application, users, requests, concurrency, mix, seed):
+    pairs = _pairs(users)
+    names, weights = list(mix), list(mix.values())
+    samples = {name: [] for name in mix}
+    errors = []
+    queue = asyncio.Queue()
+    rng = random.Random(seed)
+    for index in range(requests):
+        queue.put_nowait((rng.choices(names, weights)[0], pairs[index % len(pairs)]))
+
+    def request_for(name, username, room_id):
+        if name == "create":
+            return (
+                "POST",
+                "/api/messages/",
+                {"room_id": room_id, "message": f"hi from {username}"},
+            )
+        if name == "history":
+            query = urlencode({"room_id": room_id, "start_date": "2000-01-01T00:00:00"})
+            return "GET", f"/api/messages/history/?{query}", None
+        return "GET", "/api/conversations/", None
+
+    async def worker():
+        while not queue.empty():
+            name, (username, token, _, room_id) = queue.get_nowait()
+            method, path, body = request_for(name, username, room_id)
+            start = time.perf_counter()
+            status, content = await http_request(application, method, path, token, body)
+            if status >= 400:
+                errors.append(f"{name}: HTTP {status} {content[:100]!r}")
+                continue
+            samples[name].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "ops": {name: percentiles(durations) for name, durations in samples.items()},
+        "requests_per_sec": round(sum(map(len, samples.values())) / elapsed, 1),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+    }
+
+
+def run_dispatch_bench(iterations):
+    """Microseconds per frame spent routing and validating, by source."""
+    handlers = ChatConsumer.handlers
+    frames = {}
+    for source, data in DISPATCH_FRAMES.items():
+        frame = {"source": source}
+        if data is not None:
+            frame["data"] = data
+        text = json.dumps(frame)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            JSON.peek_source(text)
+            decoded = JSON.decode(text)
+            handler = handlers.resolve(decoded)
+            handler.schema.validate(decoded.get("data"))
+        elapsed = time.perf_counter() - start
+        frames[source] = {"us_per_frame": round(elapsed / iterations * 1e6, 3)}
+    return {"iterations": iterations, "frames": frames}
+
+
+async def run_benchmark(application, users, options):
+    """Run the WebSocket and REST phases; ``users`` is [(username, jwt)]."""
+    result = {
+        "meta": {
+            "clients": len(users),
+            "ops_per_client": options["ops"],
+            "mix": options["mix"],
+            "rest_requests": options["rest_requests"],
+            "rest_concurrency": options["rest_concurrency"],
+            "rest_mix": options["rest_mix"],
+            "dispatch_iterations": options["dispatch_iterations"],
+            "write_behind": options["write_behind"],
+            "mongo": options["mongo"],
+            "seed": options["seed"],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "websocket": await run_websocket_bench(
+            application, users, options["ops"], options["mix"], options["seed"]
+        ),
+    }
+    if options["rest_requests"]:
+        result["rest"] = await run_rest_bench(
+            application,
+            users,
+            options["rest_requests"],
+            options["rest_concurrency"],
+            options["rest_mix"],
+            options["seed"],
+        )
+    if options["dispatch_iterations"]:
+        result["dispatch"] = run_dispatch_bench(options["dispatch_iterations"])
+    return result
+
+
+# Parameters that must match for two results to be comparable.
+COMPARABLE_META = (
+    "clients",
+    "ops_per_client",
+    "mix",
+    "rest_requests",
+    "rest_concurrency",
+    "rest_mix",
+    "dispatch_iterations",
+    "write_behind",
+    "mongo",
+)
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of ``result`` against ``baseline`` as readable strings.
+
+    A p95 or per-frame dispatch time more than ``tolerance`` (a fraction)
+    above the baseline's, or a throughput more than ``tolerance`` below it,
+    counts as a regression.
+    """
+    mismatched = [
+        key
+        for key in COMPARABLE_META
+        if result["meta"].get(key) != baseline["meta"].get(key)
+    ]
+    if mismatched:
+        return [f"baseline not comparable: different {', '.join(mismatched)}"]
+
+    regressions = []
+    for section, throughput_keys in (
+        ("websocket", ("ops_per_sec", "messages_per_sec")),
+        ("rest", ("requests_per_sec",)),
+    ):
+        current, previous = result.get(section), baseline.get(section)
+        if not current or not previous:
+            continue
+        for name, stats in current["ops"].items():
+            before = previous["ops"].get(name, {}).get("p95_ms")
+            if (
+                before
+                and stats["p95_ms"]
+                and stats["p95_ms"] > before * (1 + tolerance)
+            ):
+                regressions.append(
+                    f"{section} {name} p95 {stats['p95_ms']}ms (baseline {before}ms)"
+                )
+        for key in throughput_keys:
+            before = previous.get(key)
+            if before and current[key] < before * (1 - tolerance):
+                regressions.append(
+                    f"{section} {key} {current[key]} (baseline {before})"
+                )
+
+    current, previous = result.get("dispatch"), baseline.get("dispatch")
+    if current and previous:
+        for source, stats in current["frames"].items():
+            before = previous["frames"].get(source, {}).get("us_per_frame")
+            if before and stats["us_per_frame"] > before * (1 + tolerance):
+                regressions.append(
+                    f"dispatch {source} {stats['us_per_frame']}us "
+                    f"(baseline {before}us)"
+                )
+    return regressions
+
+
+# -------------------------------
+# mongomock adapters
+# -------------------------------
+
+
+class _MockCollection:
+    """mongomock collection accepting the bulk ops pymongo 4.x builds."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        # mongomock's bulk API predates the options pymongo 4.x passes
+        # along, so replay the requests one by one.
+        for request in requests:
+            self._collection.update_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+
+    def find_one_and_update(self, filter, update, upsert=False, **kwargs):
+        # mongomock compares $max operands with Python's ">", which fails on
+        # embedded documents; apply those the way BSON orders them (field by
+        # field, null first) and pass the rest through.
+        if any(isinstance(value, dict) for value in update.get("$max", {}).values()):
+            update = dict(update)
+            current = self._collection.find_one(filter) or {}
+            update["$set"] = dict(update.get("$set", {}))
+            for field, value in update.pop("$max").items():
+                if field not in current or _bson_key(value) > _bson_key(current[field]):
+                    update["$set"][field] = value
+            if not update["$set"]:
+                del update["$set"]
+            if not update:
+                return self._collection.find_one(filter, kwargs.get("projection"))
+        return self._collection.find_one_and_update(
+            filter, update, upsert=upsert, **kwargs
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+def _bson_key(value):
+    if isinstance(value, dict):
+        return tuple((key, _bson_key(item)) for key, item in value.items())
+    return (value is not None, value)
+
+
+class _MockDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return _MockCollection(self._database[name])
+
+
+class _MockClient:
+    def __init__(self, client):
+        self._client = client
+
+    def __getitem__(self, name):
+        return _MockDatabase(self._client[name])
+
+    def close(self):
+        pass
+
+
+class _AsyncMockCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, count):
+        self._cursor = self._cursor.limit(count)
+        return self
+
+    def skip(self, count):
+        self._cursor = self._cursor.skip(count)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length=None):
+        docs = list(self._cursor)
+        return docs[:length] if length else docs
+
+    async def close(self):
+        self._cursor.close()
+
+    def __aiter__(self):
+        self._iterator = iter(self._cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _AsyncMockCollection:
+    """Coroutine front for a _MockCollection, shaped like AsyncCollection."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return _AsyncMockCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs):
+        return _AsyncMockCursor(iter(list(self._collection.aggregate(*args, **kwargs))))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class _AsyncMockDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return _AsyncMockCollection(self._database[name])
+
+
+class _AsyncMockClient:
+    def __init__(self, client):
+        self._client = client
+
+    def __getitem__(self, name):
+        return _AsyncMockDatabase(self._client[name])
+
+
+@contextmanager
+def mongomock_clients():
+    """Point chat.mongo_utils at one shared in-memory mongomock client."""
+    try:
+        import mongomock
+    except ImportError:
+        raise BenchError("mongomock is not installed (pip install mongomock)")
+
+    client = _MockClient(mongomock.MongoClient())
+    saved = (mongo_utils._client, mongo_utils._async_client, mongo_utils._client_pid)
+    mongo_utils._client = client
+    mongo_utils._async_client = _AsyncMockClient(client)
+    mongo_utils._client_pid = os.getpid()
+    try:
+        yield
+    finally:
+        mongo_utils._client, mongo_utils._async_client, mongo_utils._client_pid = saved
@@ -0,0 +1,88 @@
+# chat/conf.py
+"""Tunables for the chat app, overridable through ``settings.CHAT_SETTINGS``."""
+from django.conf import settings
+
+DEFAULTS = {
+    # Undelivered messages sent per ``message.batch`` frame on connect.
+    'PENDING_BATCH_SIZE': 100,
+    # Only mark messages delivered when the receiver sends message.ack.
+    'REQUIRE_DELIVERY_ACK': True,
+    # Attachment storage backend: 'gridfs' or 'local' (files under ATTACHMENT_ROOT).
+    'ATTACHMENT_STORAGE': 'gridfs',
+    'ATTACHMENT_BUCKET': 'attachments',
+    'ATTACHMENT_ROOT': 'attachments',
+    'ATTACHMENT_CHUNK_SIZE': 255 * 1024,
+    'ATTACHMENT_MAX_SIZE': 100 * 1024 * 1024,
+    # Redis used by chat services (presence, ...); separate from the channel layer.
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    # Presence backend: 'redis' (shared across nodes) or 'local' (single process).
+    'PRESENCE_BACKEND': 'redis',
+    # Seconds a connection counts as online without a heartbeat.
+    'PRESENCE_TTL': 60,
+    'PRESENCE_HEARTBEAT_INTERVAL': 20,
+    # Seconds a status answer is reused in-process, and max cached users.
+    'PRESENCE_READ_CACHE_TTL': 2,
+    'PRESENCE_READ_CACHE_SIZE': 10000,
+    # Verified JWT -> user snapshots kept per process (chat.authentication).
+    'AUTH_CACHE_SIZE': 50000,
+    'AUTH_CACHE_TTL': 300,
+    # Room membership cache (chat.rooms) and per-socket room group cap.
+    'ROOM_MEMBERS_CACHE_TTL': 30,
+    'ROOM_MEMBERS_CACHE_SIZE': 10000,
+    'MAX_ROOM_SUBSCRIPTIONS': 500,
+    # Frames a connection may have queued before it is closed as too slow.
+    'OUTBOUND_QUEUE_SIZE': 1000,
+    # Seconds the outbound writer waits to gather frames into one flush.
+    'OUTBOUND_FLUSH_WINDOW': 0.005,
+    # Upper bound on frames joined into a single batch frame.
+    'OUTBOUND_MAX_BATCH': 256,
+    # Minimum seconds between typing publishes per sender and room.
+    'TYPING_THROTTLE_INTERVAL': 2,
+    # Seconds without keystrokes before "stopped typing" is sent for the user.
+    'TYPING_TIMEOUT': 6,
+    # Characters of the last message kept in each conversation summary.
+    'CONVERSATION_PREVIEW_LENGTH': 120,
+    # 'mongo' ($text index) or 'local' (in-process index, for tests).
+    'SEARCH_BACKEND': 'mongo',
+    # Documents fetched per round trip by the NDJSON export.
+    'EXPORT_BATCH_SIZE': 1000,
+    # Collect chat.metrics and serve them at METRICS_PATH on the ASGI app.
+    'METRICS_ENABLED': False,
+    'METRICS_PATH': '/metrics',
+    # Scrapers must send "Authorization: Bearer <METRICS_TOKEN>"; with no
+    # token set, METRICS_PATH only answers clients on the loopback address.
+    'METRICS_TOKEN': None,
+    # Inbound frames per user and source: source -> (tokens per second, burst).
+    # '*' covers sources not listed; leave it out to not limit them.
+    # message.type is sent per keystroke, so its limit only stops floods
+    # (and excess typing frames are dropped without an error frame).
+    'RATE_LIMITS': {
+        'message.send': (5, 20),
+        'message.edit': (2, 10),
+        'message.delete': (2, 10),
+        'message.type': (20, 60),
+        'message.list': (5, 20),
+        'message.search': (1, 5),
+        'user.list': (1, 5),
+        '*': (20, 60),
+    },
+    # 'redis' (shared across nodes), 'local' (per process) or None to disable.
+    'RATE_LIMIT_BACKEND': 'redis',
+    # Max in-process buckets before they are dropped and rebuilt.
+    'RATE_LIMIT_CACHE_SIZE': 100000,
+    # Longest message text accepted over the WebSocket API.
+    'MAX_MESSAGE_LENGTH': 10000,
+    # Batch message inserts into insert_many calls (see chat.write_behind).
+    'WRITE_BEHIND_ENABLED': False,
+    # 'flushed' (wait for the batch write) or 'buffered' (return once queued).
+    'WRITE_BEHIND_ACK': 'flushed',
+    # Seconds to gather a batch, and the documents written per batch.
+    'WRITE_BEHIND_WINDOW': 0.005,
+    'WRITE_BEHIND_BATCH_SIZE': 500,
+    # Queued documents beyond which 'buffered' callers wait for their batch.
+    'WRITE_BEHIND_MAX_PENDING': 10000,
+}
+
+
+def chat_setting(name):
+    return getattr(settings, 'CHAT_SETTINGS', {}).get(name, DEFAULTS[name])
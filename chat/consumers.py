@@ -1,543 +1,1201 @@
-import json
-import base64
-import logging
-from bson import ObjectId
-from datetime import datetime
-from django.core.cache import cache
-from django.core.files.base import ContentFile
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from jwt import decode as jwt_decode
-from jwt.exceptions import InvalidTokenError
-from urllib.parse import parse_qs
-from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.contrib.auth.models import AnonymousUser
-from chat.mongo_utils import get_messages_collection
-
-logger = logging.getLogger(__name__)
-User = get_user_model()
-
-
-class ChatConsumer(WebsocketConsumer):
-    """WebSocket consumer for chat functionality following original structure."""
-
-    def connect(self):
-        """Handle WebSocket connection."""
-        try:
-            query_string = self.scope["query_string"].decode()
-            query_params = parse_qs(query_string)
-            token = query_params.get("token", [None])[0]
-
-            user = self.get_user_from_token(token)
-            if not user or not user.is_authenticated:
-                logger.warning("Unauthorized connection attempt")
-                self.close()
-                return
-
-            self.scope["user"] = user
-            self.user = user
-            self.username = user.username
-
-            async_to_sync(self.channel_layer.group_add)(
-                self.username, self.channel_name
-            )
-            self.accept()
-
-            cache.set(f"user_status_{self.username}", "online", timeout=None)
-            cache.set(
-                f"user_last_seen_{self.username}", datetime.utcnow(), timeout=None
-            )
-
-            self.send(
-                text_data=json.dumps(
-                    {
-                        "source": "connection",
-                        "data": {
-                            "message": "connected",
-                            "username": self.username,
-                            "timestamp": datetime.utcnow().isoformat(),
-                        },
-                    }
-                )
-            )
-
-            # Send any pending messages
-            self.send_pending_messages()
-
-        except Exception as e:
-            logger.error(f"Connection error: {str(e)}")
-            self.close()
-
-    def disconnect(self, close_code):
-        """Handle WebSocket disconnection."""
-        try:
-            if hasattr(self, "username"):
-                async_to_sync(self.channel_layer.group_discard)(
-                    self.username, self.channel_name
-                )
-                cache.set(f"user_status_{self.username}", "offline", timeout=None)
-                cache.set(
-                    f"user_last_seen_{self.username}",
-                    datetime.utcnow(),
-                    timeout=60 * 60 * 24 * 30,
-                )
-                logger.info(f"User {self.username} disconnected")
-        except Exception as e:
-            logger.error(f"Disconnection error: {str(e)}")
-
-    def receive(self, text_data):
-        """Receive and route incoming messages."""
-        try:
-            data = json.loads(text_data)
-            source = data.get("source")
-
-            if not source:
-                raise ValueError("Missing message source")
-
-            handler_name = f'receive_{source.replace(".", "_")}'
-            if not hasattr(self, handler_name):
-                raise ValueError(f"Unknown message source: {source}")
-
-            handler = getattr(self, handler_name)
-            handler(data)
-
-        except json.JSONDecodeError:
-            self.send_error("invalid_json", "Invalid JSON format")
-        except ValueError as e:
-            self.send_error("invalid_request", str(e))
-        except Exception as e:
-            logger.error(f"Message handling error: {str(e)}")
-            self.send_error("server_error", "Internal server error")
-
-    # -------------------------------
-    # Message Handlers (following original structure)
-    # -------------------------------
-
-    def receive_message_send(self, data):
-        """Handle sending a new message."""
-        required_fields = ["room_id", "sender", "receiver", "message"]
-        if not all(field in data.get("data", {}) for field in required_fields):
-            self.send_error("validation_error", "Missing required fields")
-            return
-
-        message_data = data["data"]
-        if message_data["sender"] != self.username:
-            self.send_error("permission_denied", "Cannot send messages as another user")
-            return
-
-        messages_collection = get_messages_collection()
-        message_doc = {
-            "room_id": message_data["room_id"],
-            "sender": message_data["sender"],
-            "receiver": message_data["receiver"],
-            "message": message_data["message"],
-            "timestamp": datetime.utcnow(),
-            "is_read": False,
-            "delivered": False,
-        }
-
-        # Handle file attachment
-        if message_data.get("file") and message_data.get("filename"):
-            try:
-                file_data = base64.b64decode(message_data["file"])
-                message_doc["file"] = {
-                    "filename": message_data["filename"],
-                    "size": len(file_data),
-                    "data": file_data,
-                    "content_type": message_data.get(
-                        "content_type", "application/octet-stream"
-                    ),
-                }
-            except Exception as e:
-                logger.error(f"File processing error: {str(e)}")
-                self.send_error("file_error", "Invalid file data")
-                return
-
-        # Store message
-        result = messages_collection.insert_one(message_doc)
-        message_id = str(result.inserted_id)
-
-        # Prepare response
-        payload = {
-            "source": "message.send",
-            "data": {
-                "message_id": message_id,
-                "room_id": message_data["room_id"],
-                "sender": message_data["sender"],
-                "receiver": message_data["receiver"],
-                "message": message_data["message"],
-                "timestamp": message_doc["timestamp"].isoformat(),
-                "delivered": False,
-            },
-        }
-
-        # Add file info if present
-        if "file" in message_doc:
-            payload["data"]["file"] = {
-                "filename": message_doc["file"]["filename"],
-                "size": message_doc["file"]["size"],
-                "content_type": message_doc["file"]["content_type"],
-            }
-
-        # Send to sender (echo)
-        self.send(text_data=json.dumps(payload))
-
-        # Send to receiver
-        self.send_group(message_data["receiver"], payload)
-
-        # Update delivery status
-        messages_collection.update_one(
-            {"_id": ObjectId(message_id)}, {"$set": {"delivered": True}}
-        )
-
-    def receive_message_read(self, data):
-        """Handle marking message as read."""
-        if "message_id" not in data.get("data", {}):
-            self.send_error("validation_error", "Missing message_id")
-            return
-
-        message_id = data["data"]["message_id"]
-        messages_collection = get_messages_collection()
-
-        result = messages_collection.update_one(
-            {"_id": ObjectId(message_id), "receiver": self.username},
-            {"$set": {"is_read": True, "read_at": datetime.utcnow()}},
-        )
-
-        if result.modified_count == 0:
-            self.send_error("not_found", "Message not found or already read")
-            return
-
-        self.send_group(
-            self.username,
-            {
-                "source": "message.read",
-                "data": {
-                    "message_id": message_id,
-                    "status": "read",
-                    "read_at": datetime.utcnow().isoformat(),
-                },
-            },
-        )
-
-    def receive_message_edit(self, data):
-        """Handle editing a message."""
-        required_fields = ["message_id", "new_message"]
-        if not all(field in data.get("data", {}) for field in required_fields):
-            self.send_error("validation_error", "Missing required fields")
-            return
-
-        message_data = data["data"]
-        messages_collection = get_messages_collection()
-
-        result = messages_collection.update_one(
-            {"_id": ObjectId(message_data["message_id"]), "sender": self.username},
-            {
-                "$set": {
-                    "message": message_data["new_message"],
-                    "edited": True,
-                    "edited_at": datetime.utcnow(),
-                }
-            },
-        )
-
-        if result.modified_count == 0:
-            self.send_error("not_found", "Message not found or not authorized to edit")
-            return
-
-        # Get updated message to broadcast
-        updated_message = messages_collection.find_one(
-            {"_id": ObjectId(message_data["message_id"])}
-        )
-
-        payload = {
-            "source": "message.edit",
-            "data": {
-                "message_id": message_data["message_id"],
-                "room_id": updated_message["room_id"],
-                "sender": updated_message["sender"],
-                "receiver": updated_message["receiver"],
-                "new_message": message_data["new_message"],
-                "edited_at": updated_message.get(
-                    "edited_at", datetime.utcnow()
-                ).isoformat(),
-            },
-        }
-
-        self.send_group(updated_message["sender"], payload)
-        self.send_group(updated_message["receiver"], payload)
-
-    def receive_message_delete(self, data):
-        """Handle deleting a message."""
-        if "message_id" not in data.get("data", {}):
-            self.send_error("validation_error", "Missing message_id")
-            return
-
-        message_id = data["data"]["message_id"]
-        messages_collection = get_messages_collection()
-
-        # First get the message to determine participants
-        message = messages_collection.find_one({"_id": ObjectId(message_id)})
-
-        if not message:
-            self.send_error("not_found", "Message not found")
-            return
-
-        if message["sender"] != self.username:
-            self.send_error(
-                "permission_denied", "Not authorized to delete this message"
-            )
-            return
-
-        # Delete the message
-        result = messages_collection.delete_one({"_id": ObjectId(message_id)})
-
-        if result.deleted_count == 0:
-            self.send_error("server_error", "Failed to delete message")
-            return
-
-        payload = {
-            "source": "message.delete",
-            "data": {
-                "message_id": message_id,
-                "room_id": message["room_id"],
-                "deleted_by": self.username,
-                "deleted_at": datetime.utcnow().isoformat(),
-            },
-        }
-
-        self.send_group(message["sender"], payload)
-        self.send_group(message["receiver"], payload)
-
-    def receive_message_type(self, data):
-        """Handle typing indicators."""
-        required_fields = ["room_id", "receiver"]
-        if not all(field in data.get("data", {}) for field in required_fields):
-            self.send_error("validation_error", "Missing required fields")
-            return
-
-        self.send_group(
-            data["data"]["receiver"],
-            {
-                "source": "message.type",
-                "data": {
-                    "room_id": data["data"]["room_id"],
-                    "sender": self.username,
-                    "is_typing": data["data"].get("is_typing", True),
-                },
-            },
-        )
-
-    def receive_user_status(self, data):
-        """Handle user status requests."""
-        if "username" not in data.get("data", {}):
-            self.send_error("validation_error", "Missing username")
-            return
-
-        username = data["data"]["username"]
-        status = cache.get(f"user_status_{username}", "offline")
-        last_seen = cache.get(f"user_last_seen_{username}")
-
-        self.send(
-            text_data=json.dumps(
-                {
-                    "source": "user.status",
-                    "data": {
-                        "username": username,
-                        "status": status,
-                        "last_seen": last_seen.isoformat() if last_seen else None,
-                    },
-                }
-            )
-        )
-
-    def receive_user_list(self, data):
-        """Handle request for user list."""
-        try:
-            current_user_id = self.scope["user"].id
-            users = User.objects.exclude(id=current_user_id).only(
-                "username", "email", "first_name", "last_name"
-            )
-
-            user_list = []
-            for user in users:
-                status = cache.get(f"user_status_{user.username}", "offline")
-                last_seen = cache.get(f"user_last_seen_{user.username}")
-
-                user_list.append(
-                    {   
-                        "id": str(user.id),
-                        "username": user.username,
-                        "email": user.email,
-                        "first_name": user.first_name,
-                        "last_name": user.last_name,
-                        "status": status,
-                        "last_seen": last_seen.isoformat() if last_seen else None,
-                    }
-                )
-
-            self.send(text_data=json.dumps({"source": "user.list", "data": user_list}))
-        except Exception as e:
-            logger.error(f"User list error: {str(e)}")
-            self.send_error("server_error", "Failed to fetch users")
-
-    def receive_message_list(self, data):
-        """Handle request for message history."""
-        try:
-            room_id = data.get("data", {}).get("room_id")
-            if not room_id:
-                self.send_error("validation_error", "Missing room_id")
-                return
-
-            page = int(data.get("data", {}).get("page", 0))
-            page_size = min(int(data.get("data", {}).get("page_size", 20)), 100)
-            skip = page * page_size
-
-            messages_collection = get_messages_collection()
-            query = {
-                "room_id": room_id,
-                "$or": [{"sender": self.username}, {"receiver": self.username}],
-            }
-
-            total_count = messages_collection.count_documents(query)
-            messages_cursor = (
-                messages_collection.find(query)
-                .sort("timestamp", -1)
-                .skip(skip)
-                .limit(page_size)
-            )
-
-            messages = []
-            for msg in messages_cursor:
-                message_data = {
-                    "message_id": str(msg["_id"]),
-                    "room_id": msg["room_id"],
-                    "sender": msg["sender"],
-                    "receiver": msg["receiver"],
-                    "message": msg["message"],
-                    "timestamp": msg["timestamp"].isoformat(),
-                    "is_read": msg.get("is_read", False),
-                    "delivered": msg.get("delivered", False),
-                    "edited": msg.get("edited", False),
-                    "edited_at": (
-                        msg.get("edited_at", "").isoformat()
-                        if msg.get("edited_at")
-                        else None
-                    ),
-                }
-
-                if "file" in msg:
-                    message_data["file"] = {
-                        "filename": msg["file"]["filename"],
-                        "size": msg["file"]["size"],
-                        "content_type": msg["file"]["content_type"],
-                    }
-
-                messages.append(message_data)
-
-            messages.reverse()  # Return in chronological order
-
-            self.send(
-                text_data=json.dumps(
-                    {
-                        "source": "message.list",
-                        "data": {
-                            "messages": messages,
-                            "page": page,
-                            "page_size": page_size,
-                            "total": total_count,
-                            "has_more": (skip + page_size) < total_count,
-                        },
-                    }
-                )
-            )
-
-        except Exception as e:
-            logger.error(f"Message list error: {str(e)}")
-            self.send_error("server_error", "Failed to fetch messages")
-
-    def receive_ping(self, data):
-        """Handle ping/pong keepalive."""
-        self.send(text_data=json.dumps({"source": "pong"}))
-
-    # -------------------------------
-    # Utility Methods
-    # -------------------------------
-
-    def get_user_from_token(self, token):
-        """Authenticate user from JWT token."""
-        try:
-            if not token:
-                return AnonymousUser()
-
-            if token.startswith("Bearer "):
-                token = token[7:]
-
-            payload = jwt_decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            user = User.objects.get(id=payload["user_id"])
-
-            if not user.is_active:
-                raise InvalidTokenError("User account is disabled")
-
-            return user
-        except Exception as e:
-            logger.warning(f"Token validation failed: {str(e)}")
-            return AnonymousUser()
-
-    def send_group(self, group, payload):
-        """Send message to a channel group."""
-        async_to_sync(self.channel_layer.group_send)(
-            group, {"type": "broadcast_group", **payload}
-        )
-
-    def broadcast_group(self, event):
-        """Handle messages sent to groups."""
-        event.pop("type", None)
-        self.send(text_data=json.dumps(event))
-
-    def send_error(self, error_type, message):
-        """Send error message to client."""
-        self.send(
-            text_data=json.dumps(
-                {"source": "error", "error": {"type": error_type, "message": message}}
-            )
-        )
-
-    def send_pending_messages(self):
-        """Send any undelivered messages to user upon connection."""
-        if not hasattr(self, "username"):
-            return
-
-        messages_collection = get_messages_collection()
-        pending_messages = messages_collection.find(
-            {"receiver": self.username, "delivered": False}
-        ).sort("timestamp", 1)
-
-        for msg in pending_messages:
-            payload = {
-                "source": "message.send",
-                "data": {
-                    "message_id": str(msg["_id"]),
-                    "room_id": msg["room_id"],
-                    "sender": msg["sender"],
-                    "receiver": msg["receiver"],
-                    "message": msg["message"],
-                    "timestamp": msg["timestamp"].isoformat(),
-                    "delivered": True,
-                },
-            }
-
-            if "file" in msg:
-                payload["data"]["file"] = {
-                    "filename": msg["file"]["filename"],
-                    "size": msg["file"]["size"],
-                    "content_type": msg["file"]["content_type"],
-                }
-
-            self.send(text_data=json.dumps(payload))
-
-            # Update delivery status
-            messages_collection.update_one(
-                {"_id": msg["_id"]}, {"$set": {"delivered": True}}
-            )
+import asyncio
+import base64
+import logging
+import time
+from bson import ObjectId
+from datetime import datetime
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from urllib.parse import parse_qs
+from django.contrib.auth.models import AnonymousUser
+from chat import metrics
+from chat.attachments import (
+    DEFAULT_CONTENT_TYPE,
+    AttachmentNotFound,
+    get_attachment_storage,
+    message_file_info,
+)
+from chat.authentication import aget_user_for_jwt
+from chat.conf import chat_setting
+from chat.conversations import (
+    aget_conversations,
+    amark_read,
+    arecord_delete,
+    arecord_edit,
+    arecord_message,
+    aset_unread,
+)
+from chat.directory import get_directory_page, parse_fields
+from chat.dispatch import Field, HandlerRegistryMixin, ValidationError, handles
+from chat.mongo_utils import get_async_messages_collection
+from chat.protocol import JSON, encode_frames, negotiate
+from chat.presence import ONLINE, get_presence
+from chat.ratelimit import get_rate_limiter
+from chat.outbound import OutboundQueue
+from chat.pagination import build_page, clamp_page_size, keyset_query
+from chat.rooms import (
+    aget_room_members,
+    aget_user_room_ids,
+    room_group_name,
+    room_members_cache,
+)
+from chat.receipts import aadvance_watermark, acount_unread, up_to_watermark
+from chat.repository import get_async_message_repository, message_summary
+from chat.search import asearch_messages, get_search_backend
+from chat.typing_throttle import TypingThrottle
+from chat.write_behind import ainsert_message
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on ids accepted in one message.ack or message.read frame.
+MAX_ACK_IDS = 1000
+# Longest room id, username or cursor accepted in a frame.
+MAX_KEY_LENGTH = 256
+MAX_FILENAME_LENGTH = 255
+MAX_SEARCH_LENGTH = 500
+# Read once, when the handler schemas are compiled.
+MAX_MESSAGE_LENGTH = chat_setting("MAX_MESSAGE_LENGTH")
+
+# Field types shared by the handler schemas (see chat.dispatch).
+OBJECT_ID = Field(str, object_id=True)
+MESSAGE_ID = Field(str, required=True, object_id=True)
+ROOM_ID = Field(str, required=True, min_length=1, max_length=MAX_KEY_LENGTH)
+KEY = Field(str, max_length=MAX_KEY_LENGTH)
+PAGE_SIZE = Field(int)
+
+# group_add calls in flight at once while subscribing a socket to its rooms.
+ROOM_SUBSCRIBE_CONCURRENCY = 50
+
+# Sources whose rate-limited frames are dropped without an error frame:
+# typing indicators are fire-and-forget and already throttled on fan-out.
+QUIET_RATE_LIMITED_SOURCES = frozenset({"message.type"})
+
+# Sent when a message has neither a room created through /api/rooms/ nor
+# an explicit receiver to route it to.
+NO_RECEIVER = "receiver is required outside rooms created through /api/rooms/"
+
+
+class ChatConsumer(HandlerRegistryMixin, AsyncWebsocketConsumer):
+    """WebSocket consumer for chat functionality following original structure.
+
+    Runs natively on the event loop: Mongo access goes through the async
+    driver and channel layer calls are awaited directly, so an idle socket
+    costs a coroutine rather than a thread-pool worker.
+
+    Frames are JSON unless the client negotiates ``chat.msgpack`` through
+    ``Sec-WebSocket-Protocol`` (see chat.protocol). Handlers are registered
+    per ``source`` with ``@handles``, which also declares the schema their
+    ``data`` is validated against (see chat.dispatch).
+    """
+
+    # Until connect() negotiates a subprotocol, frames are JSON.
+    codec = JSON
+    # Created once the socket is accepted; see chat.outbound.
+    outbound = None
+    # Whether this socket is counted in metrics.CONNECTIONS.
+    metered = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Room ids whose channel group this socket has joined.
+        self.rooms = set()
+        self.limiter = get_rate_limiter()
+        self.typing = TypingThrottle(
+            self.publish_typing,
+            interval=chat_setting("TYPING_THROTTLE_INTERVAL"),
+            timeout=chat_setting("TYPING_TIMEOUT"),
+        )
+
+    async def connect(self):
+        """Handle WebSocket connection."""
+        try:
+            query_string = self.scope["query_string"].decode()
+            query_params = parse_qs(query_string)
+            token = query_params.get("token", [None])[0]
+
+            user = await self.get_user_from_token(token)
+            if not user or not user.is_authenticated:
+                logger.warning("Unauthorized connection attempt")
+                await self.close()
+                return
+
+            self.scope["user"] = user
+            self.user = user
+            self.username = user.username
+
+            self.codec, subprotocol = negotiate(self.scope.get("subprotocols"))
+
+            await self.channel_layer.group_add(self.username, self.channel_name)
+            await self.subscribe_rooms(await aget_user_room_ids(self.username))
+            await self.accept(subprotocol=subprotocol)
+            if metrics.enabled:
+                metrics.CONNECTIONS.inc()
+                self.metered = True
+
+            self.outbound = OutboundQueue(
+                self,
+                max_size=chat_setting("OUTBOUND_QUEUE_SIZE"),
+                window=chat_setting("OUTBOUND_FLUSH_WINDOW"),
+                batching=query_params.get("batch", ["0"])[0] == "1",
+                max_batch=chat_setting("OUTBOUND_MAX_BATCH"),
+            )
+            self.start_task(self.outbound.run())
+
+            await get_presence().connect(self.username, self.channel_name)
+            self.start_task(self.presence_heartbeat())
+
+            await self.send_payload(
+                {
+                    "source": "connection",
+                    "data": {
+                        "message": "connected",
+                        "username": self.username,
+                        "timestamp": datetime.utcnow().isoformat(),
+                    },
+                }
+            )
+
+            # Send any pending messages without holding up the handshake
+            self.start_task(self.send_pending_messages())
+
+        except Exception as e:
+            logger.error(f"Connection error: {str(e)}")
+            await self.close()
+
+    async def disconnect(self, close_code):
+        """Handle WebSocket disconnection."""
+        try:
+            for task in list(getattr(self, "tasks", ())):
+                task.cancel()
+            if self.metered:
+                metrics.CONNECTIONS.dec()
+                self.metered = False
+
+            if hasattr(self, "username"):
+                await self.typing.close()
+                for room_id in list(self.rooms):
+                    await self.unsubscribe_room(room_id)
+                await self.channel_layer.group_discard(self.username, self.channel_name)
+                await get_presence().disconnect(self.username, self.channel_name)
+                logger.info(f"User {self.username} disconnected")
+        except Exception as e:
+            logger.error(f"Disconnection error: {str(e)}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Receive and route incoming messages."""
+        if metrics.enabled:
+            # Bytes on the wire: text frames are UTF-8 encoded.
+            if text_data is not None:
+                size = len(text_data.encode())
+            else:
+                size = len(bytes_data or b"")
+            metrics.FRAME_BYTES.observe(size, "in")
+        # Shed frames over their rate limit before parsing them, when the
+        # source can be read off the front of the frame.
+        peeked = self.codec.peek_source(text_data, bytes_data)
+        if peeked is not None and await self.rate_limited(peeked):
+            return
+
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except self.codec.decode_errors:
+            await self.send_error(self.codec.error_type, self.codec.error_message)
+            return
+
+        try:
+            handler = self.handlers.resolve(data)
+            # Decoders keep the last of duplicate keys, so the source that
+            # is dispatched can differ from the one peeked at; it is the
+            # dispatched one that must pay.
+            if handler.source != peeked and await self.rate_limited(handler.source):
+                return
+
+            try:
+                data["data"] = handler.schema.validate(data.get("data"))
+            except ValidationError as e:
+                await self.send_error(
+                    "validation_error", str(e), source=handler.source, fields=e.errors
+                )
+                return
+
+            if metrics.enabled:
+                await self.timed_handler(handler, data)
+            else:
+                await handler.method(self, data)
+
+        except ValueError as e:
+            await self.send_error("invalid_request", str(e))
+        except Exception as e:
+            logger.error(f"Message handling error: {str(e)}")
+            await self.send_error("server_error", "Internal server error")
+
+    async def rate_limited(self, source):
+        """Take a rate limit token for a ``source`` frame (see chat.ratelimit).
+
+        Returns True, after answering with a ``rate_limited`` error, if the
+        frame must be dropped. Repeated errors for the same source replace
+        each other while queued rather than piling up; sources in
+        ``QUIET_RATE_LIMITED_SOURCES`` are dropped without one.
+        """
+        if self.limiter is None:
+            return False
+        retry_after = await self.limiter.hit(self.username, source)
+        if not retry_after:
+            return False
+        if metrics.enabled:
+            metrics.RATE_LIMITED.inc(self.limiter.limit_for(source)[0])
+        if source in QUIET_RATE_LIMITED_SOURCES:
+            return True
+        await self.send_error(
+            "rate_limited",
+            f"Too many {source} requests",
+            key=f"rate_limited:{source}",
+            source=source,
+            retry_after=round(retry_after, 3),
+        )
+        return True
+
+    async def timed_handler(self, handler, data):
+        """Run ``handler`` recording its latency per source."""
+        start = time.perf_counter()
+        try:
+            await handler.method(self, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(handler.source)
+            raise
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, handler.source)
+
+    # -------------------------------
+    # Message Handlers (following original structure)
+    # -------------------------------
+
+    @handles(
+        "message.send",
+        room_id=ROOM_ID,
+        sender=Field(str, required=True, max_length=MAX_KEY_LENGTH),
+        message=Field(str, required=True, max_length=MAX_MESSAGE_LENGTH),
+        receiver=KEY,
+        file_id=KEY,
+        file=Field(str, bytes),
+        filename=Field(str, max_length=MAX_FILENAME_LENGTH),
+        content_type=Field(str, max_length=MAX_FILENAME_LENGTH),
+    )
+    async def receive_message_send(self, data):
+        """Handle sending a new message.
+
+        The message is written exactly once. Its ``status`` is decided up
+        front from presence: ``sent`` when the receiver has a live
+        connection, ``queued`` otherwise. ``delivered`` only becomes true
+        when the receiver acknowledges it with ``message.ack`` (or, with
+        REQUIRE_DELIVERY_ACK off, when the receiver is online at send time).
+
+        Messages to a room created through /api/rooms/ are published once to
+        the room group; ``receiver`` is then optional and, for two-person
+        rooms, filled in from the membership. Other room ids keep the
+        original per-receiver routing.
+        """
+        message_data = data["data"]
+        if message_data["sender"] != self.username:
+            await self.send_error(
+                "permission_denied", "Cannot send messages as another user"
+            )
+            return
+
+        members = await aget_room_members(message_data["room_id"])
+        if members is not None:
+            if self.username not in members:
+                await self.send_error(
+                    "permission_denied", "Not a participant of this room"
+                )
+                return
+            others = members - {self.username}
+            receiver = message_data.get("receiver") or (
+                next(iter(others)) if len(others) == 1 else None
+            )
+        elif message_data.get("receiver"):
+            receiver = message_data["receiver"]
+        else:
+            await self.send_error("validation_error", NO_RECEIVER)
+            return
+
+        receiver_online = False
+        if receiver:
+            receiver_status = await get_presence().get_status(receiver)
+            receiver_online = receiver_status["status"] == ONLINE
+        delivered = receiver_online and not chat_setting("REQUIRE_DELIVERY_ACK")
+
+        message_doc = {
+            "room_id": message_data["room_id"],
+            "sender": message_data["sender"],
+            "receiver": receiver,
+            "message": message_data["message"],
+            "timestamp": datetime.utcnow(),
+            "is_read": False,
+            "status": "sent" if receiver_online or not receiver else "queued",
+            "delivered": delivered,
+        }
+
+        # Handle file attachment. Files are uploaded out of band through
+        # /api/attachments/ and referenced by file_id; inline data (base64 in
+        # JSON, raw bytes over msgpack) is still accepted but goes to the
+        # same storage.
+        storage = get_attachment_storage()
+        if message_data.get("file_id"):
+            try:
+                file_info = await storage.adescribe(message_data["file_id"])
+            except AttachmentNotFound:
+                await self.send_error("file_error", "Unknown attachment")
+                return
+            if file_info["owner"] != self.username:
+                await self.send_error(
+                    "permission_denied", "Cannot attach another user's file"
+                )
+                return
+            message_doc["file"] = message_file_info(file_info)
+        elif message_data.get("file") and message_data.get("filename"):
+            try:
+                file_data = message_data["file"]
+                if not isinstance(file_data, bytes):
+                    file_data = base64.b64decode(file_data)
+            except Exception as e:
+                logger.error(f"File processing error: {str(e)}")
+                await self.send_error("file_error", "Invalid file data")
+                return
+            if len(file_data) > chat_setting("ATTACHMENT_MAX_SIZE"):
+                await self.send_error("file_error", "File too large")
+                return
+            file_info = await storage.asave(
+                file_data,
+                message_data["filename"],
+                message_data.get("content_type", DEFAULT_CONTENT_TYPE),
+                self.username,
+            )
+            message_doc["file"] = message_file_info(file_info)
+
+        # Store message (possibly batched with others, see chat.write_behind)
+        message_id = str(await ainsert_message(message_doc))
+        await arecord_message(
+            members if members is not None else (self.username, receiver), message_doc
+        )
+        get_search_backend().index_message(message_doc)
+
+        # Prepare response
+        payload = {
+            "source": "message.send",
+            "data": {
+                "message_id": message_id,
+                "room_id": message_data["room_id"],
+                "sender": message_data["sender"],
+                "receiver": receiver,
+                "message": message_data["message"],
+                "timestamp": message_doc["timestamp"].isoformat(),
+                "status": message_doc["status"],
+                "delivered": delivered,
+            },
+        }
+
+        # Add file info if present
+        if "file" in message_doc:
+            payload["data"]["file"] = message_doc["file"]
+
+        # Encode once for the echo and every receiving socket
+        frames = encode_frames(payload)
+
+        if members is not None:
+            # One publish reaches every member's sockets, this one included.
+            await self.subscribe_room(message_data["room_id"])
+            await self.send_group(
+                room_group_name(message_data["room_id"]), payload, frames
+            )
+            return
+
+        # Send to sender (echo)
+        await self.send_frame(frames)
+
+        # Send to receiver. Published even when presence says offline: a
+        # connection that raced the presence read still gets it live, and
+        # anything unacknowledged is redelivered on the next connect.
+        await self.send_group(receiver, payload, frames)
+
+    @handles(
+        "message.ack",
+        message_ids=Field(
+            list, required=True, min_length=1, max_length=MAX_ACK_IDS, items=OBJECT_ID
+        ),
+    )
+    async def receive_message_ack(self, data):
+        """Handle delivery acknowledgements from the receiver.
+
+        Accepts ``message_ids`` for messages received via ``message.send``
+        or ``message.batch``; senders are told with ``message.delivered``.
+        """
+        message_ids = data["data"]["message_ids"]
+        query = {
+            "_id": {"$in": [ObjectId(message_id) for message_id in message_ids]},
+            "receiver": self.username,
+            "delivered": False,
+        }
+        repository = get_async_message_repository()
+        acked = await repository.find(query, "metadata").to_list(length=None)
+        if not acked:
+            return
+
+        delivered_at = datetime.utcnow()
+        await repository.collection.update_many(
+            {"_id": {"$in": [msg["_id"] for msg in acked]}},
+            {"$set": {"delivered": True, "delivered_at": delivered_at}},
+        )
+
+        by_sender = {}
+        for msg in acked:
+            by_sender.setdefault(msg["sender"], []).append(str(msg["_id"]))
+        for sender, sender_message_ids in by_sender.items():
+            await self.send_group(
+                sender,
+                {
+                    "source": "message.delivered",
+                    "data": {
+                        "message_ids": sender_message_ids,
+                        "receiver": self.username,
+                        "delivered_at": delivered_at.isoformat(),
+                    },
+                },
+            )
+
+    @handles(
+        "message.read",
+        message_ids=Field(list, min_length=1, max_length=MAX_ACK_IDS, items=OBJECT_ID),
+        message_id=OBJECT_ID,
+        room_id=Field(str, min_length=1, max_length=MAX_KEY_LENGTH),
+        up_to=OBJECT_ID,
+        up_to_timestamp=Field(str, max_length=64, parse=datetime.fromisoformat),
+    )
+    async def receive_message_read(self, data):
+        """Handle read receipts.
+
+        Accepts ``message_ids`` (or a single ``message_id``) for specific
+        messages, or ``room_id`` with a watermark -- ``up_to`` (a message id)
+        or ``up_to_timestamp`` (ISO 8601) -- to mark everything in the room
+        up to that point. Either form is applied with one ``update_many``
+        and answered with one aggregated ``message.read`` per recipient.
+
+        Group messages have no receiver and no per-reader flag, so listing
+        one advances the reader's watermark in its room up to the newest
+        listed message, as ``up_to`` would.
+        """
+        read_data = data["data"]
+        if read_data.get("room_id"):
+            await self.mark_room_read(read_data)
+            return
+
+        message_ids = read_data.get("message_ids")
+        if message_ids is None and read_data.get("message_id"):
+            message_ids = [read_data["message_id"]]
+        if not message_ids:
+            await self.send_error(
+                "validation_error", "message_ids, message_id or room_id is required"
+            )
+            return
+
+        query = {
+            "_id": {"$in": [ObjectId(message_id) for message_id in message_ids]},
+            "$or": [
+                {"receiver": self.username, "is_read": {"$ne": True}},
+                {"receiver": None, "sender": {"$ne": self.username}},
+            ],
+        }
+        repository = get_async_message_repository()
+        found = await repository.find(query, "metadata").to_list(length=None)
+        read = [msg for msg in found if msg.get("receiver") == self.username]
+
+        newest_in_room = {}
+        for msg in found:
+            if msg.get("receiver") is None:
+                newest = newest_in_room.setdefault(msg["room_id"], msg)
+                if (msg["timestamp"], msg["_id"]) > (newest["timestamp"], newest["_id"]):
+                    newest_in_room[msg["room_id"]] = msg
+        group_reads = []
+        for room_id, newest in newest_in_room.items():
+            members = await aget_room_members(room_id)
+            if members is not None and self.username in members:
+                group_reads.append((room_id, members, newest))
+
+        if not read and not group_reads:
+            await self.send_error("not_found", "Message not found or already read")
+            return
+
+        for room_id, members, newest in group_reads:
+            await self.advance_room_read(
+                room_id, members, newest["timestamp"], newest["_id"]
+            )
+        if not read:
+            return
+
+        read_at = datetime.utcnow()
+        await repository.collection.update_many(
+            {"_id": {"$in": [msg["_id"] for msg in read]}},
+            {"$set": {"is_read": True, "read_at": read_at}},
+        )
+
+        by_room = {}
+        for msg in read:
+            by_room[msg["room_id"]] = by_room.get(msg["room_id"], 0) + 1
+        await amark_read(self.username, by_room)
+
+        by_sender = {}
+        for msg in read:
+            by_sender.setdefault(msg["sender"], []).append(str(msg["_id"]))
+        # The reader's other sockets get the full list too.
+        by_sender[self.username] = [str(msg["_id"]) for msg in read]
+        for recipient, recipient_message_ids in by_sender.items():
+            await self.send_group(
+                recipient,
+                {
+                    "source": "message.read",
+                    "data": {
+                        "message_ids": recipient_message_ids,
+                        "reader": self.username,
+                        "status": "read",
+                        "read_at": read_at.isoformat(),
+                    },
+                },
+            )
+
+    async def mark_room_read(self, read_data):
+        """Mark a room read up to a watermark and advance the stored one."""
+        room_id = read_data["room_id"]
+        # Checked before the anchor lookup so non-members learn nothing
+        # about the room's messages.
+        members = await aget_room_members(room_id)
+        if members is not None and self.username not in members:
+            await self.send_error("not_found", "Room not found")
+            return
+
+        repository = get_async_message_repository()
+        if read_data.get("up_to"):
+            anchor = await repository.find_one(
+                {"_id": ObjectId(read_data["up_to"]), "room_id": room_id}
+            )
+            if anchor is None:
+                await self.send_error("not_found", "Message not found")
+                return
+            timestamp, message_id = anchor["timestamp"], anchor["_id"]
+        elif read_data.get("up_to_timestamp"):
+            timestamp = read_data["up_to_timestamp"]
+            message_id = None
+        else:
+            await self.send_error(
+                "validation_error", "up_to or up_to_timestamp is required with room_id"
+            )
+            return
+        await self.advance_room_read(room_id, members, timestamp, message_id)
+
+    async def advance_room_read(self, room_id, members, timestamp, message_id):
+        """Apply a read watermark in ``room_id`` and announce it."""
+        repository = get_async_message_repository()
+        query = {"room_id": room_id, "receiver": self.username, "is_read": False}
+        query.update(up_to_watermark(timestamp, message_id))
+        # Rooms without a rooms document have no channel group; their
+        # receipt goes to each sender's own group instead.
+        senders = []
+        if members is None:
+            senders = await repository.collection.distinct("sender", query)
+
+        read_at = datetime.utcnow()
+        result = await repository.collection.update_many(
+            query, {"$set": {"is_read": True, "read_at": read_at}}
+        )
+        watermark = await aadvance_watermark(
+            self.username, room_id, timestamp, message_id
+        )
+        await aset_unread(
+            self.username,
+            room_id,
+            await acount_unread(self.username, room_id, watermark),
+        )
+
+        await self.send_room(
+            room_id,
+            {
+                "source": "message.read",
+                "data": {
+                    "room_id": room_id,
+                    "reader": self.username,
+                    "up_to": {
+                        "message_id": str(message_id) if message_id else None,
+                        "timestamp": timestamp.isoformat(),
+                    },
+                    "count": result.modified_count,
+                    "status": "read",
+                    "read_at": read_at.isoformat(),
+                },
+            },
+            [*senders, self.username],
+        )
+
+    @handles(
+        "message.edit",
+        message_id=MESSAGE_ID,
+        new_message=Field(str, required=True, max_length=MAX_MESSAGE_LENGTH),
+    )
+    async def receive_message_edit(self, data):
+        """Handle editing a message."""
+        message_data = data["data"]
+        repository = get_async_message_repository()
+        edited_at = datetime.utcnow()
+
+        # Update and fetch the routing fields in one round trip
+        updated_message = await repository.find_one_and_update(
+            {"_id": ObjectId(message_data["message_id"]), "sender": self.username},
+            {
+                "$set": {
+                    "message": message_data["new_message"],
+                    "edited": True,
+                    "edited_at": edited_at,
+                }
+            },
+        )
+
+        if updated_message is None:
+            await self.send_error(
+                "not_found", "Message not found or not authorized to edit"
+            )
+            return
+
+        await arecord_edit(
+            {
+                "_id": updated_message["_id"],
+                "room_id": updated_message["room_id"],
+                "message": message_data["new_message"],
+            }
+        )
+        get_search_backend().update_message(
+            updated_message["_id"], message_data["new_message"]
+        )
+
+        payload = {
+            "source": "message.edit",
+            "data": {
+                "message_id": message_data["message_id"],
+                "room_id": updated_message["room_id"],
+                "sender": updated_message["sender"],
+                "receiver": updated_message["receiver"],
+                "new_message": message_data["new_message"],
+                "edited_at": edited_at.isoformat(),
+            },
+        }
+
+        await self.send_room(
+            updated_message["room_id"],
+            payload,
+            [updated_message["sender"], updated_message["receiver"]],
+        )
+
+    @handles("message.delete", message_id=MESSAGE_ID)
+    async def receive_message_delete(self, data):
+        """Handle deleting a message."""
+        message_id = data["data"]["message_id"]
+        repository = get_async_message_repository()
+
+        # First get the message to determine participants
+        message = await repository.find_one({"_id": ObjectId(message_id)}, "summary")
+
+        if not message:
+            await self.send_error("not_found", "Message not found")
+            return
+
+        if message["sender"] != self.username:
+            await self.send_error(
+                "permission_denied", "Not authorized to delete this message"
+            )
+            return
+
+        # Delete the message
+        result = await repository.collection.delete_one({"_id": ObjectId(message_id)})
+
+        if result.deleted_count == 0:
+            await self.send_error("server_error", "Failed to delete message")
+            return
+        await arecord_delete(message)
+        get_search_backend().remove_message(message["_id"])
+
+        payload = {
+            "source": "message.delete",
+            "data": {
+                "message_id": message_id,
+                "room_id": message["room_id"],
+                "deleted_by": self.username,
+                "deleted_at": datetime.utcnow().isoformat(),
+            },
+        }
+
+        await self.send_room(
+            message["room_id"], payload, [message["sender"], message["receiver"]]
+        )
+
+    @handles("message.type", room_id=ROOM_ID, is_typing=Field(bool), receiver=KEY)
+    async def receive_message_type(self, data):
+        """Handle typing indicators (throttled, see chat.typing_throttle)."""
+        room_id = data["data"]["room_id"]
+        # Sent per keystroke, so repeated refusals coalesce in the queue.
+        members = await aget_room_members(room_id)
+        if members is not None and self.username not in members:
+            await self.send_error(
+                "permission_denied",
+                "Not a participant of this room",
+                key=f"type_error:{room_id}",
+            )
+            return
+        published = await self.typing.update(
+            room_id,
+            data["data"].get("is_typing", True),
+            data["data"].get("receiver"),
+        )
+        if published is False:
+            await self.send_error(
+                "validation_error", NO_RECEIVER, key=f"type_error:{room_id}"
+            )
+
+    async def publish_typing(self, room_id, receiver, is_typing):
+        return await self.send_room(
+            room_id,
+            {
+                "source": "message.type",
+                "data": {
+                    "room_id": room_id,
+                    "sender": self.username,
+                    "is_typing": is_typing,
+                },
+            },
+            [receiver],
+            key=f"type:{room_id}:{self.username}",
+        )
+
+    @handles("room.join", room_id=ROOM_ID)
+    async def receive_room_join(self, data):
+        """Subscribe this socket to a room's broadcasts."""
+        room_id = data["data"]["room_id"]
+
+        members = await aget_room_members(room_id)
+        if members is None or self.username not in members:
+            await self.send_error("not_found", "Room not found")
+            return
+
+        await self.subscribe_room(room_id)
+        await self.send_payload(
+            {"source": "room.join", "data": {"room_id": room_id, "status": "joined"}}
+        )
+
+    @handles("room.leave", room_id=ROOM_ID)
+    async def receive_room_leave(self, data):
+        """Stop receiving a room's broadcasts on this socket."""
+        room_id = data["data"]["room_id"]
+
+        await self.unsubscribe_room(room_id)
+        await self.send_payload(
+            {"source": "room.leave", "data": {"room_id": room_id, "status": "left"}}
+        )
+
+    @handles(
+        "user.status",
+        username=Field(str, required=True, min_length=1, max_length=MAX_KEY_LENGTH),
+    )
+    async def receive_user_status(self, data):
+        """Handle user status requests."""
+        username = data["data"]["username"]
+        presence = await get_presence().get_status(username)
+
+        await self.send_payload(
+            {
+                "source": "user.status",
+                "data": {"username": username, **presence},
+            }
+        )
+
+    @handles(
+        "user.list",
+        search=KEY,
+        after=KEY,
+        limit=Field(int),
+        fields=Field(str, list, max_length=MAX_KEY_LENGTH, items=KEY),
+    )
+    async def receive_user_list(self, data):
+        """Handle request for user list.
+
+        Accepts optional ``search`` (prefix of username or name), ``after``
+        (cursor from the previous page), ``limit`` and ``fields``.
+        """
+        try:
+            params = data["data"]
+            page = await database_sync_to_async(get_directory_page)(
+                search=params.get("search"),
+                after=params.get("after"),
+                limit=params.get("limit"),
+                fields=parse_fields(params.get("fields")),
+                exclude_username=self.username,
+            )
+            statuses = await get_presence().get_statuses(
+                [user["username"] for user in page["results"]]
+            )
+
+            user_list = []
+            for user in page["results"]:
+                if "id" in user:
+                    user = {**user, "id": str(user["id"])}
+                user_list.append({**user, **statuses[user["username"]]})
+
+            await self.send_payload(
+                {
+                    "source": "user.list",
+                    "data": {"users": user_list, "next": page["next"]},
+                }
+            )
+        except ValueError as e:
+            await self.send_error("validation_error", str(e))
+        except Exception as e:
+            logger.error(f"User list error: {str(e)}")
+            await self.send_error("server_error", "Failed to fetch users")
+
+    @handles(
+        "message.list",
+        room_id=ROOM_ID,
+        page_size=PAGE_SIZE,
+        before=KEY,
+        after=KEY,
+        include_total=Field(bool),
+    )
+    async def receive_message_list(self, data):
+        """Handle request for message history.
+
+        Pages are addressed with the opaque ``before``/``after`` cursors
+        returned by the previous page; ``total`` is only computed when the
+        client asks for it with ``include_total``. Members of a room created
+        through /api/rooms/ see all of its messages; in other rooms only
+        the messages they sent or received.
+        """
+        try:
+            params = data["data"]
+            room_id = params["room_id"]
+
+            page_size = clamp_page_size(params.get("page_size"))
+
+            members = await aget_room_members(room_id)
+            if members is None:
+                base_query = {
+                    "room_id": room_id,
+                    "$or": [{"sender": self.username}, {"receiver": self.username}],
+                }
+            elif self.username in members:
+                base_query = {"room_id": room_id}
+            else:
+                await self.send_error("not_found", "Room not found")
+                return
+
+            repository = get_async_message_repository()
+            query, sort = keyset_query(
+                base_query, before=params.get("before"), after=params.get("after")
+            )
+
+            messages_cursor = repository.find(query).sort(sort).limit(page_size + 1)
+            docs = await messages_cursor.to_list(length=page_size + 1)
+            docs, has_more, cursors = build_page(docs, page_size, sort)
+            messages = [message_summary(msg) for msg in docs]
+
+            response = {
+                "messages": messages,
+                "page_size": page_size,
+                "has_more": has_more,
+                "cursors": cursors,
+            }
+            if params.get("include_total"):
+                response["total"] = await repository.collection.count_documents(
+                    base_query
+                )
+
+            await self.send_payload({"source": "message.list", "data": response})
+
+        except ValueError as e:
+            await self.send_error("validation_error", str(e))
+        except Exception as e:
+            logger.error(f"Message list error: {str(e)}")
+            await self.send_error("server_error", "Failed to fetch messages")
+
+    @handles("conversation.list", before=KEY, page_size=PAGE_SIZE)
+    async def receive_conversation_list(self, data):
+        """Handle a request for the user's conversations.
+
+        Most recently active first, with last message preview and unread
+        count (see chat.conversations); older pages via ``before``.
+        """
+        params = data["data"]
+        try:
+            response = await aget_conversations(
+                self.username, params.get("before"), params.get("page_size")
+            )
+        except ValueError as e:
+            await self.send_error("validation_error", str(e))
+            return
+        await self.send_payload({"source": "conversation.list", "data": response})
+
+    @handles(
+        "message.search",
+        q=Field(str, required=True, min_length=1, max_length=MAX_SEARCH_LENGTH),
+        room_id=KEY,
+        sender=KEY,
+        start=KEY,
+        end=KEY,
+        after=KEY,
+        page_size=PAGE_SIZE,
+    )
+    async def receive_message_search(self, data):
+        """Handle a full-text search over the user's conversations.
+
+        Accepts ``q`` plus optional ``room_id``, ``sender``, ``start``/``end``
+        (ISO 8601), ``page_size`` and the ``after`` cursor of the previous
+        page; see chat.search.
+        """
+        try:
+            response = await asearch_messages(self.username, data["data"])
+        except ValueError as e:
+            await self.send_error("validation_error", str(e))
+            return
+        await self.send_payload({"source": "message.search", "data": response})
+
+    @handles("ping")
+    async def receive_ping(self, data):
+        """Handle ping/pong keepalive."""
+        await self.send_payload({"source": "pong"})
+
+    # -------------------------------
+    # Utility Methods
+    # -------------------------------
+
+    def start_task(self, coro):
+        """Run ``coro`` alongside the connection; cancelled on disconnect."""
+        if not hasattr(self, "tasks"):
+            self.tasks = set()
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def presence_heartbeat(self):
+        """Keep this connection's presence entry alive while the socket is open."""
+        interval = chat_setting("PRESENCE_HEARTBEAT_INTERVAL")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await get_presence().heartbeat(self.username, self.channel_name)
+            except Exception as e:
+                logger.error(f"Presence heartbeat error: {str(e)}")
+
+    async def get_user_from_token(self, token):
+        """Authenticate user from JWT token."""
+        try:
+            if not token:
+                return AnonymousUser()
+
+            if token.startswith("Bearer "):
+                token = token[7:]
+
+            return await aget_user_for_jwt(token)
+        except Exception as e:
+            logger.warning(f"Token validation failed: {str(e)}")
+            return AnonymousUser()
+
+    async def send_group(self, group, payload, frames=None, key=None):
+        """Send message to a channel group.
+
+        The payload is encoded here, once per codec, and travels through
+        the layer as ready-made frames, so the cost does not grow with the
+        number of receiving sockets. Pass ``frames`` to reuse an encoding
+        and ``key`` to let receivers replace a still-queued frame with the
+        same key (see chat.outbound).
+        """
+        if frames is None:
+            frames = encode_frames(payload)
+        event = {"type": "broadcast_group", "frames": frames}
+        if key is not None:
+            event["key"] = key
+        if metrics.enabled:
+            with metrics.LAYER_PUBLISH_SECONDS.time():
+                await self.channel_layer.group_send(group, event)
+        else:
+            await self.channel_layer.group_send(group, event)
+
+    async def send_room(self, room_id, payload, fallback_users=(), key=None):
+        """Publish ``payload`` to everyone in a room.
+
+        Known rooms get a single publish to the room group (only if this
+        user is a participant); other room ids fall back to the per-user
+        groups in ``fallback_users``. Returns False if nothing was sent.
+        """
+        members = await aget_room_members(room_id)
+        if members is not None:
+            if self.username not in members:
+                return False
+            await self.send_group(room_group_name(room_id), payload, key=key)
+            return True
+
+        users = [user for user in dict.fromkeys(fallback_users) if user]
+        frames = encode_frames(payload)
+        for user in users:
+            await self.send_group(user, payload, frames, key)
+        return bool(users)
+
+    async def subscribe_room(self, room_id):
+        if room_id in self.rooms:
+            return
+        self.rooms.add(room_id)
+        await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        if metrics.enabled:
+            metrics.ROOM_SUBSCRIPTIONS.inc()
+
+    async def subscribe_rooms(self, room_ids):
+        """Join several room groups, ``ROOM_SUBSCRIBE_CONCURRENCY`` at a time."""
+        room_ids = [
+            room_id for room_id in dict.fromkeys(room_ids) if room_id not in self.rooms
+        ]
+        for start in range(0, len(room_ids), ROOM_SUBSCRIBE_CONCURRENCY):
+            batch = room_ids[start : start + ROOM_SUBSCRIBE_CONCURRENCY]
+            self.rooms.update(batch)
+            await asyncio.gather(
+                *(
+                    self.channel_layer.group_add(
+                        room_group_name(room_id), self.channel_name
+                    )
+                    for room_id in batch
+                )
+            )
+            if metrics.enabled:
+                metrics.ROOM_SUBSCRIPTIONS.inc(amount=len(batch))
+
+    async def unsubscribe_room(self, room_id):
+        if room_id not in self.rooms:
+            return
+        self.rooms.discard(room_id)
+        await self.channel_layer.group_discard(
+            room_group_name(room_id), self.channel_name
+        )
+        if metrics.enabled:
+            metrics.ROOM_SUBSCRIPTIONS.dec()
+
+    async def room_created(self, event):
+        """Join a room created after this socket connected (see RoomCreateView)."""
+        room_members_cache.invalidate(event["room_id"])
+        await self.subscribe_room(event["room_id"])
+
+    async def send_payload(self, payload, key=None):
+        """Encode ``payload`` with the negotiated codec and send it."""
+        await self.queue_frame(self.codec.encode(payload), key)
+
+    async def send_frame(self, frames, key=None):
+        """Send the pre-encoded frame matching this socket's codec."""
+        await self.queue_frame(frames[self.codec.subprotocol], key)
+
+    async def queue_frame(self, frame, key=None):
+        """Hand an encoded frame to the outbound queue (or the socket, before
+        the queue exists)."""
+        if self.outbound is not None:
+            self.outbound.put(frame, key)
+        elif isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def broadcast_group(self, event):
+        """Handle messages sent to groups."""
+        frames = event.get("frames")
+        if frames is None:
+            # Plain payload from a publisher that does not pre-encode.
+            event.pop("type", None)
+            await self.send_payload(event)
+            return
+        await self.send_frame(frames, event.get("key"))
+
+    async def send_error(self, error_type, message, key=None, **details):
+        """Send error message to client; ``details`` are added to the error."""
+        await self.send_payload(
+            {
+                "source": "error",
+                "error": {"type": error_type, "message": message, **details},
+            },
+            key,
+        )
+
+    async def send_pending_messages(self):
+        """Stream undelivered messages to the user in ``message.batch`` frames.
+
+        Runs as a background task started from connect(), so a large backlog
+        never delays the handshake. The client confirms each chunk with
+        ``message.ack``; with REQUIRE_DELIVERY_ACK off, each chunk is instead
+        marked delivered with a single update_many once its frame has been
+        handed to the socket. Awaiting the send before reading the next
+        chunk keeps a slow client from buffering the whole backlog in memory.
+        """
+        if not hasattr(self, "username"):
+            return
+
+        batch_size = chat_setting("PENDING_BATCH_SIZE")
+        repository = get_async_message_repository()
+        pending_messages = (
+            repository.find({"receiver": self.username, "delivered": False})
+            .sort("timestamp", 1)
+            .batch_size(batch_size)
+        )
+
+        try:
+            batch = []
+            backlog = 0
+            async for msg in pending_messages:
+                if len(batch) >= batch_size:
+                    if not await self.deliver_pending_batch(batch, has_more=True):
+                        return
+                    batch = []
+                batch.append(msg)
+                backlog += 1
+            await self.deliver_pending_batch(batch, has_more=False)
+            if metrics.enabled:
+                metrics.PENDING_BACKLOG.observe(backlog)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Pending delivery error: {str(e)}")
+
+    async def deliver_pending_batch(self, batch, has_more):
+        """Send one ``message.batch`` frame of undelivered messages.
+
+        Returns False if the client overflowed its outbound queue; the frame
+        may then never have been written, so nothing is marked delivered.
+        """
+        if not batch:
+            return True
+
+        require_ack = chat_setting("REQUIRE_DELIVERY_ACK")
+        messages = []
+        for msg in batch:
+            message_data = message_summary(msg)
+            message_data["delivered"] = not require_ack
+            messages.append(message_data)
+
+        await self.send_payload(
+            {
+                "source": "message.batch",
+                "data": {"messages": messages, "has_more": has_more},
+            }
+        )
+        # Don't read the next batch until this one has left the socket.
+        await self.outbound.drain()
+        if self.outbound.overflowed:
+            return False
+
+        if require_ack:
+            return True
+
+        # Update delivery status
+        await get_async_messages_collection().update_many(
+            {"_id": {"$in": [msg["_id"] for msg in batch]}},
+            {"$set": {"delivered": True}},
+        )
+        return True
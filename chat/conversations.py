@@ -0,0 +1,234 @@
+# chat/conversations.py
+"""Per-(user, room) conversation summaries.
+
+The ``conversations`` collection holds one document per participant and
+room::
+
+    {"username": ..., "room_id": ..., "last_message": {...},
+     "unread_count": ..., "updated_at": ...}
+
+It is denormalised from ``messages`` and kept current incrementally by the
+send, read, edit and delete paths, so listing a user's conversations is a
+single keyset query on ``(username, updated_at, _id)`` instead of one
+message scan per room. Each write helper comes in a sync flavour for the
+REST views and an ``a``-prefixed one for the consumer.
+"""
+from pymongo import UpdateOne
+from chat.conf import chat_setting
+from chat.mongo_utils import (
+    get_async_conversations_collection,
+    get_async_read_states_collection,
+    get_conversations_collection,
+)
+from chat.pagination import build_page, clamp_page_size, keyset_query
+from chat.receipts import covers_message
+from chat.repository import get_async_message_repository
+from chat.rooms import aget_room_members
+
+PROJECTION = {"room_id": 1, "last_message": 1, "unread_count": 1, "updated_at": 1}
+
+
+def message_preview(message_doc):
+    """The ``last_message`` stored for ``message_doc``."""
+    text = message_doc.get("message") or ""
+    return {
+        "message_id": message_doc["_id"],
+        "sender": message_doc["sender"],
+        "preview": text[: chat_setting("CONVERSATION_PREVIEW_LENGTH")],
+        "timestamp": message_doc["timestamp"],
+        "has_file": bool(message_doc.get("file")),
+        "edited": message_doc.get("edited", False),
+    }
+
+
+def conversation_summary(doc):
+    """Client representation of a conversations document."""
+    last_message = doc.get("last_message")
+    if last_message:
+        last_message = dict(
+            last_message,
+            message_id=str(last_message["message_id"]),
+            timestamp=last_message["timestamp"].isoformat(),
+        )
+    return {
+        "room_id": doc["room_id"],
+        "last_message": last_message,
+        "unread_count": doc.get("unread_count", 0),
+        "updated_at": doc["updated_at"].isoformat(),
+    }
+
+
+def _message_updates(participants, message_doc):
+    last_message = message_preview(message_doc)
+    return [
+        UpdateOne(
+            {"username": username, "room_id": message_doc["room_id"]},
+            {
+                "$set": {
+                    "last_message": last_message,
+                    "updated_at": message_doc["timestamp"],
+                },
+                "$inc": {"unread_count": 0 if username == message_doc["sender"] else 1},
+            },
+            upsert=True,
+        )
+        for username in participants
+        if username
+    ]
+
+
+def _decrement(count):
+    # Pipeline update so concurrent receipts can never push it below zero.
+    return [
+        {
+            "$set": {
+                "unread_count": {
+                    "$max": [
+                        0,
+                        {"$subtract": [{"$ifNull": ["$unread_count", 0]}, count]},
+                    ]
+                }
+            }
+        }
+    ]
+
+
+def record_message(participants, message_doc):
+    """Bump every participant's summary for a newly inserted message."""
+    updates = _message_updates(participants, message_doc)
+    if updates:
+        get_conversations_collection().bulk_write(updates, ordered=False)
+
+
+async def arecord_message(participants, message_doc):
+    updates = _message_updates(participants, message_doc)
+    if updates:
+        await get_async_conversations_collection().bulk_write(updates, ordered=False)
+
+
+async def amark_read(username, counts):
+    """Lower unread counts; ``counts`` maps room_id to messages just read."""
+    updates = [
+        UpdateOne({"username": username, "room_id": room_id}, _decrement(count))
+        for room_id, count in counts.items()
+        if count
+    ]
+    if updates:
+        await get_async_conversations_collection().bulk_write(updates, ordered=False)
+
+
+async def aset_unread(username, room_id, count):
+    await get_async_conversations_collection().update_one(
+        {"username": username, "room_id": room_id},
+        {"$set": {"unread_count": count}},
+    )
+
+
+async def arecord_edit(message_doc):
+    """Refresh the preview wherever ``message_doc`` is the last message."""
+    await get_async_conversations_collection().update_many(
+        {
+            "room_id": message_doc["room_id"],
+            "last_message.message_id": message_doc["_id"],
+        },
+        {
+            "$set": {
+                "last_message.preview": message_doc["message"][
+                    : chat_setting("CONVERSATION_PREVIEW_LENGTH")
+                ],
+                "last_message.edited": True,
+            }
+        },
+    )
+
+
+async def arecord_delete(message_doc):
+    """Account for a deleted message (summary projection).
+
+    Participants who had not read it lose one unread message, and
+    summaries showing it as the last message fall back to the newest
+    remaining message of the room.
+    """
+    collection = get_async_conversations_collection()
+    room_id = message_doc["room_id"]
+
+    if message_doc.get("receiver"):
+        unread_by = [] if message_doc.get("is_read") else [message_doc["receiver"]]
+    else:
+        # Group rooms track reads with the per-room watermark.
+        members = (await aget_room_members(room_id) or frozenset()) - {
+            message_doc["sender"]
+        }
+        watermarks = {
+            state["username"]: state.get("read_up_to")
+            async for state in get_async_read_states_collection().find(
+                {"room_id": room_id, "username": {"$in": list(members)}},
+                {"username": 1, "read_up_to": 1},
+            )
+        }
+        unread_by = [
+            username
+            for username in members
+            if not covers_message(watermarks.get(username), message_doc)
+        ]
+    if unread_by:
+        await collection.bulk_write(
+            [
+                UpdateOne({"username": username, "room_id": room_id}, _decrement(1))
+                for username in unread_by
+            ],
+            ordered=False,
+        )
+
+    repository = get_async_message_repository()
+    latest = await repository.collection.find_one(
+        {"room_id": room_id},
+        {"sender": 1, "message": 1, "timestamp": 1, "file.file_id": 1, "edited": 1},
+        sort=[("timestamp", -1), ("_id", -1)],
+    )
+    await collection.update_many(
+        {"room_id": room_id, "last_message.message_id": message_doc["_id"]},
+        {"$set": {"last_message": message_preview(latest) if latest else None}},
+    )
+
+
+def _page_query(username, before, page_size):
+    page_size = clamp_page_size(page_size)
+    query, sort = keyset_query(
+        {"username": username}, before=before, field="updated_at"
+    )
+    return query, sort, page_size
+
+
+def _page(docs, page_size, sort):
+    docs, has_more, cursors = build_page(docs, page_size, sort, chronological=False)
+    return {
+        "conversations": [conversation_summary(doc) for doc in docs],
+        "page_size": page_size,
+        "has_more": has_more,
+        "cursors": {"before": cursors["before"]},
+    }
+
+
+def get_conversations(username, before=None, page_size=None):
+    """Most recently active conversations first; raises ValueError for a
+    bad ``before`` cursor."""
+    query, sort, page_size = _page_query(username, before, page_size)
+    cursor = (
+        get_conversations_collection()
+        .find(query, PROJECTION)
+        .sort(sort)
+        .limit(page_size + 1)
+    )
+    return _page(list(cursor), page_size, sort)
+
+
+async def aget_conversations(username, before=None, page_size=None):
+    query, sort, page_size = _page_query(username, before, page_size)
+    cursor = (
+        get_async_conversations_collection()
+        .find(query, PROJECTION)
+        .sort(sort)
+        .limit(page_size + 1)
+    )
+    return _page(await cursor.to_list(length=page_size + 1), page_size, sort)
@@ -0,0 +1,168 @@
+# chat/directory.py
+"""Paginated, searchable user directory shared by user.list and /api/users/.
+
+Pages are keyset-paginated on the (unique) username and searched by prefix
+on username, first name or last name through ``LOWER(...)`` range
+conditions, which the functional indexes declared on ``User`` can serve.
+Rendered pages are cached under a directory-wide version number that is
+bumped whenever a user is created or deleted or one of ``TRACKED_FIELDS``
+changes (see chat.signals), so stale pages are never served after such a
+change and never need to be deleted one by one. Saves that touch nothing
+else, such as logins, leave the cache alone.
+"""
+import base64
+import hashlib
+import logging
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY_FIELDS = (
+    "id",
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "is_online",
+    "last_seen",
+    "profile_picture",
+)
+DEFAULT_FIELDS = ("id", "username", "email", "first_name", "last_name")
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+CACHE_TIMEOUT = 60
+VERSION_KEY = "user_directory:version"
+# Fields whose changes invalidate cached pages. last_seen is left out: its
+# auto_now touches it on every save, and pages expire after CACHE_TIMEOUT.
+TRACKED_FIELDS = (
+    "is_active",
+    "username",
+    "email",
+    "first_name",
+    "last_name",
+    "is_online",
+    "profile_picture",
+)
+
+
+def parse_fields(value):
+    """Validate a ``fields`` list or comma separated string; raises ValueError."""
+    if not value:
+        return DEFAULT_FIELDS
+    if isinstance(value, str):
+        value = value.split(",")
+    fields = tuple(field.strip() for field in value if field.strip())
+    unknown = set(fields) - set(DIRECTORY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def _encode_cursor(username):
+    return base64.urlsafe_b64encode(username.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(token):
+    try:
+        return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except (TypeError, ValueError):
+        raise ValueError("Invalid pagination cursor")
+
+
+def directory_state(user):
+    """The values of ``TRACKED_FIELDS`` loaded on a User instance."""
+    return tuple(str(user.__dict__.get(name)) for name in TRACKED_FIELDS)
+
+
+def get_directory_version():
+    return cache.get_or_set(VERSION_KEY, 1, timeout=None)
+
+
+def invalidate_directory():
+    """Bump the directory version; never raises, so user saves do not fail
+    when the cache is unreachable (pages then expire after CACHE_TIMEOUT)."""
+    try:
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, timeout=None)
+    except Exception as e:
+        logger.error(f"Directory invalidation failed: {str(e)}")
+
+
+def _prefix_filter(search):
+    prefix = search.lower()
+    # Range form of LIKE 'prefix%' so an index on LOWER(col) can be used.
+    upper = prefix + "\uffff"
+    return (
+        Q(username_lower__gte=prefix, username_lower__lt=upper)
+        | Q(first_name_lower__gte=prefix, first_name_lower__lt=upper)
+        | Q(last_name_lower__gte=prefix, last_name_lower__lt=upper)
+    )
+
+
+def _query_page(search, after, limit, fields):
+    users = User.objects.filter(is_active=True)
+    if search:
+        users = users.alias(
+            username_lower=Lower("username"),
+            first_name_lower=Lower("first_name"),
+            last_name_lower=Lower("last_name"),
+        ).filter(_prefix_filter(search))
+    if after:
+        users = users.filter(username__gt=_decode_cursor(after))
+
+    columns = set(fields) | {"username"}
+    rows = list(users.order_by("username").values(*columns)[: limit + 1])
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = [
+        {
+            field: value.isoformat() if isinstance(value, datetime) else value
+            for field, value in row.items()
+            if field in fields or field == "username"
+        }
+        for row in rows
+    ]
+    return {
+        "results": results,
+        "next": _encode_cursor(rows[-1]["username"]) if has_more else None,
+    }
+
+
+def get_directory_page(search=None, after=None, limit=None, fields=DEFAULT_FIELDS,
+                       exclude_username=None):
+    """One page of active users ordered by username.
+
+    ``exclude_username`` is dropped after the cache lookup so every caller
+    shares the same cached pages.
+    """
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    search = (search or "").strip()
+
+    key_material = f"{search}|{after or ''}|{limit}|{','.join(fields)}"
+    cache_key = (
+        f"user_directory:{get_directory_version()}:"
+        f"{hashlib.sha1(key_material.encode()).hexdigest()}"
+    )
+    page = cache.get(cache_key)
+    if page is None:
+        page = _query_page(search, after, limit, fields)
+        cache.set(cache_key, page, timeout=CACHE_TIMEOUT)
+
+    if exclude_username:
+        page = {
+            **page,
+            "results": [
+                user for user in page["results"]
+                if user["username"] != exclude_username
+            ],
+        }
+    return page
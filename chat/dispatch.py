@@ -0,0 +1,206 @@
+# chat/dispatch.py
+"""Handler registry and frame schemas for the WebSocket consumer.
+
+Handlers are declared with ``@handles(source, **fields)``. Classes using
+``HandlerRegistryMixin`` collect them into ``handlers`` once, when the
+class is created, so each frame is routed with a single dict lookup. The
+frame's ``data`` is checked against the handler's schema before the handler
+runs; all problems found are reported together in a ``ValidationError``.
+
+Fields that are absent or null are skipped unless ``required``; fields a
+schema does not declare are left alone.
+"""
+import re
+
+# Errors reported per frame; the rest are dropped.
+MAX_ERRORS = 10
+
+_OBJECT_ID = re.compile(r"\A[0-9a-fA-F]{24}\Z")
+
+_TYPE_NAMES = {
+    str: "a string",
+    bytes: "bytes",
+    int: "an integer",
+    float: "a number",
+    bool: "a boolean",
+    list: "a list",
+    dict: "an object",
+}
+
+
+class ValidationError(ValueError):
+    """Invalid frame data; ``errors`` holds one ``{field, code, message}``
+    dict per problem."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(error["message"] for error in errors))
+
+
+def _error(field, code, message):
+    return {"field": field, "code": code, "message": message}
+
+
+class Field:
+    """Constraints on one value of a frame's ``data``.
+
+    ``types`` are the accepted Python types (bool is never taken for int);
+    ``min_length``/``max_length`` bound ``len()`` of strings, bytes and
+    lists; ``object_id`` requires a 24-digit hex id; ``items`` is a Field
+    applied to each element of a list; ``parse`` converts the checked value
+    (raising ValueError when it cannot), and its result replaces the value
+    in ``data``.
+    """
+
+    def __init__(
+        self,
+        *types,
+        required=False,
+        min_length=None,
+        max_length=None,
+        object_id=False,
+        items=None,
+        parse=None,
+    ):
+        self.types = types
+        self.required = required
+        self.min_length = min_length
+        self.max_length = max_length
+        self.object_id = object_id
+        self.items = items
+        self.parse = parse
+        self.exclude_bool = int in types and bool not in types
+        self.type_message = " or ".join(_TYPE_NAMES[t] for t in types)
+
+    def check(self, name, value, errors):
+        """Append any problems with ``value`` to ``errors``; returns the value
+        to keep (parsed, if the field has a ``parse``)."""
+        if not isinstance(value, self.types) or (
+            self.exclude_bool and isinstance(value, bool)
+        ):
+            errors.append(_error(name, "type", f"{name} must be {self.type_message}"))
+            return value
+        if self.min_length is not None and len(value) < self.min_length:
+            errors.append(
+                _error(
+                    name,
+                    "min_length",
+                    (
+                        f"{name} must not be empty"
+                        if self.min_length == 1
+                        else f"{name} is too short ({len(value)} < {self.min_length})"
+                    ),
+                )
+            )
+            return value
+        if self.max_length is not None and len(value) > self.max_length:
+            errors.append(
+                _error(
+                    name,
+                    "max_length",
+                    f"{name} is too long ({len(value)} > {self.max_length})",
+                )
+            )
+            return value
+        if self.object_id and not _OBJECT_ID.match(value):
+            errors.append(_error(name, "object_id", f"{name} is not a valid id"))
+            return value
+        if self.items is not None and isinstance(value, list):
+            items = []
+            for index, item in enumerate(value):
+                items.append(self.items.check(f"{name}[{index}]", item, errors))
+                if len(errors) >= MAX_ERRORS:
+                    return value
+            if self.items.parse is not None:
+                value = items
+        if self.parse is not None:
+            try:
+                return self.parse(value)
+            except ValueError:
+                errors.append(_error(name, "invalid", f"{name} is not valid"))
+        return value
+
+
+class Schema:
+    """The fields of a frame's ``data``, checked in declaration order."""
+
+    def __init__(self, fields):
+        self.fields = tuple(fields.items())
+
+    def validate(self, data):
+        """Return ``data`` (``{}`` if absent) or raise ValidationError."""
+        if data is None:
+            data = {}
+        elif not isinstance(data, dict):
+            raise ValidationError([_error("data", "type", "data must be an object")])
+
+        errors = []
+        for name, field in self.fields:
+            value = data.get(name)
+            if value is None:
+                if field.required:
+                    errors.append(_error(name, "required", f"{name} is required"))
+            else:
+                data[name] = field.check(name, value, errors)
+        if errors:
+            raise ValidationError(errors[:MAX_ERRORS])
+        return data
+
+
+def handles(source, **fields):
+    """Register the decorated method as the handler for ``source`` frames,
+    with ``fields`` (name -> Field) as the schema of their ``data``."""
+
+    def decorator(method):
+        method.handles = (source, Schema(fields))
+        return method
+
+    return decorator
+
+
+class Handler:
+    __slots__ = ("source", "method", "schema")
+
+    def __init__(self, source, method, schema):
+        self.source = source
+        self.method = method
+        self.schema = schema
+
+
+class HandlerRegistry(dict):
+    """source -> Handler."""
+
+    def resolve(self, frame):
+        """The Handler for a decoded frame; raises ValueError if there is none."""
+        if not isinstance(frame, dict):
+            raise ValueError("Frame must be an object")
+        source = frame.get("source")
+        if not source:
+            raise ValueError("Missing message source")
+        handler = self.get(source) if isinstance(source, str) else None
+        if handler is None:
+            raise ValueError(f"Unknown message source: {source}")
+        return handler
+
+
+class HandlerRegistryMixin:
+    """Builds ``handlers`` from the ``@handles`` methods of each subclass.
+
+    A subclass overriding a handler without repeating the decorator keeps
+    the inherited source and schema.
+    """
+
+    handlers = HandlerRegistry()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        declared = {}
+        for klass in reversed(cls.__mro__):
+            for name, attribute in vars(klass).items():
+                spec = getattr(attribute, "handles", None)
+                if spec is not None:
+                    declared[name] = spec
+        cls.handlers = HandlerRegistry(
+            (source, Handler(source, getattr(cls, name), schema))
+            for name, (source, schema) in declared.items()
+        )
@@ -0,0 +1,84 @@
+# chat/export.py
+"""Streaming NDJSON export of a room's history.
+
+Messages are read with a single ascending ``(timestamp, _id)`` cursor that
+fetches ``EXPORT_BATCH_SIZE`` documents per round trip and are written out
+one JSON object per line, so memory stays flat however long the range is.
+The chunks come from an async generator over the async client's cursor:
+under ASGI, Django would otherwise have to read a sync iterator to the end
+in a worker thread before sending the first byte. Every line carries a ``cursor``: passing the last one received as ``after``
+resumes an interrupted export right after that message.
+"""
+import base64
+import json
+import zlib
+from datetime import datetime
+from bson import ObjectId
+from chat.conf import chat_setting
+from chat.pagination import encode_cursor, keyset_query
+from chat.repository import get_async_message_repository
+
+# Bytes of output gathered before a chunk is handed to the response.
+CHUNK_SIZE = 64 * 1024
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+
+def export_line(doc):
+    """One NDJSON line (bytes, newline included) for a message document."""
+    cursor = encode_cursor(doc)
+    record = {"message_id": doc.pop("_id"), **doc, "cursor": cursor}
+    return (json.dumps(record, default=_json_default) + "\n").encode()
+
+
+def iter_export(query, after=None):
+    """Async iterator of NDJSON chunks for every message matching ``query``.
+
+    ``after`` is a cursor from a previous export; raises ValueError (before
+    anything is read) if it is malformed.
+    """
+    query, sort = keyset_query(query, after=after, newest_first=False)
+    return _iter_chunks(query, sort)
+
+
+async def _iter_chunks(query, sort):
+    # The cursor is created here, on the event loop the response is
+    # streamed from, since the async client binds to its loop.
+    cursor = (
+        get_async_message_repository()
+        .find(query, "full")
+        .sort(sort)
+        .batch_size(chat_setting("EXPORT_BATCH_SIZE"))
+    )
+    buffer = []
+    size = 0
+    try:
+        async for doc in cursor:
+            line = export_line(doc)
+            buffer.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        await cursor.close()
+
+
+async def gzip_chunks(chunks):
+    """Compress an async iterable of byte chunks into a single gzip stream."""
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
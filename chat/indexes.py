@@ -0,0 +1,214 @@
+# chat/indexes.py
+"""Index declarations for the Mongo collections used by the chat app.
+
+Every query shape issued by chat.consumers and chat.views should be backed
+by one of the indexes below. ``ensure_indexes()`` creates them idempotently
+and ``check_query_shapes()`` asks the server, via ``explain()``, whether any
+shape still falls back to a collection scan.
+"""
+import logging
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from chat.mongo_utils import get_mongodb_connection
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    'messages': [
+        # message.list and /api/messages/history/: equality on room_id,
+        # range/sort on timestamp with _id as the keyset tie-breaker.
+        IndexModel(
+            [('room_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)],
+            name='room_timestamp_id',
+        ),
+        # send_pending_messages: only undelivered messages are indexed, so
+        # the index stays small however large the delivered history grows.
+        IndexModel(
+            [('receiver', ASCENDING), ('timestamp', ASCENDING)],
+            name='pending_by_receiver',
+            partialFilterExpression={'delivered': False},
+        ),
+        # Attachment download permission check.
+        IndexModel(
+            [('file.file_id', ASCENDING)],
+            name='file_id',
+            partialFilterExpression={'file.file_id': {'$exists': True}},
+        ),
+        # message.search and /api/messages/search/ (chat.search). No
+        # stemming, so matches line up with the returned highlights.
+        IndexModel(
+            [('message', TEXT)],
+            name='message_text',
+            default_language='none',
+        ),
+    ],
+    'rooms': [
+        # RoomCreateView duplicate-room lookup ($all on participants).
+        IndexModel([('participants', ASCENDING)], name='participants'),
+    ],
+    'read_states': [
+        # One read watermark per (user, room); see chat.receipts.
+        IndexModel(
+            [('username', ASCENDING), ('room_id', ASCENDING)],
+            name='username_room_id',
+            unique=True,
+        ),
+    ],
+    'conversations': [
+        # Incremental upserts from chat.conversations.
+        IndexModel(
+            [('username', ASCENDING), ('room_id', ASCENDING)],
+            name='username_room_id',
+            unique=True,
+        ),
+        # conversation.list and /api/conversations/: keyset on updated_at.
+        IndexModel(
+            [('username', ASCENDING), ('updated_at', DESCENDING), ('_id', DESCENDING)],
+            name='username_updated_at_id',
+        ),
+        # Edit/delete refreshes of the last message preview.
+        IndexModel(
+            [('room_id', ASCENDING), ('last_message.message_id', ASCENDING)],
+            name='room_last_message',
+        ),
+    ],
+}
+
+# Representative (collection, filter, sort) shapes issued by the app.
+QUERY_SHAPES = [
+    (
+        'messages',
+        {'room_id': '', '$or': [{'sender': ''}, {'receiver': ''}]},
+        [('timestamp', DESCENDING), ('_id', DESCENDING)],
+    ),
+    (
+        'messages',
+        {'$and': [
+            {'room_id': ''},
+            {'$or': [
+                {'timestamp': {'$lt': 0}},
+                {'timestamp': 0, '_id': {'$lt': 0}},
+            ]},
+        ]},
+        [('timestamp', DESCENDING), ('_id', DESCENDING)],
+    ),
+    (
+        'messages',
+        {'room_id': '', 'timestamp': {'$gte': 0, '$lte': 0}},
+        [('timestamp', ASCENDING), ('_id', ASCENDING)],
+    ),
+    (
+        'messages',
+        {'receiver': '', 'delivered': False},
+        [('timestamp', ASCENDING)],
+    ),
+    (
+        'messages',
+        {'file.file_id': '', '$or': [{'sender': ''}, {'receiver': ''}]},
+        None,
+    ),
+    (
+        'messages',
+        {'file.file_id': ''},
+        None,
+    ),
+    (
+        'rooms',
+        {'participants': {'$all': ['', ''], '$size': 2}},
+        None,
+    ),
+    (
+        'messages',
+        {
+            'room_id': '',
+            'receiver': '',
+            'is_read': False,
+            '$or': [
+                {'timestamp': {'$lt': 0}},
+                {'timestamp': 0, '_id': {'$lte': 0}},
+            ],
+        },
+        None,
+    ),
+    (
+        'read_states',
+        {'username': '', 'room_id': {'$in': ['']}},
+        None,
+    ),
+    (
+        'read_states',
+        {'room_id': '', 'username': {'$in': ['']}},
+        None,
+    ),
+    (
+        'messages',
+        {
+            '$text': {'$search': 'x'},
+            '$or': [{'room_id': {'$in': ['']}}, {'sender': ''}, {'receiver': ''}],
+        },
+        None,
+    ),
+    (
+        'conversations',
+        {'username': ''},
+        [('updated_at', DESCENDING), ('_id', DESCENDING)],
+    ),
+    (
+        'conversations',
+        {'room_id': '', 'last_message.message_id': ''},
+        None,
+    ),
+]
+
+
+def ensure_indexes(db=None):
+    """Create any missing declared indexes; returns the names per collection.
+
+    create_indexes() is a no-op for indexes that already exist with the same
+    spec, so this is safe to run on every deploy.
+    """
+    db = db if db is not None else get_mongodb_connection()
+    created = {}
+    for collection_name, models in INDEXES.items():
+        created[collection_name] = db[collection_name].create_indexes(models)
+        logger.info(
+            f"Ensured indexes on {collection_name}: "
+            f"{', '.join(created[collection_name])}"
+        )
+    return created
+
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+def check_query_shapes(db=None):
+    """Explain each entry of QUERY_SHAPES and return the unindexed ones.
+
+    Each result is a dict with the collection, filter, sort and the stages
+    of the winning plan; an empty list means every shape uses an index.
+    """
+    db = db if db is not None else get_mongodb_connection()
+    unindexed = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        stages = list(_plan_stages(winning_plan))
+        if 'COLLSCAN' in stages:
+            unindexed.append({
+                'collection': collection_name,
+                'filter': query,
+                'sort': sort,
+                'stages': stages,
+            })
+    return unindexed
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import tempfile
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import mongo_utils
+from chat.write_behind import close_write_behind
+from chat.benchmark import (
+    DEFAULT_MIX,
+    DEFAULT_REST_MIX,
+    BenchError,
+    compare,
+    mongomock_clients,
+    parse_mix,
+    run_benchmark,
+)
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / "benchmarks" / "baseline.json"
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate concurrent WebSocket and REST clients in-process and report "
+        "p50/p95/p99 latency, throughput and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument(
+            "--ops", type=int, default=40, help="Operations per client."
+        )
+        parser.add_argument(
+            "--mix",
+            default="",
+            help="WebSocket mix, e.g. send=50,list=20,read=20,type=10.",
+        )
+        parser.add_argument("--rest-requests", type=int, default=500)
+        parser.add_argument("--rest-concurrency", type=int, default=10)
+        parser.add_argument(
+            "--rest-mix",
+            default="",
+            help="REST mix, e.g. create=40,history=30,conversations=30.",
+        )
+        parser.add_argument(
+            "--dispatch-iterations",
+            type=int,
+            default=20000,
+            help="Frames per source for the dispatch micro-benchmark; 0 skips it.",
+        )
+        parser.add_argument(
+            "--write-behind",
+            choices=["off", "flushed", "buffered"],
+            default="off",
+            help="Batch message inserts, with the given WRITE_BEHIND_ACK.",
+        )
+        parser.add_argument(
+            "--mongo",
+            choices=["mongomock", "local"],
+            default="mongomock",
+            help="mongomock in-process, or a scratch database on MONGODB_SETTINGS['host'].",
+        )
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="Also write the result JSON here.")
+        parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Store this run as the baseline.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="Allowed fractional p95 increase / throughput drop against the baseline.",
+        )
+        parser.add_argument(
+            "--fail-on-regression",
+            action="store_true",
+            help="Exit non-zero on a regression.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            bench_options = {
+                "ops": options["ops"],
+                "mix": parse_mix(options["mix"], DEFAULT_MIX),
+                "rest_requests": options["rest_requests"],
+                "rest_concurrency": options["rest_concurrency"],
+                "rest_mix": parse_mix(options["rest_mix"], DEFAULT_REST_MIX),
+                "dispatch_iterations": options["dispatch_iterations"],
+                "write_behind": options["write_behind"],
+                "mongo": options["mongo"],
+                "seed": options["seed"],
+            }
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        try:
+            result = self.run(options["clients"], bench_options)
+        except BenchError as e:
+            raise CommandError(str(e))
+
+        self.report(result)
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(result, indent=2) + "\n")
+
+        baseline_path = Path(options["baseline"])
+        if options["save_baseline"]:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(result, indent=2) + "\n")
+            self.stdout.write(f"Baseline written to {baseline_path}")
+            return
+        if not baseline_path.exists():
+            return
+
+        regressions = compare(
+            result, json.loads(baseline_path.read_text()), options["tolerance"]
+        )
+        for regression in regressions:
+            self.stdout.write(self.style.WARNING(f"Regression: {regression}"))
+        if not regressions:
+            self.stdout.write(
+                self.style.SUCCESS("No regressions against the baseline.")
+            )
+        elif options["fail_on_regression"]:
+            raise CommandError(
+                f"{len(regressions)} regression(s) against {baseline_path}"
+            )
+
+    def run(self, clients, bench_options):
+        chat_settings = {
+            **getattr(settings, "CHAT_SETTINGS", {}),
+            "PRESENCE_BACKEND": "local",
+            "SEARCH_BACKEND": "local",
+            # Measure raw capacity rather than the configured limits.
+            "RATE_LIMIT_BACKEND": None,
+            "WRITE_BEHIND_ENABLED": bench_options["write_behind"] != "off",
+            "WRITE_BEHIND_ACK": bench_options["write_behind"],
+            "ATTACHMENT_STORAGE": "local",
+            "ATTACHMENT_ROOT": tempfile.mkdtemp(prefix="chat-bench-"),
+        }
+        mongo_settings = {
+            **settings.MONGODB_SETTINGS,
+            "db": f"{settings.MONGODB_SETTINGS['db']}_bench",
+        }
+        overrides = override_settings(
+            CHANNEL_LAYERS={
+                "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+            },
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            },
+            CHAT_SETTINGS=chat_settings,
+            MONGODB_SETTINGS=mongo_settings,
+            # Build the scratch SQL schema from the models rather than the
+            # migration history.
+            MIGRATION_MODULES={"chat": None},
+        )
+
+        with overrides:
+            old_config = setup_databases(
+                verbosity=0, interactive=False, aliases={"default"}
+            )
+            try:
+                users = self.create_users(clients)
+                from chat_project.asgi import application
+
+                if bench_options["mongo"] == "mongomock":
+                    with mongomock_clients():
+                        try:
+                            return asyncio.run(
+                                run_benchmark(application, users, bench_options)
+                            )
+                        finally:
+                            close_write_behind()
+                try:
+                    return asyncio.run(run_benchmark(application, users, bench_options))
+                finally:
+                    close_write_behind()
+                    mongo_utils.get_mongo_client().drop_database(mongo_settings["db"])
+                    mongo_utils.close_mongodb_connections()
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+    def create_users(self, count):
+        User = get_user_model()
+        User.objects.bulk_create(
+            User(username=f"bench{index}", password="!") for index in range(count)
+        )
+        return [
+            (user.username, str(AccessToken.for_user(user)))
+            for user in User.objects.filter(username__startswith="bench").order_by("id")
+        ]
+
+    def report(self, result):
+        meta = result["meta"]
+        self.stdout.write(
+            f"{meta['clients']} clients x {meta['ops_per_client']} ops, "
+            f"mongo={meta['mongo']}, seed={meta['seed']}"
+        )
+        for section in ("websocket", "rest"):
+            if section not in result:
+                continue
+            self.stdout.write(
+                f"\n{section:<14} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+            )
+            for name, stats in result[section]["ops"].items():
+                if not stats["count"]:
+                    continue
+                self.stdout.write(
+                    f"{name:<14} {stats['count']:>7} {stats['p50_ms']:>9.2f} "
+                    f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+                )
+            summary = {
+                key: value
+                for key, value in result[section].items()
+                if key not in ("ops", "error_samples")
+            }
+            self.stdout.write(
+                "  ".join(f"{key}={value}" for key, value in summary.items())
+            )
+            for sample in result[section]["error_samples"]:
+                self.stdout.write(self.style.WARNING(f"  error: {sample}"))
+
+        if "dispatch" in result:
+            self.stdout.write(f"\n{'dispatch':<14} {'us/frame':>9}")
+            for source, stats in result["dispatch"]["frames"].items():
+                self.stdout.write(f"{source:<14} {stats['us_per_frame']:>9.2f}")
@@ -0,0 +1,74 @@
+import base64
+import os
+import time
+from django.core.management.base import BaseCommand
+from chat.protocol import JSON, MSGPACK
+
+
+def _message(index):
+    return {
+        "message_id": f"{index:024x}",
+        "room_id": "6650f1c2a9d3e4b5c6d7e8f9",
+        "sender": "alice",
+        "receiver": "bob",
+        "message": "Hey, are we still on for tomorrow? " * 2,
+        "timestamp": "2025-06-25T01:25:00.123000",
+        "status": "sent",
+        "delivered": False,
+    }
+
+
+def sample_payloads(attachment_size):
+    attachment = os.urandom(attachment_size)
+    return {
+        "message.send": {"source": "message.send", "data": _message(1)},
+        "message.batch (100)": {
+            "source": "message.batch",
+            "data": {"messages": [_message(i) for i in range(100)], "has_more": True},
+        },
+        f"inline attachment ({attachment_size // 1024} KiB)": (
+            {
+                "source": "message.send",
+                "data": {**_message(1), "file": base64.b64encode(attachment).decode()},
+            },
+            {"source": "message.send", "data": {**_message(1), "file": attachment}},
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare CPU time per frame and bytes on the wire for the JSON and MessagePack codecs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+        parser.add_argument("--attachment-size", type=int, default=64 * 1024)
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        self.stdout.write(
+            f"{'payload':<28} {'codec':<8} {'bytes':>9} {'encode us':>10} {'decode us':>10}"
+        )
+        for name, payload in sample_payloads(options["attachment_size"]).items():
+            # Attachments are base64 text for JSON but raw bytes for msgpack.
+            json_payload, msgpack_payload = (
+                payload if isinstance(payload, tuple) else (payload, payload)
+            )
+            for codec, codec_payload in ((JSON, json_payload), (MSGPACK, msgpack_payload)):
+                encoded = codec.encode(codec_payload)
+                frame = {"bytes_data": encoded} if codec.binary else {"text_data": encoded}
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    codec.encode(codec_payload)
+                encode_us = (time.perf_counter() - start) / iterations * 1e6
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    codec.decode(**frame)
+                decode_us = (time.perf_counter() - start) / iterations * 1e6
+
+                size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+                self.stdout.write(
+                    f"{name:<28} {codec.subprotocol[5:]:<8} {size:>9} "
+                    f"{encode_us:>10.2f} {decode_us:>10.2f}"
+                )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat.indexes import check_query_shapes, ensure_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the Mongo indexes declared in chat.indexes and report unindexed query shapes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check-only",
+            action="store_true",
+            help="Only run explain() on the known query shapes; do not create indexes.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["check_only"]:
+            for collection_name, names in ensure_indexes().items():
+                self.stdout.write(f"{collection_name}: {', '.join(names)}")
+
+        unindexed = check_query_shapes()
+        if not unindexed:
+            self.stdout.write(self.style.SUCCESS("All query shapes are indexed."))
+            return
+
+        for shape in unindexed:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"COLLSCAN on {shape['collection']}: filter={shape['filter']} "
+                    f"sort={shape['sort']} stages={shape['stages']}"
+                )
+            )
+        raise CommandError(f"{len(unindexed)} query shape(s) have no index.")
@@ -0,0 +1,259 @@
+# chat/metrics.py
+"""Prometheus-style metrics for the chat hot paths.
+
+A deliberately small in-process implementation of counters, gauges and
+histograms, rendered in the Prometheus text exposition format by
+``MetricsEndpoint`` (wired in front of Django in chat_project.asgi).
+
+Instrumentation is off unless ``METRICS_ENABLED`` is set. Call sites guard
+on the module-level ``enabled`` flag, so when disabled the cost is one
+attribute read per site, and the Mongo command listener is not even
+registered. Values are per process; scrape every worker.
+"""
+import hmac
+import threading
+import time
+from pymongo import monitoring
+from chat.conf import chat_setting
+
+# Set from METRICS_ENABLED by configure(), called from ChatConfig.ready().
+enabled = False
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def configure():
+    global enabled
+    enabled = bool(chat_setting("METRICS_ENABLED"))
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+    def _render_value(self, labelvalues, value):
+        labels = _format_labels(self.labelnames, labelvalues)
+        return [f"{self.name}{labels} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count.
+                state = self._values[labelvalues] = [[0] * len(self.buckets), 0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def _render_value(self, labelvalues, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labelvalues", "start")
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram(
+    "chat_handler_seconds", "Time spent in a WebSocket handler.", ["source"]
+)
+HANDLER_ERRORS = Counter(
+    "chat_handler_errors_total", "WebSocket handlers that raised.", ["source"]
+)
+RATE_LIMITED = Counter(
+    "chat_rate_limited_total", "Frames dropped by the rate limiter.", ["source"]
+)
+FRAME_BYTES = Histogram(
+    "chat_frame_bytes", "WebSocket frame sizes.", ["direction"], buckets=SIZE_BUCKETS
+)
+MONGO_SECONDS = Histogram(
+    "chat_mongo_command_seconds", "MongoDB command round trips.", ["command"]
+)
+MONGO_FAILURES = Counter(
+    "chat_mongo_command_failures_total", "Failed MongoDB commands.", ["command"]
+)
+LAYER_PUBLISH_SECONDS = Histogram(
+    "chat_layer_publish_seconds", "Channel layer group_send latency."
+)
+CONNECTIONS = Gauge("chat_connections", "Open WebSocket connections.")
+ROOM_SUBSCRIPTIONS = Gauge(
+    "chat_room_subscriptions", "Room channel groups joined by open sockets."
+)
+PENDING_BACKLOG = Histogram(
+    "chat_pending_backlog_messages",
+    "Undelivered messages streamed to a socket on connect.",
+    buckets=COUNT_BUCKETS,
+)
+WRITE_BEHIND_BATCH = Histogram(
+    "chat_write_behind_batch_documents",
+    "Messages written per write-behind insert_many.",
+    buckets=COUNT_BUCKETS,
+)
+OUTBOUND_FLUSH_FRAMES = Histogram(
+    "chat_outbound_flush_frames",
+    "Frames written per outbound queue flush.",
+    buckets=COUNT_BUCKETS,
+)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class CommandTimings(monitoring.CommandListener):
+    """Feeds MONGO_SECONDS; registered by chat.mongo_utils when enabled."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_FAILURES.inc(event.command_name)
+
+
+command_timings = CommandTimings()
+
+
+LOOPBACK_HOSTS = ("127.0.0.1", "::1")
+
+
+class MetricsEndpoint:
+    """ASGI wrapper answering ``METRICS_PATH`` itself, before Django."""
+
+    def __init__(self, application):
+        self.application = application
+        self.path = chat_setting("METRICS_PATH")
+        self.token = chat_setting("METRICS_TOKEN")
+
+    def allowed(self, scope):
+        if self.token:
+            headers = dict(scope.get("headers") or ())
+            return hmac.compare_digest(
+                headers.get(b"authorization", b""), f"Bearer {self.token}".encode()
+            )
+        client = scope.get("client") or (None, None)
+        return client[0] in LOOPBACK_HOSTS
+
+    async def __call__(self, scope, receive, send):
+        if not (enabled and scope["type"] == "http" and scope["path"] == self.path):
+            return await self.application(scope, receive, send)
+
+        if self.allowed(scope):
+            status, body = 200, render().encode()
+        else:
+            status, body = 403, b"Forbidden\n"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,25 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # 0001 recorded online_status while the model declares is_online and
+    # last_seen; bring the schema in line with the model.
+
+    dependencies = [
+        ('chat', '0002_user_directory_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='user',
+            old_name='online_status',
+            new_name='is_online',
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='last_seen',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
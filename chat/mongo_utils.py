@@ -1,20 +1,228 @@
-# chat/mongo_utils.py
-from pymongo import MongoClient
-from django.conf import settings
-
-def get_mongodb_connection():
-    client = MongoClient(settings.MONGODB_SETTINGS['host'])
-    db = client[settings.MONGODB_SETTINGS['db']]
-    return db
-
-def get_messages_collection():
-    db = get_mongodb_connection()
-    return db['messages']
-
-def get_rooms_collection():
-    db = get_mongodb_connection()
-    return db['rooms']
-
-def get_direct_messages_collection():
-    db = get_mongodb_connection()
-    return db['dm_message']
\ No newline at end of file
+# chat/mongo_utils.py
+import os
+import threading
+from pymongo import AsyncMongoClient, MongoClient, monitoring
+from django.conf import settings
+from chat import metrics
+
+# Keys in MONGODB_SETTINGS that are ours rather than MongoClient options.
+_RESERVED_KEYS = ('host', 'db')
+
+_DEFAULT_CLIENT_OPTIONS = {
+    'maxPoolSize': 100,
+    'minPoolSize': 0,
+    'maxIdleTimeMS': 60000,
+    'waitQueueTimeoutMS': 5000,
+    'serverSelectionTimeoutMS': 5000,
+}
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+_client_pid = None
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Aggregate connection pool events into counters for get_pool_stats()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pools = 0
+            self.open_connections = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.wait_time_total = 0.0
+            self.wait_time_max = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pools': self.pools,
+                'open_connections': self.open_connections,
+                'checked_out': self.checked_out,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_time_total_ms': round(self.wait_time_total * 1000, 3),
+                'wait_time_avg_ms': round(
+                    self.wait_time_total * 1000 / self.checkouts, 3
+                ) if self.checkouts else 0.0,
+                'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+            }
+
+    def pool_created(self, event):
+        with self._lock:
+            self.pools += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.pools -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_time_total += event.duration
+            self.wait_time_max = max(self.wait_time_max, event.duration)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+
+pool_stats = PoolStatsListener()
+
+
+def get_client_options():
+    """MongoClient keyword arguments built from MONGODB_SETTINGS.
+
+    Anything in MONGODB_SETTINGS besides 'host' and 'db' is passed straight
+    to the client, so pool size, timeouts and read/write concerns
+    ('readConcernLevel', 'w', 'journal', ...) are configured there.
+    """
+    options = dict(_DEFAULT_CLIENT_OPTIONS)
+    options.update(
+        (key, value) for key, value in settings.MONGODB_SETTINGS.items()
+        if key not in _RESERVED_KEYS
+    )
+    options['event_listeners'] = [pool_stats]
+    if metrics.enabled:
+        options['event_listeners'].append(metrics.command_timings)
+    return options
+
+
+def _reset_after_fork():
+    # The parent's sockets and monitor threads are not usable in the child;
+    # drop the references so the child builds its own pool on first use.
+    global _client, _async_client, _client_pid, _lock
+    _lock = threading.Lock()
+    _client = None
+    _async_client = None
+    _client_pid = None
+    pool_stats.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _check_pid():
+    # Covers fork paths that bypass register_at_fork hooks.
+    if _client_pid is not None and _client_pid != os.getpid():
+        _reset_after_fork()
+
+
+def get_mongo_client():
+    global _client, _client_pid
+    _check_pid()
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = MongoClient(
+                    settings.MONGODB_SETTINGS['host'], **get_client_options()
+                )
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_async_mongo_client():
+    global _async_client, _client_pid
+    _check_pid()
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = AsyncMongoClient(
+                    settings.MONGODB_SETTINGS['host'], **get_client_options()
+                )
+                _client_pid = os.getpid()
+    return _async_client
+
+
+def get_pool_stats():
+    """Connection pool counters for this process (shared by both clients)."""
+    return pool_stats.snapshot()
+
+
+def close_mongodb_connections():
+    global _client, _async_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        # AsyncMongoClient.close() is a coroutine; dropping the reference
+        # lets its pool be collected with the event loop.
+        _async_client = None
+
+
+def get_mongodb_connection():
+    client = get_mongo_client()
+    db = client[settings.MONGODB_SETTINGS['db']]
+    return db
+
+def get_messages_collection():
+    db = get_mongodb_connection()
+    return db['messages']
+
+def get_rooms_collection():
+    db = get_mongodb_connection()
+    return db['rooms']
+
+def get_direct_messages_collection():
+    db = get_mongodb_connection()
+    return db['dm_message']
+
+def get_conversations_collection():
+    db = get_mongodb_connection()
+    return db['conversations']
+
+# Async counterparts used by the WebSocket consumer. They share the options
+# and pool listener above; the async client binds to the running event loop
+# on first use.
+
+def get_async_mongodb_connection():
+    client = get_async_mongo_client()
+    return client[settings.MONGODB_SETTINGS['db']]
+
+def get_async_messages_collection():
+    db = get_async_mongodb_connection()
+    return db['messages']
+
+def get_async_rooms_collection():
+    db = get_async_mongodb_connection()
+    return db['rooms']
+
+def get_async_read_states_collection():
+    db = get_async_mongodb_connection()
+    return db['read_states']
+
+def get_async_conversations_collection():
+    db = get_async_mongodb_connection()
+    return db['conversations']
@@ -0,0 +1,122 @@
+# chat/outbound.py
+"""Per-connection outbound queue.
+
+Handlers never write to the socket directly; they put encoded frames on the
+connection's queue and a single writer task drains it:
+
+- frames arriving within ``window`` seconds of each other are flushed
+  together, as one ``batch`` frame when the client opted in with
+  ``?batch=1`` (see ``codec.join()``), otherwise back to back;
+- frames put with a coalescing ``key`` (typing indicators, ...) replace a
+  still-queued frame with the same key instead of queueing behind it;
+- a client that lets more than ``max_size`` frames pile up is a slow
+  consumer and is disconnected rather than buffered without bound.
+"""
+
+import asyncio
+import logging
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code sent to clients that fall too far behind.
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class OutboundQueue:
+    def __init__(self, consumer, max_size, window, batching, max_batch):
+        self.consumer = consumer
+        self.max_size = max_size
+        self.window = window
+        self.batching = batching
+        self.max_batch = max_batch
+        self.overflowed = False
+        self._close_task = None
+        self._entries = []
+        self._keyed = {}
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, frame, key=None):
+        """Queue ``frame``; returns False once the client is over its buffer."""
+        if self.overflowed:
+            return False
+
+        if key is not None and key in self._keyed:
+            # Superseded: keep the queue position, send the latest state.
+            self._keyed[key][1] = frame
+            return True
+
+        if len(self._entries) >= self.max_size:
+            # The writer may be stuck in a send to this very client, so the
+            # close is scheduled independently of it.
+            self.overflowed = True
+            self._wakeup.set()
+            self._drained.set()
+            self._close_task = asyncio.get_running_loop().create_task(
+                self._close_slow_consumer()
+            )
+            return False
+
+        entry = [key, frame]
+        self._entries.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._drained.clear()
+        self._wakeup.set()
+        return True
+
+    async def drain(self):
+        """Wait until everything queued so far has been written."""
+        await self._drained.wait()
+
+    async def run(self):
+        """Writer loop; runs for the lifetime of the connection."""
+        while True:
+            await self._wakeup.wait()
+            if self.overflowed:
+                return
+
+            if self.window:
+                await asyncio.sleep(self.window)
+
+            entries, self._entries = self._entries, []
+            self._keyed.clear()
+            self._wakeup.clear()
+
+            frames = [frame for _, frame in entries]
+            if metrics.enabled:
+                metrics.OUTBOUND_FLUSH_FRAMES.observe(len(frames))
+            if self.batching:
+                for start in range(0, len(frames), self.max_batch):
+                    chunk = frames[start : start + self.max_batch]
+                    await self._write(
+                        chunk[0] if len(chunk) == 1 else self.consumer.codec.join(chunk)
+                    )
+            else:
+                for frame in frames:
+                    await self._write(frame)
+
+            if not self._entries:
+                self._drained.set()
+
+    async def _close_slow_consumer(self):
+        logger.warning(
+            f"Closing slow consumer {getattr(self.consumer, 'username', '')}: "
+            f"more than {self.max_size} frames queued"
+        )
+        await self.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def _write(self, frame):
+        if metrics.enabled:
+            metrics.FRAME_BYTES.observe(
+                len(frame) if isinstance(frame, bytes) else len(frame.encode()), "out"
+            )
+        if isinstance(frame, bytes):
+            await self.consumer.send(bytes_data=frame)
+        else:
+            await self.consumer.send(text_data=frame)
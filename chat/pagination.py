@@ -0,0 +1,96 @@
+# chat/pagination.py
+"""Keyset pagination over the messages collection.
+
+Pages are addressed by opaque cursors encoding the ``(timestamp, _id)`` of
+the message at the page edge, so fetching a page is an index seek on
+``{room_id, timestamp, _id}`` followed by ``limit()`` -- the cost does not
+depend on how far back the page is.
+"""
+import base64
+import json
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(doc, field="timestamp"):
+    """Opaque cursor pointing at ``doc``'s position in (``field``, _id) order."""
+    timestamp = doc[field]
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    raw = json.dumps([timestamp, str(doc["_id"])])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor(); raises ValueError for malformed tokens."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        timestamp, object_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(timestamp), ObjectId(object_id)
+    except (TypeError, ValueError, InvalidId):
+        raise ValueError("Invalid pagination cursor")
+
+
+def clamp_page_size(value, default=DEFAULT_PAGE_SIZE):
+    return max(1, min(int(value or default), MAX_PAGE_SIZE))
+
+
+def keyset_query(
+    query, before=None, after=None, newest_first=True, field="timestamp"
+):
+    """Add the keyset condition for ``before``/``after`` to ``query``.
+
+    Returns ``(query, sort)``. ``before`` walks towards older messages and
+    ``after`` towards newer ones; with neither, the page starts at the
+    newest message (or the oldest when ``newest_first`` is False).
+    ``field`` names the datetime the keyset orders by.
+    """
+    if before and after:
+        raise ValueError("Pass either 'before' or 'after', not both")
+
+    if before:
+        timestamp, object_id = decode_cursor(before)
+        operator, direction = "$lt", DESCENDING
+    elif after:
+        timestamp, object_id = decode_cursor(after)
+        operator, direction = "$gt", ASCENDING
+    else:
+        direction = DESCENDING if newest_first else ASCENDING
+        return query, [(field, direction), ("_id", direction)]
+
+    keyset = {
+        "$or": [
+            {field: {operator: timestamp}},
+            {field: timestamp, "_id": {operator: object_id}},
+        ]
+    }
+    return {"$and": [query, keyset]}, [(field, direction), ("_id", direction)]
+
+
+def build_page(docs, page_size, sort, chronological=True):
+    """Trim a ``page_size + 1`` fetch into a chronological page.
+
+    Returns ``(docs, has_more, cursors)`` where ``has_more`` refers to the
+    direction of travel and ``cursors`` holds the ``before``/``after``
+    tokens for the neighbouring pages. Pass ``chronological=False`` to
+    keep the fetch order instead.
+    """
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    if chronological and sort[0][1] == DESCENDING:
+        docs.reverse()  # Return in chronological order
+
+    field = sort[0][0]
+    oldest_first = docs
+    if not chronological and sort[0][1] == DESCENDING:
+        oldest_first = docs[::-1]
+    cursors = {
+        "before": encode_cursor(oldest_first[0], field) if docs else None,
+        "after": encode_cursor(oldest_first[-1], field) if docs else None,
+    }
+    return docs, has_more, cursors
@@ -0,0 +1,174 @@
+# chat/presence.py
+"""Who is online, shared across every node serving WebSockets.
+
+Each user has a set of live connections (one per socket, keyed by channel
+name) whose entries expire unless refreshed by a heartbeat, so a node that
+dies without running disconnect() stops counting after ``PRESENCE_TTL``
+seconds. Status for any number of users is answered in a single backend
+round trip, and recent answers are kept in a short-TTL in-process cache.
+"""
+import time
+from datetime import datetime
+from chat.conf import chat_setting
+from chat.redis_utils import get_async_redis
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class BasePresence:
+    def __init__(self, ttl, read_cache_ttl):
+        self.ttl = ttl
+        self.read_cache_ttl = read_cache_ttl
+        self._read_cache = {}
+
+    async def connect(self, username, channel_name):
+        self._read_cache.pop(username, None)
+        await self._touch(username, channel_name, last_seen=True)
+
+    async def heartbeat(self, username, channel_name):
+        await self._touch(username, channel_name, last_seen=False)
+
+    async def disconnect(self, username, channel_name):
+        """Drop one connection; returns True if the user is still online elsewhere."""
+        self._read_cache.pop(username, None)
+        return await self._remove(username, channel_name)
+
+    async def get_status(self, username):
+        return (await self.get_statuses([username]))[username]
+
+    async def get_statuses(self, usernames):
+        """Map each username to ``{"status": ..., "last_seen": iso or None}``."""
+        now = time.monotonic()
+        statuses = {}
+        misses = []
+        for username in usernames:
+            cached = self._read_cache.get(username)
+            if cached and cached[0] > now:
+                statuses[username] = cached[1]
+            else:
+                misses.append(username)
+
+        if misses:
+            fetched = await self._fetch_statuses(misses)
+            expires_at = now + self.read_cache_ttl
+            for username, status in fetched.items():
+                self._read_cache[username] = (expires_at, status)
+            statuses.update(fetched)
+
+        if len(self._read_cache) > chat_setting("PRESENCE_READ_CACHE_SIZE"):
+            self._read_cache.clear()
+        return statuses
+
+    async def _touch(self, username, channel_name, last_seen):
+        raise NotImplementedError
+
+    async def _remove(self, username, channel_name):
+        raise NotImplementedError
+
+    async def _fetch_statuses(self, usernames):
+        raise NotImplementedError
+
+
+class RedisPresence(BasePresence):
+    """Connections in a sorted set per user scored by expiry time; last-seen
+    timestamps in one hash."""
+
+    key_prefix = "presence"
+
+    def _connections_key(self, username):
+        return f"{self.key_prefix}:conns:{username}"
+
+    @property
+    def _last_seen_key(self):
+        return f"{self.key_prefix}:last_seen"
+
+    async def _touch(self, username, channel_name, last_seen):
+        now = time.time()
+        key = self._connections_key(username)
+        pipe = get_async_redis().pipeline(transaction=False)
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zadd(key, {channel_name: now + self.ttl})
+        pipe.expire(key, self.ttl)
+        if last_seen:
+            pipe.hset(self._last_seen_key, username, datetime.utcnow().isoformat())
+        await pipe.execute()
+
+    async def _remove(self, username, channel_name):
+        key = self._connections_key(username)
+        pipe = get_async_redis().pipeline(transaction=False)
+        pipe.zrem(key, channel_name)
+        pipe.zcount(key, time.time(), "+inf")
+        pipe.hset(self._last_seen_key, username, datetime.utcnow().isoformat())
+        _, remaining, _ = await pipe.execute()
+        return remaining > 0
+
+    async def _fetch_statuses(self, usernames):
+        now = time.time()
+        pipe = get_async_redis().pipeline(transaction=False)
+        for username in usernames:
+            pipe.zcount(self._connections_key(username), now, "+inf")
+        pipe.hmget(self._last_seen_key, usernames)
+        *counts, last_seen = await pipe.execute()
+        return {
+            username: {
+                "status": ONLINE if count else OFFLINE,
+                "last_seen": seen,
+            }
+            for username, count, seen in zip(usernames, counts, last_seen)
+        }
+
+
+class LocalPresence(BasePresence):
+    """Single-process presence for tests and local development."""
+
+    def __init__(self, ttl, read_cache_ttl):
+        super().__init__(ttl, read_cache_ttl)
+        self._connections = {}
+        self._last_seen = {}
+
+    async def _touch(self, username, channel_name, last_seen):
+        self._connections.setdefault(username, {})[channel_name] = (
+            time.time() + self.ttl
+        )
+        if last_seen:
+            self._last_seen[username] = datetime.utcnow().isoformat()
+
+    async def _remove(self, username, channel_name):
+        connections = self._connections.get(username, {})
+        connections.pop(channel_name, None)
+        self._last_seen[username] = datetime.utcnow().isoformat()
+        now = time.time()
+        return any(expires_at > now for expires_at in connections.values())
+
+    async def _fetch_statuses(self, usernames):
+        now = time.time()
+        return {
+            username: {
+                "status": ONLINE
+                if any(
+                    expires_at > now
+                    for expires_at in self._connections.get(username, {}).values()
+                )
+                else OFFLINE,
+                "last_seen": self._last_seen.get(username),
+            }
+            for username in usernames
+        }
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        backend = (
+            LocalPresence
+            if chat_setting("PRESENCE_BACKEND") == "local"
+            else RedisPresence
+        )
+        _presence = backend(
+            chat_setting("PRESENCE_TTL"), chat_setting("PRESENCE_READ_CACHE_TTL")
+        )
+    return _presence
@@ -0,0 +1,135 @@
+# chat/protocol.py
+"""Wire codecs for the WebSocket API.
+
+The message schema is the same for every codec; only the framing differs.
+Clients pick a codec with the ``Sec-WebSocket-Protocol`` header:
+
+- ``chat.json`` (default, also used when no subprotocol is requested):
+  UTF-8 JSON text frames, attachments base64-encoded.
+- ``chat.msgpack``: MessagePack binary frames; attachments travel as raw
+  bytes.
+"""
+import json
+import re
+import msgpack
+
+# A frame whose first key is a plain "source" string, read without decoding
+# the rest (see peek_source()).
+_JSON_SOURCE = re.compile(r'\A\s*\{\s*"source"\s*:\s*"([\w.]{1,64})"')
+_JSON_SOURCE_BYTES = re.compile(_JSON_SOURCE.pattern.encode())
+
+
+class JSONCodec:
+    subprotocol = "chat.json"
+    binary = False
+    decode_errors = (json.JSONDecodeError, UnicodeDecodeError)
+    error_type = "invalid_json"
+    error_message = "Invalid JSON format"
+
+    def encode(self, payload):
+        return json.dumps(payload)
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def peek_source(self, text_data=None, bytes_data=None):
+        """The frame's ``source`` if it is the first key, else None.
+
+        Lets the consumer turn away rate-limited frames without parsing
+        them; frames it cannot read this way are checked after decoding.
+        """
+        if text_data is not None:
+            match = _JSON_SOURCE.match(text_data)
+            return match.group(1) if match else None
+        match = _JSON_SOURCE_BYTES.match(bytes_data)
+        return match.group(1).decode() if match else None
+
+    def join(self, frames):
+        """Wrap already-encoded frames in one ``batch`` frame without re-encoding."""
+        return '{"source": "batch", "data": [' + ", ".join(frames) + "]}"
+
+
+class MsgPackCodec:
+    subprotocol = "chat.msgpack"
+    binary = True
+    decode_errors = (
+        msgpack.ExtraData,
+        msgpack.FormatError,
+        msgpack.StackError,
+        ValueError,
+    )
+    error_type = "invalid_msgpack"
+    error_message = "Invalid MessagePack frame"
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Text frames on a msgpack socket are treated as JSON.
+            return json.loads(text_data)
+        return msgpack.unpackb(bytes_data, raw=False)
+
+    _SOURCE_KEY = msgpack.packb("source")
+
+    def peek_source(self, text_data=None, bytes_data=None):
+        """The frame's ``source`` if it is the first key of a fixmap, else None."""
+        if bytes_data is None:
+            return JSON.peek_source(text_data)
+        start = 1 + len(self._SOURCE_KEY)
+        if not (
+            len(bytes_data) > start
+            and 0x80 <= bytes_data[0] <= 0x8F
+            and bytes_data.startswith(self._SOURCE_KEY, 1)
+            and 0xA0 <= bytes_data[start] <= 0xBF
+        ):
+            return None
+        end = start + 1 + (bytes_data[start] & 0x1F)
+        try:
+            return bytes_data[start + 1 : end].decode()
+        except UnicodeDecodeError:
+            return None
+
+    _BATCH_PREFIX = (
+        b"\x82"  # fixmap with two entries
+        + msgpack.packb("source")
+        + msgpack.packb("batch")
+        + msgpack.packb("data")
+    )
+
+    def join(self, frames):
+        """Wrap already-encoded frames in one ``batch`` frame without re-encoding."""
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+        return self._BATCH_PREFIX + header + b"".join(frames)
+
+
+JSON = JSONCodec()
+MSGPACK = MsgPackCodec()
+CODECS = {codec.subprotocol: codec for codec in (MSGPACK, JSON)}
+
+
+def negotiate(subprotocols):
+    """Pick the codec for the client's offered subprotocols, in its order.
+
+    Returns ``(codec, subprotocol to accept or None)``.
+    """
+    for subprotocol in subprotocols or ():
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return JSON, None
+
+
+def encode_frames(payload):
+    """Encode ``payload`` once per codec, keyed by subprotocol.
+
+    Used for broadcasts: the sender pays for one encoding per codec and
+    every receiving consumer writes the matching frame as-is.
+    """
+    return {codec.subprotocol: codec.encode(payload) for codec in CODECS.values()}
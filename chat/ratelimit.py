@@ -0,0 +1,167 @@
+# chat/ratelimit.py
+"""Token-bucket rate limits for inbound WebSocket frames.
+
+Every user has one bucket per ``source`` (``message.send``, ...), refilled
+at ``rate`` tokens per second up to ``burst``; each frame takes a token.
+Limits come from ``RATE_LIMITS``; sources it does not list share the
+``'*'`` bucket, so a client cannot mint buckets with made-up sources.
+
+Two backends, chosen with ``RATE_LIMIT_BACKEND``:
+
+- ``local``: buckets held in process, per node.
+- ``redis``: buckets shared by every node through an atomic Lua script, so
+  a user's limit holds however many sockets they open. The process-local
+  buckets are still consulted first: they only count this node's frames,
+  so they are never emptier than the shared one, and a client that is
+  already over its limit is turned away without a Redis round trip. Redis
+  errors let the frame through.
+"""
+import logging
+import time
+from chat.conf import chat_setting
+from chat.redis_utils import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Bucket used for sources RATE_LIMITS does not list.
+DEFAULT_KEY = "*"
+
+# KEYS[1] bucket hash; ARGV rate, burst. Returns the seconds until a token is
+# available as a string ("0" when one was taken), since Lua numbers are
+# truncated to integers in replies.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+def take_token(bucket, rate, burst, now):
+    """Refill ``bucket`` (``[tokens, updated]``) and take one token.
+
+    Returns 0.0 on success, otherwise the seconds until a token is available.
+    """
+    tokens = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return 0.0
+    bucket[0] = tokens
+    return (1 - tokens) / rate
+
+
+class LocalRateLimiter:
+    """Buckets keyed by ``(username, source)`` in a per-process dict."""
+
+    def __init__(self, limits, max_buckets):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = {}
+
+    def limit_for(self, source):
+        """``(bucket key, (rate, burst))``, or ``(key, None)`` if unlimited."""
+        if source in self.limits:
+            return source, self.limits[source]
+        return DEFAULT_KEY, self.limits.get(DEFAULT_KEY)
+
+    def take_local(self, username, key, rate, burst):
+        now = time.monotonic()
+        bucket = self._buckets.get((username, key))
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                # A dropped bucket only errs towards letting frames through.
+                self._buckets.clear()
+            bucket = self._buckets[(username, key)] = [float(burst), now]
+        return take_token(bucket, rate, burst, now)
+
+    def refund_local(self, username, key):
+        bucket = self._buckets.get((username, key))
+        if bucket is not None:
+            bucket[0] += 1
+
+    async def hit(self, username, source):
+        """Take a token for a ``source`` frame from ``username``.
+
+        Returns 0.0 if the frame may proceed, otherwise the retry-after
+        delay in seconds.
+        """
+        key, limit = self.limit_for(source)
+        if limit is None:
+            return 0.0
+        return self.take_local(username, key, *limit)
+
+
+class RedisRateLimiter(LocalRateLimiter):
+    """Buckets shared across nodes, one Redis hash per ``(username, source)``."""
+
+    key_prefix = "ratelimit"
+
+    def __init__(self, limits, max_buckets):
+        super().__init__(limits, max_buckets)
+        self._script = None
+        self._script_client = None
+
+    def _bucket_key(self, username, key):
+        return f"{self.key_prefix}:{username}:{key}"
+
+    def _get_script(self):
+        client = get_async_redis()
+        if self._script_client is not client:
+            # The client is rebuilt after a fork; bind the script to the new one.
+            self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+            self._script_client = client
+        return self._script
+
+    async def hit(self, username, source):
+        key, limit = self.limit_for(source)
+        if limit is None:
+            return 0.0
+        retry_after = self.take_local(username, key, *limit)
+        if retry_after:
+            return retry_after
+
+        rate, burst = limit
+        try:
+            retry_after = await self._get_script()(
+                keys=[self._bucket_key(username, key)], args=[rate, burst]
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit check failed, allowing frame: {str(e)}")
+            return 0.0
+        retry_after = float(retry_after)
+        if retry_after:
+            # Local buckets only count frames that were let through, which
+            # keeps them at least as full as the shared one.
+            self.refund_local(username, key)
+        return retry_after
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """The configured limiter, or None when ``RATE_LIMIT_BACKEND`` is None."""
+    global _limiter
+    backend = chat_setting("RATE_LIMIT_BACKEND")
+    if backend is None:
+        return None
+    if _limiter is None:
+        limiter_class = LocalRateLimiter if backend == "local" else RedisRateLimiter
+        _limiter = limiter_class(
+            chat_setting("RATE_LIMITS"), chat_setting("RATE_LIMIT_CACHE_SIZE")
+        )
+    return _limiter
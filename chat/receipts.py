@@ -0,0 +1,87 @@
+# chat/receipts.py
+"""Per-room read watermarks.
+
+Besides the per-message ``is_read`` flag, each (user, room) pair keeps the
+position of the newest message the user has read in a ``read_states``
+document::
+
+    {"username": ..., "room_id": ..., "read_up_to": {"timestamp": ..., "message_id": ...}}
+
+``read_up_to`` is only ever moved forward (``$max`` compares the embedded
+document field by field, timestamp first), so a late or duplicated receipt
+cannot rewind it. Unread counts are then a single indexed count of the room's
+messages after the watermark instead of a scan over ``is_read``.
+"""
+from pymongo import ReturnDocument
+from chat.mongo_utils import (
+    get_async_messages_collection,
+    get_async_read_states_collection,
+)
+
+
+def after_watermark(watermark):
+    """Filter matching messages newer than ``watermark`` (None: all)."""
+    if not watermark:
+        return {}
+    if watermark.get("message_id") is None:
+        return {"timestamp": {"$gt": watermark["timestamp"]}}
+    return {
+        "$or": [
+            {"timestamp": {"$gt": watermark["timestamp"]}},
+            {
+                "timestamp": watermark["timestamp"],
+                "_id": {"$gt": watermark["message_id"]},
+            },
+        ]
+    }
+
+
+def up_to_watermark(timestamp, message_id=None):
+    """Filter matching messages at or before the given position."""
+    if message_id is None:
+        return {"timestamp": {"$lte": timestamp}}
+    return {
+        "$or": [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lte": message_id}},
+        ]
+    }
+
+
+async def aadvance_watermark(username, room_id, timestamp, message_id=None):
+    """Move the user's read position in ``room_id`` forward (never back).
+
+    Returns the stored watermark, which is further ahead than the one
+    passed in when a newer receipt got there first.
+    """
+    state = await get_async_read_states_collection().find_one_and_update(
+        {"username": username, "room_id": room_id},
+        {"$max": {"read_up_to": {"timestamp": timestamp, "message_id": message_id}}},
+        projection={"read_up_to": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return state["read_up_to"]
+
+
+def covers_message(watermark, message_doc):
+    """Whether ``message_doc`` is at or before ``watermark``."""
+    if not watermark:
+        return False
+    if message_doc["timestamp"] != watermark["timestamp"]:
+        return message_doc["timestamp"] < watermark["timestamp"]
+    return (
+        watermark.get("message_id") is None
+        or message_doc["_id"] <= watermark["message_id"]
+    )
+
+
+async def acount_unread(username, room_id, watermark=None, limit=None):
+    """Count messages from others in ``room_id`` after ``watermark``.
+
+    ``limit`` caps the count (clients usually render "99+").
+    """
+    query = {"room_id": room_id, "sender": {"$ne": username}}
+    query.update(after_watermark(watermark))
+    kwargs = {"limit": limit} if limit else {}
+    return await get_async_messages_collection().count_documents(query, **kwargs)
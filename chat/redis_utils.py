@@ -0,0 +1,22 @@
+# chat/redis_utils.py
+import os
+from redis import asyncio as aioredis
+from chat.conf import chat_setting
+
+_async_redis = None
+_redis_pid = None
+
+
+def get_async_redis():
+    """Process-wide asyncio Redis client for chat services (presence, ...).
+
+    Like the Mongo clients in chat.mongo_utils, it owns a connection pool
+    and is rebuilt in a forked child instead of sharing the parent's sockets.
+    """
+    global _async_redis, _redis_pid
+    if _async_redis is None or _redis_pid != os.getpid():
+        _async_redis = aioredis.Redis.from_url(
+            chat_setting('REDIS_URL'), decode_responses=True
+        )
+        _redis_pid = os.getpid()
+    return _async_redis
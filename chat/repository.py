@@ -0,0 +1,93 @@
+# chat/repository.py
+"""Central read access to the messages collection.
+
+Every read goes through a named projection so attachment payloads (legacy
+``file.data`` blobs) never leave Mongo unless a caller explicitly asks for
+them:
+
+- ``summary``: what clients render in a message list
+- ``full``: every field except binary attachment data
+- ``metadata``: routing fields only (room and participants)
+
+The same helpers serve the sync client used by the REST views and the
+async client used by the consumer: ``find()`` returns a cursor for either,
+``find_one()`` returns a document or an awaitable respectively.
+"""
+from pymongo import ReturnDocument
+from chat.mongo_utils import get_async_messages_collection, get_messages_collection
+
+PROJECTIONS = {
+    "summary": {
+        "room_id": 1,
+        "sender": 1,
+        "receiver": 1,
+        "message": 1,
+        "timestamp": 1,
+        "is_read": 1,
+        "status": 1,
+        "delivered": 1,
+        "edited": 1,
+        "edited_at": 1,
+        "file.file_id": 1,
+        "file.filename": 1,
+        "file.size": 1,
+        "file.content_type": 1,
+    },
+    "full": {"file.data": 0},
+    "metadata": {"room_id": 1, "sender": 1, "receiver": 1, "timestamp": 1},
+}
+
+
+class MessageRepository:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query, projection="summary"):
+        return self.collection.find(query, PROJECTIONS[projection])
+
+    def find_one(self, query, projection="metadata"):
+        return self.collection.find_one(query, PROJECTIONS[projection])
+
+    def find_one_and_update(self, query, update, projection="metadata"):
+        """Apply ``update`` and return the updated document (or None)."""
+        return self.collection.find_one_and_update(
+            query,
+            update,
+            projection=PROJECTIONS[projection],
+            return_document=ReturnDocument.AFTER,
+        )
+
+
+def get_message_repository():
+    return MessageRepository(get_messages_collection())
+
+
+def get_async_message_repository():
+    return MessageRepository(get_async_messages_collection())
+
+
+def message_summary(msg):
+    """Client-facing dict for a document read with the summary projection."""
+    message_data = {
+        "message_id": str(msg["_id"]),
+        "room_id": msg["room_id"],
+        "sender": msg["sender"],
+        "receiver": msg.get("receiver"),
+        "message": msg["message"],
+        "timestamp": msg["timestamp"].isoformat(),
+        "is_read": msg.get("is_read", False),
+        "status": msg.get("status"),
+        "delivered": msg.get("delivered", False),
+        "edited": msg.get("edited", False),
+        "edited_at": msg["edited_at"].isoformat() if msg.get("edited_at") else None,
+    }
+
+    if "file" in msg:
+        message_data["file"] = {
+            "file_id": msg["file"].get("file_id"),
+            "filename": msg["file"]["filename"],
+            "size": msg["file"]["size"],
+            "content_type": msg["file"]["content_type"],
+        }
+
+    return message_data
@@ -0,0 +1,130 @@
+# chat/rooms.py
+"""Room membership and channel-group naming.
+
+Rooms live in the Mongo ``rooms`` collection (see RoomCreateView). Every
+connected member's socket is subscribed to the room's channel group, so a
+room message costs a single layer publish however many members it has.
+Membership is read through a short-TTL in-process cache because it is
+checked on every room message.
+"""
+import logging
+import time
+from bson import ObjectId
+from chat.conf import chat_setting
+from chat.mongo_utils import get_async_rooms_collection, get_rooms_collection
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_id):
+    return f"chat_{room_id}"
+
+
+class RoomMembersCache:
+    """room_id -> frozenset of participants, or None for unknown rooms."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, room_id):
+        entry = self._entries.get(room_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return False, None
+        return True, entry[1]
+
+    def set(self, room_id, members):
+        if len(self._entries) >= chat_setting("ROOM_MEMBERS_CACHE_SIZE"):
+            self._entries.clear()
+        self._entries[room_id] = (
+            time.monotonic() + chat_setting("ROOM_MEMBERS_CACHE_TTL"),
+            members,
+        )
+
+    def invalidate(self, room_id):
+        self._entries.pop(room_id, None)
+
+
+room_members_cache = RoomMembersCache()
+
+
+async def aget_room_members(room_id):
+    """Participants of ``room_id``, or None if it is not a known room.
+
+    Ad-hoc room ids that were never created through /api/rooms/ are
+    unknown; callers fall back to per-user routing for those.
+    """
+    found, members = room_members_cache.get(room_id)
+    if found:
+        return members
+
+    members = None
+    if ObjectId.is_valid(room_id):
+        room = await get_async_rooms_collection().find_one(
+            {"_id": ObjectId(room_id)}, {"participants": 1}
+        )
+        if room is not None:
+            members = frozenset(room.get("participants", ()))
+
+    room_members_cache.set(room_id, members)
+    return members
+
+
+def get_room_members(room_id):
+    """Synchronous aget_room_members() for the REST views."""
+    found, members = room_members_cache.get(room_id)
+    if found:
+        return members
+
+    members = None
+    if ObjectId.is_valid(room_id):
+        room = get_rooms_collection().find_one(
+            {"_id": ObjectId(room_id)}, {"participants": 1}
+        )
+        if room is not None:
+            members = frozenset(room.get("participants", ()))
+
+    room_members_cache.set(room_id, members)
+    return members
+
+
+def _capped(username, room_ids):
+    # One extra id is fetched so hitting the cap is noticed rather than
+    # silently dropping the user's oldest rooms.
+    limit = chat_setting("MAX_ROOM_SUBSCRIPTIONS")
+    if len(room_ids) > limit:
+        logger.warning(
+            f"User {username} is in more than {limit} rooms; "
+            f"only the {limit} most recent are subscribed"
+        )
+        del room_ids[limit:]
+    return room_ids
+
+
+async def aget_user_room_ids(username, capped=True):
+    """Ids of the rooms ``username`` participates in (most recent first).
+
+    Socket subscriptions take at most MAX_ROOM_SUBSCRIPTIONS of them;
+    membership checks such as the search scope pass ``capped=False``.
+    """
+    cursor = (
+        get_async_rooms_collection()
+        .find({"participants": username}, {"_id": 1})
+        .sort("_id", -1)
+    )
+    if not capped:
+        return [str(room["_id"]) async for room in cursor]
+    cursor = cursor.limit(chat_setting("MAX_ROOM_SUBSCRIPTIONS") + 1)
+    return _capped(username, [str(room["_id"]) async for room in cursor])
+
+
+def get_user_room_ids(username, capped=True):
+    """Synchronous aget_user_room_ids() for the REST views."""
+    cursor = (
+        get_rooms_collection()
+        .find({"participants": username}, {"_id": 1})
+        .sort("_id", -1)
+    )
+    if not capped:
+        return [str(room["_id"]) for room in cursor]
+    cursor = cursor.limit(chat_setting("MAX_ROOM_SUBSCRIPTIONS") + 1)
+    return _capped(username, [str(room["_id"]) for room in cursor])
@@ -0,0 +1,319 @@
+# chat/search.py
+"""Full-text search over the messages collection.
+
+Searches are scoped to the caller's conversations -- rooms they belong to,
+plus ad-hoc room ids where they are the sender or receiver -- and can be
+narrowed by room, sender and date range. Results are ranked by relevance
+and paged with an opaque ``(score, _id)`` keyset cursor; each result carries
+``highlights``, the ``[start, end)`` offsets of matched words in its text.
+
+Two backends, chosen with ``SEARCH_BACKEND``:
+
+- ``mongo``: a ``$text`` query against the ``message_text`` index (see
+  chat.indexes). MongoDB maintains the index on every write, so the send
+  path does no search work at all.
+- ``local``: an in-process inverted index for tests and single-process
+  development, updated incrementally as messages are sent, edited and
+  deleted. It only knows about messages written by its own process.
+"""
+import base64
+import json
+import re
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+from chat.conf import chat_setting
+from chat.mongo_utils import get_async_messages_collection, get_messages_collection
+from chat.pagination import clamp_page_size
+from chat.repository import PROJECTIONS, message_summary
+from chat.rooms import aget_user_room_ids, get_user_room_ids
+
+# Cap on highlight ranges returned per message.
+MAX_HIGHLIGHTS = 20
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [word.lower() for word in _WORD.findall(text or "")]
+
+
+def query_terms(text):
+    """Words that count as matches: quotes are ignored, ``-word`` excluded."""
+    return {
+        word.lower()
+        for token in (text or "").replace('"', " ").split()
+        if not token.startswith("-")
+        for word in _WORD.findall(token)
+    }
+
+
+def highlight(text, terms):
+    """``[start, end)`` offsets of the words of ``text`` found in ``terms``."""
+    ranges = []
+    for match in _WORD.finditer(text or ""):
+        if match.group().lower() in terms:
+            ranges.append([match.start(), match.end()])
+            if len(ranges) == MAX_HIGHLIGHTS:
+                break
+    return ranges
+
+
+def encode_cursor(doc):
+    raw = json.dumps([doc["score"], str(doc["_id"])])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        score, object_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(score), ObjectId(object_id)
+    except (TypeError, ValueError, InvalidId):
+        raise ValueError("Invalid search cursor")
+
+
+class SearchScope:
+    """Which messages a search may return."""
+
+    def __init__(
+        self, username, room_ids, room_id=None, sender=None, start=None, end=None
+    ):
+        self.username = username
+        self.room_ids = frozenset(room_ids)
+        self.room_id = room_id
+        self.sender = sender
+        self.start = start
+        self.end = end
+
+    def to_query(self):
+        query = {
+            "$or": [
+                {"room_id": {"$in": list(self.room_ids)}},
+                {"sender": self.username},
+                {"receiver": self.username},
+            ]
+        }
+        if self.room_id:
+            query["room_id"] = self.room_id
+        if self.sender:
+            query["sender"] = self.sender
+        if self.start or self.end:
+            query["timestamp"] = {}
+            if self.start:
+                query["timestamp"]["$gte"] = self.start
+            if self.end:
+                query["timestamp"]["$lte"] = self.end
+        return query
+
+    def matches(self, doc):
+        if not (
+            doc["room_id"] in self.room_ids
+            or self.username in (doc["sender"], doc.get("receiver"))
+        ):
+            return False
+        if self.room_id and doc["room_id"] != self.room_id:
+            return False
+        if self.sender and doc["sender"] != self.sender:
+            return False
+        if self.start and doc["timestamp"] < self.start:
+            return False
+        if self.end and doc["timestamp"] > self.end:
+            return False
+        return True
+
+
+class MongoTextSearch:
+    """``$text`` search; the index is maintained by MongoDB on write."""
+
+    def index_message(self, message_doc):
+        pass
+
+    def update_message(self, message_id, text):
+        pass
+
+    def remove_message(self, message_id):
+        pass
+
+    def _pipeline(self, text, scope, after, limit):
+        match = scope.to_query()
+        match["$text"] = {"$search": text}
+        pipeline = [
+            {"$match": match},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+        ]
+        if after:
+            score, object_id = after
+            pipeline.append(
+                {
+                    "$match": {
+                        "$or": [
+                            {"score": {"$lt": score}},
+                            {"score": score, "_id": {"$lt": object_id}},
+                        ]
+                    }
+                }
+            )
+        pipeline += [
+            {"$sort": {"score": -1, "_id": -1}},
+            {"$limit": limit},
+            {"$project": dict(PROJECTIONS["summary"], score=1)},
+        ]
+        return pipeline
+
+    def search(self, text, scope, after, limit):
+        pipeline = self._pipeline(text, scope, after, limit)
+        return list(get_messages_collection().aggregate(pipeline))
+
+    async def asearch(self, text, scope, after, limit):
+        pipeline = self._pipeline(text, scope, after, limit)
+        cursor = await get_async_messages_collection().aggregate(pipeline)
+        return await cursor.to_list(length=limit)
+
+
+class LocalSearchIndex:
+    """In-process inverted index: word -> {message _id: term frequency}.
+
+    Scores are the summed frequencies of the query words, which is enough
+    to rank results in tests; phrases and ``-word`` exclusions are treated
+    as plain words.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def index_message(self, message_doc):
+        doc = {
+            key: message_doc.get(key)
+            for key in PROJECTIONS["summary"]
+            if "." not in key
+        }
+        doc["_id"] = message_doc["_id"]
+        if message_doc.get("file"):
+            doc["file"] = message_doc["file"]
+        with self._lock:
+            self._add(doc)
+
+    def update_message(self, message_id, text):
+        with self._lock:
+            doc = self._docs.get(message_id)
+            if doc is None:
+                return
+            self._remove(message_id)
+            self._add(dict(doc, message=text, edited=True))
+
+    def remove_message(self, message_id):
+        with self._lock:
+            self._remove(message_id)
+
+    def _add(self, doc):
+        self._docs[doc["_id"]] = doc
+        for word, count in Counter(tokenize(doc.get("message"))).items():
+            self._postings[word][doc["_id"]] = count
+
+    def _remove(self, message_id):
+        doc = self._docs.pop(message_id, None)
+        if doc is None:
+            return
+        for word in set(tokenize(doc.get("message"))):
+            postings = self._postings.get(word)
+            if postings is not None:
+                postings.pop(message_id, None)
+                if not postings:
+                    del self._postings[word]
+
+    def search(self, text, scope, after, limit):
+        scores = Counter()
+        with self._lock:
+            for word in query_terms(text):
+                for message_id, count in self._postings.get(word, {}).items():
+                    scores[message_id] += count
+            hits = [
+                dict(self._docs[message_id], score=float(score))
+                for message_id, score in scores.items()
+                if scope.matches(self._docs[message_id])
+            ]
+        if after:
+            hits = [doc for doc in hits if (doc["score"], doc["_id"]) < after]
+        hits.sort(key=lambda doc: (doc["score"], doc["_id"]), reverse=True)
+        return hits[:limit]
+
+    async def asearch(self, text, scope, after, limit):
+        return self.search(text, scope, after, limit)
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        if chat_setting("SEARCH_BACKEND") == "local":
+            _backend = LocalSearchIndex()
+        else:
+            _backend = MongoTextSearch()
+    return _backend
+
+
+def _parse(params):
+    """Validate request parameters; raises ValueError with a client message."""
+    text = (params.get("q") or "").strip()
+    if not text:
+        raise ValueError("Missing search query")
+    try:
+        start = datetime.fromisoformat(params["start"]) if params.get("start") else None
+        end = datetime.fromisoformat(params["end"]) if params.get("end") else None
+    except (TypeError, ValueError):
+        raise ValueError("start and end must be in ISO format")
+    after = decode_cursor(params["after"]) if params.get("after") else None
+    page_size = clamp_page_size(params.get("page_size"))
+    filters = {
+        "room_id": params.get("room_id"),
+        "sender": params.get("sender"),
+        "start": start,
+        "end": end,
+    }
+    return text, after, page_size, filters
+
+
+def _page(docs, text, page_size):
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    terms = query_terms(text)
+    results = []
+    for doc in docs:
+        result = message_summary(doc)
+        result["score"] = doc["score"]
+        result["highlights"] = highlight(doc.get("message"), terms)
+        results.append(result)
+    return {
+        "results": results,
+        "page_size": page_size,
+        "has_more": has_more,
+        "cursors": {"after": encode_cursor(docs[-1]) if docs else None},
+    }
+
+
+def search_messages(username, params):
+    """Run a search for ``username``; ``params`` are the request parameters
+    (``q``, ``room_id``, ``sender``, ``start``, ``end``, ``page_size``,
+    ``after``)."""
+    text, after, page_size, filters = _parse(params)
+    scope = SearchScope(
+        username, get_user_room_ids(username, capped=False), **filters
+    )
+    docs = get_search_backend().search(text, scope, after, page_size + 1)
+    return _page(docs, text, page_size)
+
+
+async def asearch_messages(username, params):
+    text, after, page_size, filters = _parse(params)
+    scope = SearchScope(
+        username, await aget_user_room_ids(username, capped=False), **filters
+    )
+    docs = await get_search_backend().asearch(text, scope, after, page_size + 1)
+    return _page(docs, text, page_size)
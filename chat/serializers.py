@@ -23,6 +23,8 @@ class UserSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.Serializer):
     room_id = serializers.CharField()
     message = serializers.CharField()
+    file_id = serializers.CharField(required=False)
+    receiver = serializers.CharField(required=False)
     # sender = serializers.CharField()
 
 class RoomSerializer(serializers.Serializer):
@@ -0,0 +1,39 @@
+# chat/signals.py
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from chat.authentication import auth_state, bump_user_version, token_user_cache
+from chat.directory import directory_state, invalidate_directory
+
+User = get_user_model()
+
+
+@receiver(post_init, sender=User)
+def remember_state(sender, instance, **kwargs):
+    instance._directory_state = directory_state(instance)
+    instance._auth_state = auth_state(instance)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    # Logins and last_seen touches save the user too; only bump the
+    # directory version when something it shows has changed.
+    state = directory_state(instance)
+    if created or state != getattr(instance, '_directory_state', None):
+        invalidate_directory()
+    instance._directory_state = state
+
+    # Password changes and deactivation revoke cached token verifications
+    # in every process; other saves only refresh this process's snapshots.
+    state = auth_state(instance)
+    if not created and state != getattr(instance, '_auth_state', None):
+        bump_user_version(instance.pk)
+    instance._auth_state = state
+    token_user_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_directory()
+    bump_user_version(instance.pk)
+    token_user_cache.invalidate_user(instance.pk)
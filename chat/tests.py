@@ -1,3 +1,1349 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+from bson import ObjectId
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING
+from jwt.exceptions import InvalidTokenError
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import attachments, metrics, presence, ratelimit, search, write_behind
+from chat.attachments import parse_range
+from chat.authentication import (
+    CachedJWTAuthentication,
+    aget_user_for_jwt,
+    bump_user_version,
+    get_user_version,
+    token_user_cache,
+)
+from chat.benchmark import mongomock_clients
+from chat.consumers import ChatConsumer
+from chat.directory import get_directory_page, get_directory_version, invalidate_directory
+from chat.dispatch import MAX_ERRORS, Field, HandlerRegistry, Schema, ValidationError
+from chat.outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue
+from chat.pagination import (
+    MAX_PAGE_SIZE,
+    build_page,
+    clamp_page_size,
+    decode_cursor,
+    encode_cursor,
+    keyset_query,
+)
+from chat.mongo_utils import (
+    get_messages_collection,
+    get_mongodb_connection,
+    get_rooms_collection,
+)
+from chat.protocol import JSON, MSGPACK
+from chat.ratelimit import DEFAULT_KEY, LocalRateLimiter, RedisRateLimiter, take_token
+from chat.rooms import aget_user_room_ids, room_members_cache
+from chat.routing import websocket_urlpatterns
 
-# Create your tests here.
+User = get_user_model()
+
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# Seconds to wait for a frame before a test fails.
+FRAME_TIMEOUT = 2
+
+
+def make_doc(minutes):
+    return {
+        "_id": ObjectId(),
+        "timestamp": datetime(2024, 1, 1) + timedelta(minutes=minutes),
+    }
+
+
+class PaginationTests(SimpleTestCase):
+    def test_cursor_round_trip(self):
+        doc = make_doc(5)
+        self.assertEqual(decode_cursor(encode_cursor(doc)), (doc["timestamp"], doc["_id"]))
+
+    def test_cursor_on_other_field(self):
+        doc = {"_id": ObjectId(), "updated_at": datetime(2024, 2, 3, 4, 5)}
+        timestamp, _ = decode_cursor(encode_cursor(doc, field="updated_at"))
+        self.assertEqual(timestamp, doc["updated_at"])
+
+    def test_malformed_cursor(self):
+        for token in ("", "!!!", "bm90IGpzb24", encode_cursor({"_id": "x", "timestamp": "y"})):
+            with self.assertRaises(ValueError):
+                decode_cursor(token)
+
+    def test_clamp_page_size(self):
+        self.assertEqual(clamp_page_size(None, default=7), 7)
+        self.assertEqual(clamp_page_size("0"), 1)
+        self.assertEqual(clamp_page_size(10**6), MAX_PAGE_SIZE)
+        with self.assertRaises(ValueError):
+            clamp_page_size("many")
+
+    def test_keyset_without_cursor(self):
+        query, sort = keyset_query({"room_id": "r"})
+        self.assertEqual(query, {"room_id": "r"})
+        self.assertEqual(sort, [("timestamp", DESCENDING), ("_id", DESCENDING)])
+        _, sort = keyset_query({"room_id": "r"}, newest_first=False)
+        self.assertEqual(sort, [("timestamp", ASCENDING), ("_id", ASCENDING)])
+
+    def test_keyset_before_and_after(self):
+        doc = make_doc(0)
+        cursor = encode_cursor(doc)
+
+        query, sort = keyset_query({"room_id": "r"}, before=cursor)
+        self.assertEqual(sort[0], ("timestamp", DESCENDING))
+        self.assertEqual(
+            query["$and"][1]["$or"],
+            [
+                {"timestamp": {"$lt": doc["timestamp"]}},
+                {"timestamp": doc["timestamp"], "_id": {"$lt": doc["_id"]}},
+            ],
+        )
+
+        query, sort = keyset_query({"room_id": "r"}, after=cursor)
+        self.assertEqual(sort[0], ("timestamp", ASCENDING))
+        self.assertEqual(query["$and"][0], {"room_id": "r"})
+        self.assertEqual(query["$and"][1]["$or"][0], {"timestamp": {"$gt": doc["timestamp"]}})
+
+        with self.assertRaises(ValueError):
+            keyset_query({}, before=cursor, after=cursor)
+
+    def test_build_page_newest_first(self):
+        docs = [make_doc(minutes) for minutes in (4, 3, 2)]
+        sort = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+        page, has_more, cursors = build_page(list(docs), 2, sort)
+
+        self.assertTrue(has_more)
+        self.assertEqual(page, [docs[1], docs[0]])
+        self.assertEqual(cursors["before"], encode_cursor(docs[1]))
+        self.assertEqual(cursors["after"], encode_cursor(docs[0]))
+
+    def test_build_page_keeps_fetch_order(self):
+        docs = [make_doc(minutes) for minutes in (4, 3)]
+        sort = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+        page, has_more, cursors = build_page(list(docs), 5, sort, chronological=False)
+
+        self.assertFalse(has_more)
+        self.assertEqual(page, docs)
+        self.assertEqual(cursors["before"], encode_cursor(docs[1]))
+
+    def test_build_page_empty(self):
+        page, has_more, cursors = build_page([], 5, [("timestamp", ASCENDING)])
+        self.assertEqual((page, has_more), ([], False))
+        self.assertEqual(cursors, {"before": None, "after": None})
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_whole_file(self):
+        for header in (None, "", "bytes=-", "items=0-1", "bytes=0-1,4-5"):
+            self.assertIsNone(parse_range(header, 100))
+
+    def test_ranges(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=90-500", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        for header, length in (("bytes=100-", 100), ("bytes=5-2", 100), ("bytes=0-0", 0)):
+            with self.assertRaises(ValueError):
+                parse_range(header, length)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_take_token_refills_up_to_burst(self):
+        bucket = [2.0, 0.0]
+        self.assertEqual(take_token(bucket, 1, 2, 0.0), 0.0)
+        self.assertEqual(take_token(bucket, 1, 2, 0.0), 0.0)
+        self.assertAlmostEqual(take_token(bucket, 1, 2, 0.0), 1.0)
+        self.assertEqual(take_token(bucket, 1, 2, 1.0), 0.0)
+        take_token(bucket, 1, 2, 100.0)
+        self.assertEqual(bucket, [1.0, 100.0])
+
+    def test_local_limiter(self):
+        limiter = LocalRateLimiter({"message.send": (1, 2), DEFAULT_KEY: (1, 1)}, 100)
+        with mock.patch("chat.ratelimit.time.monotonic", return_value=10.0):
+            results = [asyncio.run(limiter.hit("alice", "message.send")) for _ in range(3)]
+            self.assertEqual(results[:2], [0.0, 0.0])
+            self.assertGreater(results[2], 0)
+            # Other users and unlisted sources have buckets of their own.
+            self.assertEqual(asyncio.run(limiter.hit("bob", "message.send")), 0.0)
+            self.assertEqual(asyncio.run(limiter.hit("alice", "made.up")), 0.0)
+            self.assertGreater(asyncio.run(limiter.hit("alice", "other.made.up")), 0)
+
+    def test_unlimited_without_default(self):
+        limiter = LocalRateLimiter({"message.send": (1, 1)}, 100)
+        self.assertEqual(limiter.limit_for("ping"), (DEFAULT_KEY, None))
+        for _ in range(5):
+            self.assertEqual(asyncio.run(limiter.hit("alice", "ping")), 0.0)
+
+    def test_bucket_cap_drops_buckets(self):
+        limiter = LocalRateLimiter({DEFAULT_KEY: (1, 1)}, 2)
+        for user in ("a", "b", "c"):
+            asyncio.run(limiter.hit(user, "ping"))
+        self.assertEqual(len(limiter._buckets), 1)
+
+    def redis_limiter(self, reply):
+        limiter = RedisRateLimiter({"message.send": (1, 3)}, 100)
+        script = mock.AsyncMock(side_effect=reply)
+        limiter._get_script = lambda: script
+        return limiter
+
+    def test_redis_rejection_refunds_local_bucket(self):
+        limiter = self.redis_limiter(["0.5"])
+        with mock.patch("chat.ratelimit.time.monotonic", return_value=10.0):
+            self.assertEqual(asyncio.run(limiter.hit("alice", "message.send")), 0.5)
+        self.assertEqual(limiter._buckets[("alice", "message.send")][0], 3.0)
+
+    def test_redis_acceptance_spends_local_token(self):
+        limiter = self.redis_limiter(["0"])
+        with mock.patch("chat.ratelimit.time.monotonic", return_value=10.0):
+            self.assertEqual(asyncio.run(limiter.hit("alice", "message.send")), 0.0)
+        self.assertEqual(limiter._buckets[("alice", "message.send")][0], 2.0)
+
+    def test_redis_errors_let_frames_through(self):
+        limiter = self.redis_limiter(ConnectionError("down"))
+        with self.assertLogs("chat.ratelimit", "WARNING"):
+            self.assertEqual(asyncio.run(limiter.hit("alice", "message.send")), 0.0)
+
+    def test_local_bucket_short_circuits_redis(self):
+        limiter = self.redis_limiter(["0"] * 3)
+        with mock.patch("chat.ratelimit.time.monotonic", return_value=10.0):
+            for _ in range(3):
+                asyncio.run(limiter.hit("alice", "message.send"))
+            self.assertGreater(asyncio.run(limiter.hit("alice", "message.send")), 0)
+
+
+class FieldTests(SimpleTestCase):
+    def errors(self, field, value, name="value"):
+        errors = []
+        field.check(name, value, errors)
+        return [error["code"] for error in errors]
+
+    def test_types(self):
+        self.assertEqual(self.errors(Field(str), "x"), [])
+        self.assertEqual(self.errors(Field(str), 1), ["type"])
+        self.assertEqual(self.errors(Field(int), True), ["type"])
+        self.assertEqual(self.errors(Field(int, bool), True), [])
+        self.assertEqual(self.errors(Field(str, bytes), b"x"), [])
+
+    def test_lengths(self):
+        field = Field(list, min_length=1, max_length=2)
+        self.assertEqual(self.errors(field, []), ["min_length"])
+        self.assertEqual(self.errors(field, [1, 2, 3]), ["max_length"])
+        self.assertEqual(self.errors(field, [1]), [])
+
+    def test_object_id(self):
+        field = Field(str, object_id=True)
+        self.assertEqual(self.errors(field, str(ObjectId())), [])
+        self.assertEqual(self.errors(field, "nope"), ["object_id"])
+        self.assertEqual(self.errors(field, str(ObjectId()) + "\n"), ["object_id"])
+
+    def test_items(self):
+        field = Field(str, list, items=Field(str, max_length=3))
+        errors = []
+        field.check("fields", ["id", 1, "toolong"], errors)
+        self.assertEqual(
+            [(error["field"], error["code"]) for error in errors],
+            [("fields[1]", "type"), ("fields[2]", "max_length")],
+        )
+        # Strings are not iterated as lists of characters.
+        self.assertEqual(self.errors(field, "id,username"), [])
+
+    def test_parse(self):
+        field = Field(str, parse=datetime.fromisoformat)
+        errors = []
+        self.assertEqual(field.check("at", "2024-01-02", errors), datetime(2024, 1, 2))
+        self.assertEqual(self.errors(field, "yesterday"), ["invalid"])
+
+
+class SchemaTests(SimpleTestCase):
+    schema = Schema(
+        {
+            "room_id": Field(str, required=True),
+            "page_size": Field(int),
+            "at": Field(str, parse=datetime.fromisoformat),
+        }
+    )
+
+    def test_valid(self):
+        data = {"room_id": "r", "page_size": None, "extra": object()}
+        self.assertIs(self.schema.validate(data), data)
+
+    def test_parsed_values_replace_raw_ones(self):
+        data = self.schema.validate({"room_id": "r", "at": "2024-01-02T03:04:05"})
+        self.assertEqual(data["at"], datetime(2024, 1, 2, 3, 4, 5))
+
+    def test_all_errors_reported(self):
+        with self.assertRaises(ValidationError) as raised:
+            self.schema.validate({"page_size": "1", "at": "then"})
+        self.assertEqual(
+            [error["field"] for error in raised.exception.errors],
+            ["room_id", "page_size", "at"],
+        )
+
+    def test_data_must_be_object(self):
+        with self.assertRaises(ValidationError):
+            self.schema.validate(["room_id"])
+        with self.assertRaises(ValidationError):
+            self.schema.validate(None)
+
+    def test_error_cap(self):
+        schema = Schema({"ids": Field(list, items=Field(str))})
+        with self.assertRaises(ValidationError) as raised:
+            schema.validate({"ids": list(range(50))})
+        self.assertEqual(len(raised.exception.errors), MAX_ERRORS)
+
+    def test_registry_resolve(self):
+        registry = HandlerRegistry(ChatConsumer.handlers)
+        self.assertEqual(registry.resolve({"source": "ping"}).source, "ping")
+        for frame in ([], {}, {"source": "nope"}, {"source": ["ping"]}):
+            with self.assertRaises(ValueError):
+                registry.resolve(frame)
+
+    def test_consumer_schemas(self):
+        user_list = ChatConsumer.handlers["user.list"].schema
+        with self.assertRaises(ValidationError):
+            user_list.validate({"fields": [1]})
+        read = ChatConsumer.handlers["message.read"].schema
+        with self.assertRaises(ValidationError):
+            read.validate({"room_id": "r", "up_to_timestamp": "not a date"})
+
+
+class FakeSocket:
+    codec = JSON
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(text_data if text_data is not None else bytes_data)
+
+    async def close(self, code=None):
+        self.closed_with = code
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def flush(self, queue):
+        writer = asyncio.create_task(queue.run())
+        await queue.drain()
+        writer.cancel()
+
+    def queue(self, socket, **options):
+        return OutboundQueue(
+            socket,
+            **{"max_size": 10, "window": 0, "batching": False, "max_batch": 10, **options},
+        )
+
+    async def test_keyed_frames_coalesce_in_place(self):
+        socket = FakeSocket()
+        queue = self.queue(socket)
+        queue.put("a")
+        queue.put("typing-1", key="type:r:alice")
+        queue.put("b")
+        queue.put("typing-2", key="type:r:alice")
+
+        self.assertEqual(len(queue), 3)
+        await self.flush(queue)
+        self.assertEqual(socket.sent, ["a", "typing-2", "b"])
+
+    async def test_key_is_released_after_flush(self):
+        socket = FakeSocket()
+        queue = self.queue(socket)
+        queue.put("typing-1", key="k")
+        await self.flush(queue)
+        queue.put("typing-2", key="k")
+        await self.flush(queue)
+        self.assertEqual(socket.sent, ["typing-1", "typing-2"])
+
+    async def test_batching_joins_frames(self):
+        socket = FakeSocket()
+        queue = self.queue(socket, batching=True, max_batch=2)
+        for index in range(3):
+            queue.put(JSON.encode({"source": "pong", "n": index}))
+        await self.flush(queue)
+
+        self.assertEqual(len(socket.sent), 2)
+        first = json.loads(socket.sent[0])
+        self.assertEqual(first["source"], "batch")
+        self.assertEqual([frame["n"] for frame in first["data"]], [0, 1])
+        self.assertEqual(json.loads(socket.sent[1])["n"], 2)
+
+    async def test_slow_consumer_is_closed(self):
+        socket = FakeSocket()
+        queue = self.queue(socket, max_size=2)
+        self.assertTrue(queue.put("a"))
+        self.assertTrue(queue.put("b"))
+        self.assertFalse(queue.put("c"))
+        self.assertFalse(queue.put("d"))
+        with self.assertLogs("chat.outbound", "WARNING"):
+            await queue._close_task
+        self.assertEqual(socket.closed_with, SLOW_CONSUMER_CLOSE_CODE)
+
+    def test_msgpack_join(self):
+        frames = [MSGPACK.encode({"n": index}) for index in range(20)]
+        batch = MSGPACK.decode(bytes_data=MSGPACK.join(frames))
+        self.assertEqual(batch["source"], "batch")
+        self.assertEqual([frame["n"] for frame in batch["data"]], list(range(20)))
+
+
+class ConsumerRateLimitTests(SimpleTestCase):
+    def consumer(self, retry_after):
+        consumer = ChatConsumer()
+        consumer.username = "alice"
+        consumer.limiter = mock.Mock()
+        consumer.limiter.hit = mock.AsyncMock(side_effect=retry_after)
+        consumer.limiter.limit_for.return_value = ("message.send", (1, 1))
+        consumer.send_error = mock.AsyncMock()
+        return consumer
+
+    async def test_dispatched_source_is_charged_when_peek_differs(self):
+        consumer = self.consumer([0.0, 1.0])
+        with mock.patch.object(
+            ChatConsumer.handlers["message.send"], "method", mock.AsyncMock()
+        ) as handler:
+            await consumer.receive(
+                text_data='{"source": "ping", "source": "message.send", "data": {}}'
+            )
+        self.assertEqual(
+            [call.args for call in consumer.limiter.hit.await_args_list],
+            [("alice", "ping"), ("alice", "message.send")],
+        )
+        handler.assert_not_awaited()
+        self.assertEqual(consumer.send_error.await_args.args[0], "rate_limited")
+
+    async def test_typing_is_dropped_quietly(self):
+        consumer = self.consumer([0.5])
+        self.assertTrue(await consumer.rate_limited("message.type"))
+        consumer.send_error.assert_not_awaited()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class DirectoryInvalidationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="alice", first_name="Alice")
+
+    def test_login_saves_keep_cached_pages(self):
+        version = get_directory_version()
+        user = User.objects.get(pk=self.user.pk)
+        user.is_staff = True
+        user.last_login = timezone.now()
+        user.save()
+        self.assertEqual(get_directory_version(), version)
+
+    def test_visible_changes_invalidate(self):
+        version = get_directory_version()
+        page = get_directory_page()
+        self.assertEqual(page["results"][0]["first_name"], "Alice")
+
+        self.user.first_name = "Alicia"
+        self.user.save()
+        self.assertEqual(get_directory_version(), version + 1)
+        self.assertEqual(get_directory_page()["results"][0]["first_name"], "Alicia")
+
+        User.objects.create(username="bob")
+        self.assertEqual(get_directory_version(), version + 2)
+        self.user.delete()
+        self.assertEqual(get_directory_version(), version + 3)
+        self.assertEqual(
+            [user["username"] for user in get_directory_page()["results"]], ["bob"]
+        )
+
+    def test_deactivated_users_leave_the_directory(self):
+        get_directory_page()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(get_directory_page()["results"], [])
+
+    def test_unreachable_cache_is_logged(self):
+        with mock.patch.object(cache, "incr", side_effect=ConnectionError("down")):
+            with self.assertLogs("chat.directory", "ERROR"):
+                invalidate_directory()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TokenUserCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        token_user_cache.clear()
+        self.user = User.objects.create(username="alice")
+        self.token = str(AccessToken.for_user(self.user))
+
+    def authenticate(self):
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        return CachedJWTAuthentication().authenticate(request)
+
+    def test_hits_skip_the_database(self):
+        self.assertEqual(self.authenticate()[0], self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate()[0].pk, self.user.pk)
+
+    def test_revocation_from_another_process(self):
+        self.authenticate()
+        # What the signal does in the process that saved the user.
+        bump_user_version(self.user.pk)
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+    def test_deactivation_revokes(self):
+        self.authenticate()
+        version = get_user_version(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(get_user_version(self.user.pk), version + 1)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_password_change_bumps_but_login_save_does_not(self):
+        version = get_user_version(self.user.pk)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(get_user_version(self.user.pk), version)
+        user.set_password("new password")
+        user.save()
+        self.assertEqual(get_user_version(self.user.pk), version + 1)
+
+    async def test_websocket_tokens(self):
+        user = await aget_user_for_jwt(self.token)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertIsNotNone(token_user_cache.get(token_user_cache.key("ws", self.token)))
+
+        user.is_active = False
+        await user.asave()
+        with self.assertRaises(InvalidTokenError):
+            await aget_user_for_jwt(self.token)
+
+    def test_unreachable_cache(self):
+        down = mock.patch.multiple(
+            cache,
+            get=mock.Mock(side_effect=ConnectionError("down")),
+            incr=mock.Mock(side_effect=ConnectionError("down")),
+        )
+        with down, self.assertLogs("chat", "WARNING"):
+            user = User.objects.create(username="bob")
+            user.set_password("secret")
+            user.save()
+            # Verified, but not cached since it could not be revoked.
+            self.assertEqual(self.authenticate()[0].pk, self.user.pk)
+        self.assertIsNone(token_user_cache.get(token_user_cache.key("drf", self.token)))
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ChatTestCase(TestCase):
+    """Runs the consumer and views against mongomock, an in-memory channel
+    layer and the local presence, search and attachment backends."""
+
+    chat_settings = {}
+
+    def setUp(self):
+        attachment_root = tempfile.mkdtemp(prefix="chat-test-")
+        self.addCleanup(shutil.rmtree, attachment_root, ignore_errors=True)
+        self.enterContext(
+            override_settings(
+                CHAT_SETTINGS={
+                    "PRESENCE_BACKEND": "local",
+                    "SEARCH_BACKEND": "local",
+                    "RATE_LIMIT_BACKEND": None,
+                    "ATTACHMENT_STORAGE": "local",
+                    "ATTACHMENT_ROOT": attachment_root,
+                    "OUTBOUND_FLUSH_WINDOW": 0,
+                    **self.chat_settings,
+                }
+            )
+        )
+        self.enterContext(mongomock_clients())
+        cache.clear()
+        token_user_cache.clear()
+        room_members_cache._entries.clear()
+        channel_layers.backends = {}
+        presence._presence = None
+        search._backend = None
+        ratelimit._limiter = None
+        attachments._storage = None
+        self.application = URLRouter(websocket_urlpatterns)
+
+    def create_user(self, username):
+        return User.objects.create(username=username)
+
+    def token(self, user):
+        return str(AccessToken.for_user(user))
+
+    def create_room(self, *participants):
+        result = get_rooms_collection().insert_one(
+            {"participants": sorted(participants), "created_at": datetime.now()}
+        )
+        return str(result.inserted_id)
+
+    def auth(self, user):
+        return {"authorization": f"Bearer {self.token(user)}"}
+
+    async def api_post(self, user, path, data, **kwargs):
+        return await self.async_client.post(
+            path, data, headers=self.auth(user), **kwargs
+        )
+
+    async def api_get(self, user, path, data=None, **headers):
+        return await self.async_client.get(
+            path, data, headers={**self.auth(user), **headers}
+        )
+
+    async def streamed(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            self.application, f"/api/chat/?token={self.token(user)}"
+        )
+        connected, _ = await communicator.connect(timeout=FRAME_TIMEOUT)
+        self.assertTrue(connected)
+        await self.receive(communicator, "connection")
+        return communicator
+
+    async def send(self, communicator, source, data=None):
+        await communicator.send_json_to({"source": source, "data": data})
+
+    async def receive(self, communicator, source):
+        """The next frame with ``source``, skipping any others."""
+        while True:
+            frame = await communicator.receive_json_from(timeout=FRAME_TIMEOUT)
+            if frame["source"] == source:
+                return frame
+
+    async def request(self, communicator, source, data=None, reply=None):
+        await self.send(communicator, source, data)
+        return await self.receive(communicator, reply or source)
+
+    async def eventually(self, check):
+        """Poll ``check`` until it is truthy (work done after a frame went out)."""
+        for _ in range(100):
+            if await asyncio.to_thread(check):
+                return
+            await asyncio.sleep(0.01)
+        self.fail("condition never became true")
+
+    async def send_message(self, communicator, user, room_id, text, **extra):
+        frame = await self.request(
+            communicator,
+            "message.send",
+            {"room_id": room_id, "sender": user.username, "message": text, **extra},
+        )
+        return frame["data"]
+
+
+class MessageListTests(ChatTestCase):
+    async def test_group_room_members_see_every_message(self):
+        alice, bob, carol = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "carol")
+        ]
+        room_id = self.create_room("alice", "bob", "carol")
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
+
+        sent = await self.send_message(alice_socket, alice, room_id, "hello room")
+        self.assertIsNone(sent["receiver"])
+        live = await self.receive(bob_socket, "message.send")
+        self.assertEqual(live["data"]["message_id"], sent["message_id"])
+
+        frame = await self.request(bob_socket, "message.list", {"room_id": room_id})
+        self.assertEqual(
+            [message["message"] for message in frame["data"]["messages"]], ["hello room"]
+        )
+
+    async def test_non_members_are_refused(self):
+        alice, mallory = [
+            await User.objects.acreate(username=name) for name in ("alice", "mallory")
+        ]
+        room_id = self.create_room("alice", "bob")
+        socket = await self.connect(alice)
+        await self.send_message(socket, alice, room_id, "private")
+
+        mallory_socket = await self.connect(mallory)
+        frame = await self.request(
+            mallory_socket, "message.list", {"room_id": room_id}, reply="error"
+        )
+        self.assertEqual(frame["error"]["type"], "not_found")
+
+    async def test_ad_hoc_rooms_only_list_own_messages(self):
+        alice, bob, carol = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "carol")
+        ]
+        alice_socket = await self.connect(alice)
+        await self.send_message(alice_socket, alice, "adhoc", "to bob", receiver="bob")
+
+        bob_socket = await self.connect(bob)
+        frame = await self.request(bob_socket, "message.list", {"room_id": "adhoc"})
+        self.assertEqual(len(frame["data"]["messages"]), 1)
+
+        carol_socket = await self.connect(carol)
+        frame = await self.request(carol_socket, "message.list", {"room_id": "adhoc"})
+        self.assertEqual(frame["data"]["messages"], [])
+
+    async def test_pages_follow_cursors(self):
+        alice = await User.objects.acreate(username="alice")
+        room_id = self.create_room("alice", "bob")
+        socket = await self.connect(alice)
+        for index in range(5):
+            await self.send_message(socket, alice, room_id, f"m{index}")
+
+        first = await self.request(
+            socket,
+            "message.list",
+            {"room_id": room_id, "page_size": 2, "include_total": True},
+        )
+        self.assertEqual([m["message"] for m in first["data"]["messages"]], ["m3", "m4"])
+        self.assertTrue(first["data"]["has_more"])
+        self.assertEqual(first["data"]["total"], 5)
+
+        before = first["data"]["cursors"]["before"]
+        older = await self.request(
+            socket, "message.list", {"room_id": room_id, "page_size": 2, "before": before}
+        )
+        self.assertEqual([m["message"] for m in older["data"]["messages"]], ["m1", "m2"])
+
+
+class AttachmentTests(ChatTestCase):
+    content = bytes(range(256)) * 40
+    chat_settings = {"ATTACHMENT_MAX_SIZE": len(content)}
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol, self.mallory = [
+            self.create_user(name) for name in ("alice", "bob", "carol", "mallory")
+        ]
+
+    async def upload(self, user):
+        response = await self.api_post(
+            user,
+            "/api/attachments/",
+            {"file": SimpleUploadedFile("data.bin", self.content, "application/x-test")},
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    async def post_message(self, user, room_id, file_id, **extra):
+        return await self.api_post(
+            user,
+            "/api/messages/",
+            {"room_id": room_id, "message": "see file", "file_id": file_id, **extra},
+            content_type="application/json",
+        )
+
+    async def download(self, user, file_id, **headers):
+        return await self.api_get(user, f"/api/attachments/{file_id}/", **headers)
+
+    async def test_full_and_ranged_download(self):
+        info = await self.upload(self.alice)
+        self.assertEqual(info["size"], len(self.content))
+
+        response = await self.download(self.alice, info["file_id"])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(await self.streamed(response), self.content)
+
+        response = await self.download(self.alice, info["file_id"], range="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.content)}")
+        self.assertEqual(await self.streamed(response), self.content[100:200])
+
+        response = await self.download(self.alice, info["file_id"], range="bytes=999999-")
+        self.assertEqual(response.status_code, 416)
+
+    async def test_group_room_members_can_download(self):
+        room_id = self.create_room("alice", "bob", "carol")
+        info = await self.upload(self.alice)
+        response = await self.post_message(self.alice, room_id, info["file_id"])
+        self.assertEqual(response.status_code, 201)
+
+        for user in (self.bob, self.carol):
+            response = await self.download(user, info["file_id"])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(await self.streamed(response), self.content)
+        response = await self.download(self.mallory, info["file_id"])
+        self.assertEqual(response.status_code, 404)
+
+    async def test_posting_into_an_ad_hoc_room_grants_nothing(self):
+        info = await self.upload(self.alice)
+        alice_socket = await self.connect(self.alice)
+        await self.send_message(
+            alice_socket, self.alice, "adhoc", "file", receiver="bob", file_id=info["file_id"]
+        )
+
+        response = await self.download(self.bob, info["file_id"])
+        self.assertEqual(response.status_code, 200)
+
+        mallory_socket = await self.connect(self.mallory)
+        await self.send_message(
+            mallory_socket, self.mallory, "adhoc", "let me in", receiver="alice"
+        )
+        response = await self.download(self.mallory, info["file_id"])
+        self.assertEqual(response.status_code, 404)
+
+    async def test_inline_files_are_stored_and_size_limited(self):
+        socket = await self.connect(self.alice)
+        sent = await self.send_message(
+            socket,
+            self.alice,
+            "adhoc",
+            "inline",
+            receiver="bob",
+            filename="data.bin",
+            file=base64.b64encode(self.content).decode(),
+        )
+        self.assertEqual(sent["file"]["size"], len(self.content))
+        response = await self.download(self.bob, sent["file"]["file_id"])
+        self.assertEqual(await self.streamed(response), self.content)
+
+        await self.send(
+            socket,
+            "message.send",
+            {
+                "room_id": "adhoc",
+                "sender": "alice",
+                "receiver": "bob",
+                "message": "too big",
+                "filename": "big.bin",
+                "file": base64.b64encode(self.content + b"x").decode(),
+            },
+        )
+        frame = await self.receive(socket, "error")
+        self.assertEqual(frame["error"]["message"], "File too large")
+
+    async def test_cannot_attach_another_users_file(self):
+        info = await self.upload(self.alice)
+        response = await self.post_message(
+            self.bob, "adhoc", info["file_id"], receiver="carol"
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class RoomSubscriptionTests(ChatTestCase):
+    chat_settings = {"MAX_ROOM_SUBSCRIPTIONS": 2}
+
+    async def test_room_cap_keeps_newest_rooms_and_warns(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        oldest, middle, newest = [self.create_room("alice", "bob") for _ in range(3)]
+
+        with self.assertLogs("chat.rooms", "WARNING"):
+            self.assertEqual(await aget_user_room_ids("alice"), [newest, middle])
+
+        with self.assertNoLogs("chat.rooms", "WARNING"):
+            self.assertEqual(await aget_user_room_ids("carol"), [])
+
+        with self.assertLogs("chat.rooms", "WARNING") as logs:
+            alice_socket = await self.connect(alice)
+            bob_socket = await self.connect(bob)
+        self.assertEqual(len(logs.records), 2)
+        sent = await self.send_message(bob_socket, bob, newest, "hi")
+        live = await self.receive(alice_socket, "message.send")
+        self.assertEqual(live["data"]["message_id"], sent["message_id"])
+
+
+class SearchTests(ChatTestCase):
+    chat_settings = {"MAX_ROOM_SUBSCRIPTIONS": 1}
+
+    async def test_search_covers_rooms_past_the_subscription_cap(self):
+        alice, bob, mallory = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "mallory")
+        ]
+        older = self.create_room("alice", "bob", "carol")
+        self.create_room("alice", "carol")
+        with self.assertLogs("chat.rooms", "WARNING"):
+            bob_socket = await self.connect(bob)
+            alice_socket = await self.connect(alice)
+            mallory_socket = await self.connect(mallory)
+        await self.send_message(bob_socket, bob, older, "quarterly budget draft")
+        await self.send_message(bob_socket, bob, older, "lunch?")
+
+        frame = await self.request(alice_socket, "message.search", {"q": "budget"})
+        self.assertEqual(
+            [result["message"] for result in frame["data"]["results"]],
+            ["quarterly budget draft"],
+        )
+        self.assertEqual(frame["data"]["results"][0]["room_id"], older)
+
+        response = await self.api_get(alice, "/api/messages/search/", {"q": "budget"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 1)
+
+        frame = await self.request(mallory_socket, "message.search", {"q": "budget"})
+        self.assertEqual(frame["data"]["results"], [])
+
+
+class PendingDeliveryTests(ChatTestCase):
+    chat_settings = {"REQUIRE_DELIVERY_ACK": False, "PENDING_BATCH_SIZE": 2}
+
+    def undelivered(self):
+        return get_messages_collection().count_documents(
+            {"receiver": "bob", "delivered": False}
+        )
+
+    async def test_backlog_is_batched_and_marked_delivered(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        alice_socket = await self.connect(alice)
+        for index in range(3):
+            await self.send_message(alice_socket, alice, "adhoc", f"m{index}", receiver="bob")
+        self.assertEqual(self.undelivered(), 3)
+
+        bob_socket = await self.connect(bob)
+        first = await self.receive(bob_socket, "message.batch")
+        second = await self.receive(bob_socket, "message.batch")
+        self.assertEqual(
+            [message["message"] for message in first["data"]["messages"]], ["m0", "m1"]
+        )
+        self.assertTrue(first["data"]["has_more"])
+        self.assertEqual(
+            [message["message"] for message in second["data"]["messages"]], ["m2"]
+        )
+        self.assertFalse(second["data"]["has_more"])
+        await self.eventually(lambda: self.undelivered() == 0)
+
+    async def test_overflowed_batch_is_not_marked_delivered(self):
+        get_messages_collection().insert_one(
+            {
+                "room_id": "adhoc",
+                "sender": "alice",
+                "receiver": "bob",
+                "message": "lost",
+                "timestamp": datetime.now(),
+                "delivered": False,
+            }
+        )
+        consumer = ChatConsumer()
+        consumer.username = "bob"
+        consumer.codec = JSON
+        consumer.outbound = OutboundQueue(
+            FakeSocket(), max_size=0, window=0, batching=False, max_batch=10
+        )
+        batch = list(get_messages_collection().find({"receiver": "bob"}))
+
+        with self.assertLogs("chat.outbound", "WARNING"):
+            self.assertFalse(await consumer.deliver_pending_batch(batch, has_more=False))
+            await consumer.outbound._close_task
+        self.assertEqual(self.undelivered(), 1)
+
+
+class ReadReceiptTests(ChatTestCase):
+    def read_up_to(self, username, room_id):
+        state = get_mongodb_connection()["read_states"].find_one(
+            {"username": username, "room_id": room_id}
+        )
+        return state and state["read_up_to"]["message_id"]
+
+    async def test_direct_messages_are_flagged_read(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
+        sent = await self.send_message(alice_socket, alice, "adhoc", "hi", receiver="bob")
+
+        await self.send(bob_socket, "message.read", {"message_ids": [sent["message_id"]]})
+        receipt = await self.receive(alice_socket, "message.read")
+        self.assertEqual(receipt["data"]["message_ids"], [sent["message_id"]])
+        self.assertEqual(receipt["data"]["reader"], "bob")
+        message = get_messages_collection().find_one({"_id": ObjectId(sent["message_id"])})
+        self.assertTrue(message["is_read"])
+
+        frame = await self.request(
+            bob_socket, "message.read", {"message_ids": [sent["message_id"]]}, reply="error"
+        )
+        self.assertEqual(frame["error"]["type"], "not_found")
+
+    async def test_group_message_ids_advance_the_watermark(self):
+        alice, bob, mallory = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "mallory")
+        ]
+        room_id = self.create_room("alice", "bob", "carol")
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
+        first = await self.send_message(alice_socket, alice, room_id, "one")
+        second = await self.send_message(alice_socket, alice, room_id, "two")
+        await self.receive(bob_socket, "message.send")
+
+        await self.send(
+            bob_socket,
+            "message.read",
+            {"message_ids": [second["message_id"], first["message_id"]]},
+        )
+        receipt = await self.receive(alice_socket, "message.read")
+        self.assertEqual(receipt["data"]["room_id"], room_id)
+        self.assertEqual(receipt["data"]["up_to"]["message_id"], second["message_id"])
+        self.assertEqual(self.read_up_to("bob", room_id), ObjectId(second["message_id"]))
+
+        mallory_socket = await self.connect(mallory)
+        frame = await self.request(
+            mallory_socket, "message.read", {"message_ids": [first["message_id"]]}, reply="error"
+        )
+        self.assertEqual(frame["error"]["type"], "not_found")
+        self.assertIsNone(self.read_up_to("mallory", room_id))
+
+    async def test_room_watermark(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        room_id = self.create_room("alice", "bob")
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
+        sent = await self.send_message(alice_socket, alice, room_id, "one")
+
+        await self.send(
+            bob_socket, "message.read", {"room_id": room_id, "up_to": sent["message_id"]}
+        )
+        receipt = await self.receive(alice_socket, "message.read")
+        self.assertEqual(receipt["data"]["up_to"]["message_id"], sent["message_id"])
+        self.assertEqual(self.read_up_to("bob", room_id), ObjectId(sent["message_id"]))
+
+
+class ConversationTests(ChatTestCase):
+    async def post(self, user, data):
+        return await self.api_post(user, "/api/messages/", data, content_type="application/json")
+
+    async def conversations(self, user):
+        response = await self.api_get(user, "/api/conversations/")
+        self.assertEqual(response.status_code, 200)
+        return {
+            conversation["room_id"]: conversation
+            for conversation in response.json()["conversations"]
+        }
+
+    async def test_rest_posts_to_ad_hoc_rooms_reach_the_receiver(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        bob_socket = await self.connect(bob)
+
+        response = await self.post(alice, {"room_id": "adhoc", "message": "hi"})
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.post(
+            alice, {"room_id": "adhoc", "message": "hi", "receiver": "bob"}
+        )
+        self.assertEqual(response.status_code, 201)
+        live = await self.receive(bob_socket, "message.send")
+        self.assertEqual(live["data"]["receiver"], "bob")
+
+        bob_conversations = await self.conversations(bob)
+        self.assertEqual(bob_conversations["adhoc"]["unread_count"], 1)
+        self.assertEqual(bob_conversations["adhoc"]["last_message"]["preview"], "hi")
+        self.assertEqual((await self.conversations(alice))["adhoc"]["unread_count"], 0)
+
+    async def test_socket_and_rest_sends_update_every_member(self):
+        alice, bob, carol = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "carol")
+        ]
+        room_id = self.create_room("alice", "bob", "carol")
+        alice_socket = await self.connect(alice)
+        await self.send_message(alice_socket, alice, room_id, "one")
+        response = await self.post(bob, {"room_id": room_id, "message": "two"})
+        self.assertEqual(response.status_code, 201)
+
+        carol_room = (await self.conversations(carol))[room_id]
+        self.assertEqual(carol_room["unread_count"], 2)
+        self.assertEqual(carol_room["last_message"]["preview"], "two")
+        self.assertEqual((await self.conversations(alice))[room_id]["unread_count"], 1)
+
+
+class MetricsEndpointTests(SimpleTestCase):
+    async def fetch(self, client="10.0.0.5", authorization=None):
+        headers = [(b"authorization", authorization.encode())] if authorization else []
+        scope = {"type": "http", "path": "/metrics", "headers": headers, "client": (client, 5000)}
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        with mock.patch.object(metrics, "enabled", True):
+            await metrics.MetricsEndpoint(mock.AsyncMock())(scope, None, send)
+        return sent[0]["status"]
+
+    async def test_loopback_only_without_token(self):
+        self.assertEqual(await self.fetch("127.0.0.1"), 200)
+        self.assertEqual(await self.fetch("10.0.0.5"), 403)
+
+    @override_settings(CHAT_SETTINGS={"METRICS_TOKEN": "s3cret"})
+    async def test_token_required_when_set(self):
+        self.assertEqual(await self.fetch(authorization="Bearer s3cret"), 200)
+        self.assertEqual(await self.fetch(authorization="Bearer nope"), 403)
+        self.assertEqual(await self.fetch("127.0.0.1"), 403)
+
+
+class FrameMetricsTests(ChatTestCase):
+    def observed_bytes(self):
+        state = metrics.FRAME_BYTES._values.get(("in",))
+        return state[1] if state else 0
+
+    async def test_inbound_frames_count_encoded_bytes(self):
+        alice = await User.objects.acreate(username="alice")
+        socket = await self.connect(alice)
+        frame = json.dumps({"source": "ping", "data": {"text": "héllo ✓"}}, ensure_ascii=False)
+        before = self.observed_bytes()
+        with mock.patch.object(metrics, "enabled", True):
+            await socket.send_to(text_data=frame)
+            await self.receive(socket, "pong")
+        self.assertEqual(self.observed_bytes() - before, len(frame.encode()))
+
+
+class TypingTests(ChatTestCase):
+    async def test_typing_reaches_room_members(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        room_id = self.create_room("alice", "bob", "carol")
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
+
+        await self.send(alice_socket, "message.type", {"room_id": room_id, "is_typing": True})
+        frame = await self.receive(bob_socket, "message.type")
+        self.assertEqual(frame["data"], {"room_id": room_id, "sender": "alice", "is_typing": True})
+
+    async def test_non_members_are_refused(self):
+        mallory = await User.objects.acreate(username="mallory")
+        room_id = self.create_room("alice", "bob")
+        socket = await self.connect(mallory)
+        frame = await self.request(socket, "message.type", {"room_id": room_id}, reply="error")
+        self.assertEqual(frame["error"]["type"], "permission_denied")
+
+    async def test_ad_hoc_rooms_need_a_receiver(self):
+        alice = await User.objects.acreate(username="alice")
+        socket = await self.connect(alice)
+        frame = await self.request(socket, "message.type", {"room_id": "adhoc"}, reply="error")
+        self.assertEqual(frame["error"]["type"], "validation_error")
+
+
+class SendAndAckTests(ChatTestCase):
+    async def test_send_ack_and_delivered_receipt(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        alice_socket = await self.connect(alice)
+
+        queued = await self.send_message(alice_socket, alice, "adhoc", "later", receiver="bob")
+        self.assertEqual(queued["status"], "queued")
+
+        bob_socket = await self.connect(bob)
+        sent = await self.send_message(alice_socket, alice, "adhoc", "now", receiver="bob")
+        self.assertEqual(sent["status"], "sent")
+        live = await self.receive(bob_socket, "message.send")
+        self.assertEqual(live["data"]["message_id"], sent["message_id"])
+        stored = get_messages_collection().find_one({"_id": ObjectId(sent["message_id"])})
+        self.assertEqual((stored["sender"], stored["receiver"]), ("alice", "bob"))
+        self.assertFalse(stored["delivered"])
+
+        await self.send(
+            bob_socket,
+            "message.ack",
+            {"message_ids": [queued["message_id"], sent["message_id"]]},
+        )
+        receipt = await self.receive(alice_socket, "message.delivered")
+        self.assertCountEqual(
+            receipt["data"]["message_ids"], [queued["message_id"], sent["message_id"]]
+        )
+        self.assertEqual(
+            get_messages_collection().count_documents({"delivered": True}), 2
+        )
+
+    async def test_cannot_send_as_someone_else(self):
+        alice = await User.objects.acreate(username="alice")
+        socket = await self.connect(alice)
+        frame = await self.request(
+            socket,
+            "message.send",
+            {"room_id": "adhoc", "sender": "bob", "receiver": "carol", "message": "hi"},
+            reply="error",
+        )
+        self.assertEqual(frame["error"]["type"], "permission_denied")
+        self.assertEqual(get_messages_collection().count_documents({}), 0)
+
+
+class PresenceTests(ChatTestCase):
+    chat_settings = {"PRESENCE_READ_CACHE_TTL": 0}
+
+    async def status(self, communicator, username):
+        frame = await self.request(communicator, "user.status", {"username": username})
+        return frame["data"]["status"]
+
+    async def test_online_until_the_last_socket_closes(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        alice_socket = await self.connect(alice)
+        self.assertEqual(await self.status(alice_socket, "bob"), "offline")
+
+        first = await self.connect(bob)
+        second = await self.connect(bob)
+        self.assertEqual(await self.status(alice_socket, "bob"), "online")
+
+        await first.disconnect()
+        self.assertEqual(await self.status(alice_socket, "bob"), "online")
+        await second.disconnect()
+        frame = await self.request(alice_socket, "user.status", {"username": "bob"})
+        self.assertEqual(frame["data"]["status"], "offline")
+        self.assertIsNotNone(frame["data"]["last_seen"])
+
+    async def test_user_list_merges_statuses_in_one_lookup(self):
+        alice, bob, carol = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "carol")
+        ]
+        alice_socket = await self.connect(alice)
+        await self.connect(bob)
+
+        with mock.patch.object(
+            presence.LocalPresence, "_fetch_statuses", autospec=True,
+            side_effect=presence.LocalPresence._fetch_statuses,
+        ) as fetch:
+            frame = await self.request(alice_socket, "user.list", {})
+        statuses = {user["username"]: user["status"] for user in frame["data"]["users"]}
+        self.assertEqual(statuses, {"bob": "online", "carol": "offline"})
+        self.assertEqual(fetch.call_count, 1)
+
+
+class WriteBehindTests(ChatTestCase):
+    chat_settings = {
+        "WRITE_BEHIND_ENABLED": True,
+        "WRITE_BEHIND_WINDOW": 0.05,
+        "WRITE_BEHIND_BATCH_SIZE": 10,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(write_behind.close_write_behind)
+
+    async def test_concurrent_sends_share_one_insert_many(self):
+        users = [await User.objects.acreate(username=f"user{index}") for index in range(3)]
+        sockets = [await self.connect(user) for user in users]
+
+        with mock.patch.object(
+            write_behind.WriteBehindBuffer, "_write", autospec=True,
+            side_effect=write_behind.WriteBehindBuffer._write,
+        ) as write:
+            sent = await asyncio.gather(
+                *[
+                    self.send_message(socket, user, "adhoc", user.username, receiver="bob")
+                    for socket, user in zip(sockets, users)
+                ]
+            )
+        self.assertEqual(write.call_count, 1)
+        stored = {
+            str(doc["_id"]): doc["message"]
+            for doc in get_messages_collection().find({"room_id": "adhoc"})
+        }
+        self.assertEqual(
+            stored, {data["message_id"]: data["message"] for data in sent}
+        )
+
+    def test_failed_inserts_fail_only_their_callers(self):
+        buffer = write_behind.get_write_behind()
+        duplicate = ObjectId()
+        get_messages_collection().insert_one({"_id": duplicate})
+
+        futures = [
+            buffer.submit({"message": "ok"})[0],
+            buffer.submit({"_id": duplicate, "message": "clash"})[0],
+        ]
+        with self.assertLogs("chat.write_behind", "ERROR"):
+            ok = futures[0].result(timeout=FRAME_TIMEOUT)
+            with self.assertRaises(write_behind.WriteBehindError):
+                futures[1].result(timeout=FRAME_TIMEOUT)
+        self.assertEqual(get_messages_collection().find_one({"_id": ok})["message"], "ok")
+
+    def test_buffered_inserts_are_written_on_close(self):
+        buffered = {
+            **settings.CHAT_SETTINGS,
+            "WRITE_BEHIND_ACK": "buffered",
+            "WRITE_BEHIND_WINDOW": 60,
+        }
+        with self.settings(CHAT_SETTINGS=buffered):
+            message_id = write_behind.insert_message({"message": "queued"})
+        self.assertIsNone(get_messages_collection().find_one({"_id": message_id}))
+        write_behind.close_write_behind()
+        self.assertIsNotNone(get_messages_collection().find_one({"_id": message_id}))
+
+
+class ExportTests(ChatTestCase):
+    async def export(self, user, **params):
+        response = await self.api_get(user, "/api/messages/export/", params)
+        if response.status_code != 200:
+            return response.status_code, None
+        body = await self.streamed(response)
+        if params.get("gzip"):
+            body = gzip.decompress(body)
+        return 200, [json.loads(line) for line in body.decode().splitlines()]
+
+    async def test_member_exports_room_oldest_first_and_resumes(self):
+        alice, bob, mallory = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "mallory")
+        ]
+        room_id = self.create_room("alice", "bob", "carol")
+        socket = await self.connect(alice)
+        for text in ("one", "two", "three"):
+            await self.send_message(socket, alice, room_id, text)
+
+        status, lines = await self.export(bob, room_id=room_id)
+        self.assertEqual(status, 200)
+        self.assertEqual([line["message"] for line in lines], ["one", "two", "three"])
+
+        _, rest = await self.export(bob, room_id=room_id, after=lines[0]["cursor"])
+        self.assertEqual([line["message"] for line in rest], ["two", "three"])
+
+        _, compressed = await self.export(bob, room_id=room_id, gzip="1")
+        self.assertEqual(compressed, lines)
+
+        status, _ = await self.export(mallory, room_id=room_id)
+        self.assertEqual(status, 404)
+        status, _ = await self.export(bob, room_id=room_id, after="garbage")
+        self.assertEqual(status, 400)
+
+    async def test_ad_hoc_rooms_export_own_messages_only(self):
+        alice, bob, carol = [
+            await User.objects.acreate(username=name) for name in ("alice", "bob", "carol")
+        ]
+        alice_socket = await self.connect(alice)
+        carol_socket = await self.connect(carol)
+        await self.send_message(alice_socket, alice, "adhoc", "to bob", receiver="bob")
+        await self.send_message(carol_socket, carol, "adhoc", "to alice", receiver="alice")
+
+        _, lines = await self.export(bob, room_id="adhoc")
+        self.assertEqual([line["message"] for line in lines], ["to bob"])
+
+
+class SocketAuthTests(ChatTestCase):
+    async def try_connect(self, user):
+        communicator = WebsocketCommunicator(
+            self.application, f"/api/chat/?token={self.token(user)}"
+        )
+        connected, _ = await communicator.connect(timeout=FRAME_TIMEOUT)
+        return connected
+
+    async def test_deactivation_revokes_a_cached_token(self):
+        alice = await User.objects.acreate(username="alice")
+        token = self.token(alice)
+        self.token = lambda user: token
+        self.assertTrue(await self.try_connect(alice))
+        self.assertTrue(await self.try_connect(alice))
+
+        alice.is_active = False
+        await alice.asave()
+        self.assertFalse(await self.try_connect(alice))
+
+
+class DirectoryTests(ChatTestCase):
+    async def test_user_list_reflects_profile_changes(self):
+        alice, bob = [await User.objects.acreate(username=name) for name in ("alice", "bob")]
+        socket = await self.connect(alice)
+        frame = await self.request(socket, "user.list", {"search": "bo"})
+        self.assertEqual([user["username"] for user in frame["data"]["users"]], ["bob"])
+
+        bob.first_name = "Robert"
+        await bob.asave()
+        frame = await self.request(socket, "user.list", {"search": "bo"})
+        self.assertEqual(frame["data"]["users"][0]["first_name"], "Robert")
+
+        bob.is_active = False
+        await bob.asave()
+        frame = await self.request(socket, "user.list", {"search": "bo"})
+        self.assertEqual(frame["data"]["users"], [])
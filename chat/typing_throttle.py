@@ -0,0 +1,141 @@
+# chat/typing_throttle.py
+"""Server-side throttling of typing indicators.
+
+Clients send ``message.type`` on every keystroke. Each connection keeps one
+small state per room it is typing in and only publishes when the room's
+state actually changes:
+
+- a repeated ``is_typing`` state is dropped, except for one refresh every
+  ``interval`` seconds while the user keeps typing;
+- changes arriving less than ``interval`` after the previous publish are
+  debounced into a single trailing publish carrying the latest state;
+- a user who stops sending keystrokes is reported as stopped after
+  ``timeout`` seconds, as are all rooms when the socket closes.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _RoomTyping:
+    __slots__ = ("receiver", "wanted", "published", "sent_at", "trailing", "expiry")
+
+    def __init__(self):
+        self.receiver = None
+        self.wanted = False
+        self.published = False
+        self.sent_at = float("-inf")
+        self.trailing = None
+        self.expiry = None
+
+
+class TypingThrottle:
+    def __init__(self, publish, interval, timeout):
+        """``publish(room_id, receiver, is_typing)`` does the actual send
+        and returns False if the room rejected it."""
+        self.publish = publish
+        self.interval = interval
+        self.timeout = timeout
+        self._rooms = {}
+        self._tasks = set()
+
+    async def update(self, room_id, is_typing, receiver=None):
+        """Record a typing event.
+
+        Returns the publish result when the event went out immediately, or
+        None when it was suppressed or deferred.
+        """
+        state = self._rooms.get(room_id)
+        if state is None:
+            state = self._rooms[room_id] = _RoomTyping()
+        state.receiver = receiver
+        state.wanted = bool(is_typing)
+
+        if state.expiry is not None:
+            state.expiry.cancel()
+            state.expiry = None
+        if state.wanted:
+            state.expiry = asyncio.get_running_loop().call_later(
+                self.timeout, self._expire, room_id
+            )
+
+        return await self._flush(room_id, state)
+
+    async def close(self):
+        """Cancel timers and report every room still marked as typing."""
+        rooms, self._rooms = self._rooms, {}
+        for task in list(self._tasks):
+            task.cancel()
+        for room_id, state in rooms.items():
+            self._cancel_timers(state)
+            if state.published:
+                await self.publish(room_id, state.receiver, False)
+
+    async def _flush(self, room_id, state):
+        now = time.monotonic()
+        refresh = state.wanted and now - state.sent_at >= self.interval
+        if state.wanted == state.published and not refresh:
+            if state.trailing is not None:
+                state.trailing.cancel()
+                state.trailing = None
+            if not state.wanted:
+                self._drop(room_id, state)
+            return None
+
+        wait = state.sent_at + self.interval - now
+        if wait > 0:
+            if state.trailing is None:
+                state.trailing = asyncio.get_running_loop().call_later(
+                    wait, self._spawn_flush, room_id
+                )
+            return None
+
+        if state.trailing is not None:
+            state.trailing.cancel()
+            state.trailing = None
+        state.published = state.wanted
+        state.sent_at = now
+        published = await self.publish(room_id, state.receiver, state.wanted)
+        if published is False or not state.wanted:
+            self._drop(room_id, state)
+        return published
+
+    def _expire(self, room_id):
+        state = self._rooms.get(room_id)
+        if state is None:
+            return
+        state.expiry = None
+        state.wanted = False
+        if state.trailing is not None:
+            state.trailing.cancel()
+        self._spawn_flush(room_id)
+
+    def _spawn_flush(self, room_id):
+        state = self._rooms.get(room_id)
+        if state is None:
+            return
+        state.trailing = None
+        task = asyncio.get_running_loop().create_task(self._run_flush(room_id, state))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_flush(self, room_id, state):
+        try:
+            await self._flush(room_id, state)
+        except Exception as e:
+            logger.error(f"Typing indicator error: {str(e)}")
+
+    def _drop(self, room_id, state):
+        """Forget a room once it is back to not-typing."""
+        self._cancel_timers(state)
+        if self._rooms.get(room_id) is state:
+            del self._rooms[room_id]
+
+    @staticmethod
+    def _cancel_timers(state):
+        for handle in (state.trailing, state.expiry):
+            if handle is not None:
+                handle.cancel()
+        state.trailing = state.expiry = None
@@ -12,12 +12,28 @@ User = get_user_model()
 
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework.pagination import PageNumberPagination
-
-class MessagePagination(PageNumberPagination):
-    page_size = 50
-    page_size_query_param = 'page_size'
-    max_page_size = 100
+from .pagination import build_page, clamp_page_size, keyset_query
+from .repository import get_message_repository
+from .attachments import (
+    AttachmentNotFound,
+    get_attachment_storage,
+    iter_file,
+    message_file_info,
+    parse_range,
+)
+from .conf import chat_setting
+from .protocol import encode_frames
+from .rooms import get_room_members, room_group_name
+from .conversations import get_conversations, record_message
+from .consumers import NO_RECEIVER
+from .search import get_search_backend, search_messages
+from .export import gzip_chunks, iter_export
+from .directory import get_directory_page, parse_fields
+from .write_behind import insert_message
+from django.http import StreamingHttpResponse
+from rest_framework.parsers import MultiPartParser
+
+HISTORY_PAGE_SIZE = 50
 
 class CustomAuthToken(TokenObtainPairView):
     def post(self, request, *args, **kwargs):
@@ -57,10 +73,27 @@ class UserCreateView(generics.CreateAPIView):
 
 
 class UserListView(generics.ListAPIView):
+    """Active users ordered by username, served from chat.directory.
+
+    Query parameters: ``search`` (prefix of username or name), ``after``
+    (the ``next`` cursor of the previous page), ``limit`` and ``fields``.
+    """
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def list(self, request, *args, **kwargs):
+        try:
+            page = get_directory_page(
+                search=request.query_params.get('search'),
+                after=request.query_params.get('after'),
+                limit=request.query_params.get('limit'),
+                fields=parse_fields(request.query_params.get('fields')),
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page)
+
 class RoomCreateView(generics.CreateAPIView):
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -94,6 +127,13 @@ class RoomCreateView(generics.CreateAPIView):
         room_data["_id"] = str(result.inserted_id)
         room_data["created_at"] = room_data["created_at"].isoformat()
 
+        # Let connected participants subscribe their sockets to the new room.
+        channel_layer = get_channel_layer()
+        for participant in participants:
+            async_to_sync(channel_layer.group_send)(
+                participant, {"type": "room.created", "room_id": room_data["_id"]}
+            )
+
         return Response({"message": "Room create successfully", 'result': room_data}, status=status.HTTP_201_CREATED)
 
 class MessageCreateView(generics.CreateAPIView):
@@ -103,31 +143,77 @@ class MessageCreateView(generics.CreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        messages_collection = get_messages_collection()
         message_data = serializer.validated_data
         message_data['sender'] = request.user.username
         message_data['timestamp'] = datetime.now()
-        result = messages_collection.insert_one(message_data)
-        message_data['_id'] = str(result.inserted_id)
-        self.notify_room(message_data['room_id'], message_data)
+
+        # Routed like a socket send: created rooms reach their members, other
+        # room ids need an explicit receiver.
+        members = get_room_members(message_data['room_id'])
+        if members is not None:
+            if request.user.username not in members:
+                return Response({"error": "Not a participant of this room"}, status=status.HTTP_403_FORBIDDEN)
+            others = members - {request.user.username}
+            message_data['receiver'] = message_data.get('receiver') or (
+                next(iter(others)) if len(others) == 1 else None
+            )
+        elif not message_data.get('receiver'):
+            return Response({"error": NO_RECEIVER}, status=status.HTTP_400_BAD_REQUEST)
+        message_data['is_read'] = False
+        message_data['delivered'] = False
+
+        file_id = message_data.pop('file_id', None)
+        if file_id:
+            try:
+                file_info = get_attachment_storage().describe(file_id)
+            except AttachmentNotFound:
+                return Response({"error": "Unknown attachment"}, status=status.HTTP_400_BAD_REQUEST)
+            if file_info['owner'] != request.user.username:
+                return Response({"error": "Cannot attach another user's file"}, status=status.HTTP_403_FORBIDDEN)
+            message_data['file'] = message_file_info(file_info)
+
+        message_id = insert_message(message_data)
+        record_message(
+            members if members is not None
+            else (request.user.username, message_data['receiver']),
+            message_data,
+        )
+        get_search_backend().index_message(message_data)
+        message_data['_id'] = str(message_id)
+        self.notify_room(message_data['room_id'], message_data, members)
         
         return Response(message_data, status=status.HTTP_201_CREATED)
 
-    def notify_room(self, room_id, message):
+    def notify_room(self, room_id, message, members):
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'chat_{room_id}',
-            {
-                'type': 'chat_message',
-                'message': message['message'],
-                'sender': message['sender'],
-                'timestamp': str(message['timestamp'])
-            }
-        )
+        payload = {
+            "source": "message.send",
+            "data": {
+                "message_id": message['_id'],
+                "room_id": room_id,
+                "sender": message['sender'],
+                "receiver": message['receiver'],
+                "message": message['message'],
+                "timestamp": message['timestamp'].isoformat(),
+            },
+        }
+        if 'file' in message:
+            payload["data"]["file"] = message['file']
+        event = {'type': 'broadcast_group', 'frames': encode_frames(payload)}
+        if members is not None:
+            async_to_sync(channel_layer.group_send)(room_group_name(room_id), event)
+            return
+        # Ad-hoc room ids have no channel group; reach both users directly.
+        for username in {message['sender'], message['receiver']}:
+            async_to_sync(channel_layer.group_send)(username, event)
 
 class MessageHistoryView(generics.GenericAPIView):
+    """Messages of a room within a date range, grouped by day.
+
+    Paginated with the ``before``/``after`` cursors returned in ``cursors``;
+    pass ``include_total=true`` to also get the exact ``count``.
+    """
     permission_classes = [permissions.IsAuthenticated]
-    pagination_class = MessagePagination
 
     def get(self, request, *args, **kwargs):
         room_id = request.query_params.get('room_id')
@@ -159,17 +245,27 @@ class MessageHistoryView(generics.GenericAPIView):
 
         query["timestamp"] = {"$gte": start, "$lte": end}
 
-        messages_collection = get_messages_collection()
-        messages_cursor = messages_collection.find(query).sort("timestamp", 1)
-        messages = list(messages_cursor)
+        try:
+            page_size = clamp_page_size(
+                request.query_params.get('page_size'), default=HISTORY_PAGE_SIZE
+            )
+            page_query, sort = keyset_query(
+                query,
+                before=request.query_params.get('before'),
+                after=request.query_params.get('after'),
+                newest_first=False,
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        repository = get_message_repository()
+        messages_cursor = repository.find(page_query, "full").sort(sort).limit(page_size + 1)
+        messages, has_more, cursors = build_page(list(messages_cursor), page_size, sort)
+
         grouped = defaultdict(list)
-        now = datetime.now()
-        today = now.date()
+        today = datetime.now().date()
         yesterday = today - timedelta(days=1)
 
-        if not messages:
-            return Response({"results": []})
-
         for msg in messages:
             msg['_id'] = str(msg['_id'])
             ts = msg['timestamp']
@@ -186,24 +282,193 @@ class MessageHistoryView(generics.GenericAPIView):
                 group_key = msg_date.strftime("%d-%m-%Y")
 
             grouped[group_key].append(msg)
-        all_messages = []
-        for date_key in grouped:
-            all_messages.extend(grouped[date_key])
-
-        page = self.paginate_queryset(all_messages)
-        if page is not None:
-            paginated_grouped = defaultdict(list)
-            for msg in page:
-                ts = datetime.fromisoformat(msg['timestamp'])
-                msg_date = ts.date()
-                if msg_date == today:
-                    group_key = "today"
-                elif msg_date == yesterday:
-                    group_key = "yesterday"
-                else:
-                    group_key = msg_date.strftime("%d-%m-%Y")
-                paginated_grouped[group_key].append(msg)
-
-            return self.get_paginated_response(paginated_grouped)
-
-        return Response(grouped)
\ No newline at end of file
+
+        response = {
+            "results": grouped,
+            "page_size": page_size,
+            "has_more": has_more,
+            "cursors": cursors,
+        }
+        if request.query_params.get('include_total') in ('1', 'true', 'True'):
+            response["count"] = repository.collection.count_documents(query)
+
+        return Response(response)
+
+
+class MessageExportView(generics.GenericAPIView):
+    """Stream a room's history as NDJSON, oldest first.
+
+    Optional ``start``/``end`` (ISO format) bound the range, ``after``
+    resumes from the ``cursor`` of the last line received and ``gzip=1``
+    returns a gzip-compressed file instead.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        room_id = request.query_params.get('room_id')
+        if not room_id:
+            return Response(
+                {"error": "room_id parameter is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        username = request.user.username
+        members = get_room_members(room_id)
+        if members is None:
+            query = {"room_id": room_id, "$or": [{"sender": username}, {"receiver": username}]}
+        elif username in members:
+            query = {"room_id": room_id}
+        else:
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            start_date = request.query_params.get('start')
+            end_date = request.query_params.get('end')
+            if start_date or end_date:
+                query["timestamp"] = {
+                    "$gte": datetime.fromisoformat(start_date) if start_date else datetime.min,
+                    "$lte": datetime.fromisoformat(end_date) if end_date else datetime.max,
+                }
+            chunks = iter_export(query, after=request.query_params.get('after'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        filename = f'room-{room_id}.ndjson'
+        if request.query_params.get('gzip') in ('1', 'true', 'True'):
+            chunks = gzip_chunks(chunks)
+            content_type = 'application/gzip'
+            filename += '.gz'
+        else:
+            content_type = 'application/x-ndjson'
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+class MessageSearchView(generics.GenericAPIView):
+    """Full-text search over the user's conversations, best matches first.
+
+    Query parameters: ``q`` (required), ``room_id``, ``sender``, ``start``
+    and ``end`` (ISO format), ``page_size`` and the ``after`` cursor.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            response = search_messages(request.user.username, request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(response)
+
+
+class ConversationListView(generics.GenericAPIView):
+    """The user's conversations, most recently active first.
+
+    Each entry has the last message preview and the unread count; pass the
+    returned ``cursors.before`` as ``before`` for the next page.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            response = get_conversations(
+                request.user.username,
+                before=request.query_params.get('before'),
+                page_size=request.query_params.get('page_size'),
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(response)
+
+
+class AttachmentUploadView(generics.GenericAPIView):
+    """Upload a file (multipart field ``file``) and get a ``file_id`` to send.
+
+    Django spools large uploads to a temporary file and the storage backend
+    copies it in chunks, so memory use does not grow with file size.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "file is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if upload.size > chat_setting('ATTACHMENT_MAX_SIZE'):
+            return Response(
+                {"error": "File too large"},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        file_info = get_attachment_storage().save(
+            upload,
+            upload.name,
+            upload.content_type,
+            request.user.username,
+        )
+        return Response(message_file_info(file_info), status=status.HTTP_201_CREATED)
+
+
+class AttachmentDownloadView(generics.GenericAPIView):
+    """Stream an attachment, honouring single-range ``Range`` requests.
+
+    The body is an async iterator so the ASGI handler sends it chunk by
+    chunk instead of reading the whole file into memory first.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, file_id, *args, **kwargs):
+        storage = get_attachment_storage()
+        try:
+            file_info = storage.describe(file_id)
+        except AttachmentNotFound:
+            return Response({"error": "Attachment not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        if not self.can_access(request.user.username, file_info):
+            return Response({"error": "Attachment not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        length = file_info['size']
+        try:
+            byte_range = parse_range(request.headers.get('Range'), length)
+        except ValueError:
+            response = Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{length}'
+            return response
+
+        start, end = byte_range or (0, length - 1)
+        response = StreamingHttpResponse(
+            iter_file(storage, file_id, start, end, chat_setting('ATTACHMENT_CHUNK_SIZE')),
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            content_type=file_info['content_type'],
+        )
+        response['Content-Length'] = str(max(end - start + 1, 0))
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = f'attachment; filename="{file_info["filename"]}"'
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{length}'
+        return response
+
+    def can_access(self, username, file_info):
+        """Uploader, sender/receiver of a message referencing the file, or a
+        member of a room created through /api/rooms/ where it was posted.
+
+        Ad-hoc room ids are picked by clients, so posting into one grants
+        nothing; only the messages' own participants get in.
+        """
+        if file_info['owner'] == username:
+            return True
+        messages = get_messages_collection()
+        if messages.count_documents(
+            {
+                "file.file_id": file_info['file_id'],
+                "$or": [{"sender": username}, {"receiver": username}],
+            },
+            limit=1,
+        ) > 0:
+            return True
+        room_ids = messages.distinct("room_id", {"file.file_id": file_info['file_id']})
+        return any(
+            username in (get_room_members(room_id) or ()) for room_id in room_ids
+        )
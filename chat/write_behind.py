@@ -0,0 +1,206 @@
+# chat/write_behind.py
+"""Write-behind batching of message inserts.
+
+With ``WRITE_BEHIND_ENABLED`` on, new messages are not written with one
+``insert_one`` each. They are queued, and a writer thread sends them to
+Mongo in ``insert_many(ordered=False)`` batches of up to
+``WRITE_BEHIND_BATCH_SIZE`` documents, gathered over at most
+``WRITE_BEHIND_WINDOW`` seconds. ``_id`` is assigned here with
+``ObjectId()``, so callers know it before the write happens.
+
+``WRITE_BEHIND_ACK`` decides when a caller may carry on:
+
+- ``flushed``: once its batch has been written. No message is announced
+  that Mongo has not accepted; concurrent sends share one round trip.
+- ``buffered``: as soon as it is queued. Lowest latency, but messages
+  still queued when the process dies are lost, a failed batch is only
+  logged, and a read right after the send may not see the message yet.
+  Once ``WRITE_BEHIND_MAX_PENDING`` documents are queued, callers wait for
+  their batch as in ``flushed`` mode.
+
+The queue is flushed when the process exits (``close_write_behind()`` is
+registered with atexit). With the setting off, inserts go straight to
+``insert_one`` as before.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from chat import metrics
+from chat.conf import chat_setting
+from chat.mongo_utils import get_async_messages_collection, get_messages_collection
+
+logger = logging.getLogger(__name__)
+
+FLUSHED = "flushed"
+BUFFERED = "buffered"
+
+
+class WriteBehindError(Exception):
+    """A queued insert was rejected by Mongo."""
+
+
+class WriteBehindBuffer:
+    def __init__(self, window, batch_size, max_pending):
+        self.window = window
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="chat-write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, doc):
+        """Queue ``doc`` for insertion, giving it an ``_id`` if it has none.
+
+        Returns ``(future, backlogged)``: the future resolves to the ``_id``
+        once the batch is written (or raises WriteBehindError), and
+        ``backlogged`` is True when more than ``max_pending`` documents are
+        waiting. The buffer keeps a shallow copy, so the caller may go on
+        using ``doc``.
+        """
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise WriteBehindError("Write-behind buffer is closed")
+            self._pending.append((dict(doc), future))
+            backlogged = len(self._pending) > self.max_pending
+            self._cond.notify()
+        return future, backlogged
+
+    def close(self, timeout=None):
+        """Write everything still queued and stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            # Give concurrent senders up to ``window`` seconds to join in.
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[: self.batch_size]
+            del self._pending[: self.batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        if metrics.enabled:
+            metrics.WRITE_BEHIND_BATCH.observe(len(batch))
+        try:
+            get_messages_collection().insert_many(
+                [doc for doc, _ in batch], ordered=False
+            )
+        except BulkWriteError as e:
+            failed = {
+                error["index"]: error.get("errmsg", "write error")
+                for error in e.details.get("writeErrors", ())
+            }
+            logger.error(
+                f"Write-behind batch: {len(failed)} of {len(batch)} inserts failed"
+            )
+            for index, (doc, future) in enumerate(batch):
+                if index in failed:
+                    future.set_exception(WriteBehindError(failed[index]))
+                else:
+                    future.set_result(doc["_id"])
+            return
+        except Exception as e:
+            logger.error(f"Write-behind batch of {len(batch)} failed: {str(e)}")
+            for _, future in batch:
+                future.set_exception(WriteBehindError(str(e)))
+            return
+        for doc, future in batch:
+            future.set_result(doc["_id"])
+
+
+_lock = threading.Lock()
+_buffer = None
+
+
+def get_write_behind():
+    """The process-wide buffer, or None when write-behind is off."""
+    global _buffer
+    if not chat_setting("WRITE_BEHIND_ENABLED"):
+        return None
+    if _buffer is None:
+        with _lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    chat_setting("WRITE_BEHIND_WINDOW"),
+                    chat_setting("WRITE_BEHIND_BATCH_SIZE"),
+                    chat_setting("WRITE_BEHIND_MAX_PENDING"),
+                )
+    return _buffer
+
+
+def close_write_behind(timeout=None):
+    """Flush and stop the buffer; a later insert starts a new one."""
+    global _buffer
+    with _lock:
+        buffer, _buffer = _buffer, None
+    if buffer is not None:
+        buffer.close(timeout)
+
+
+atexit.register(close_write_behind)
+
+
+def _reset_after_fork():
+    # The writer thread does not exist in the child; documents queued in
+    # the parent stay the parent's to write.
+    global _buffer, _lock
+    _lock = threading.Lock()
+    _buffer = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _must_wait(backlogged):
+    return backlogged or chat_setting("WRITE_BEHIND_ACK") != BUFFERED
+
+
+def insert_message(doc):
+    """Insert a message document and return its ``_id``."""
+    buffer = get_write_behind()
+    if buffer is None:
+        return get_messages_collection().insert_one(doc).inserted_id
+    future, backlogged = buffer.submit(doc)
+    if _must_wait(backlogged):
+        return future.result()
+    return doc["_id"]
+
+
+async def ainsert_message(doc):
+    buffer = get_write_behind()
+    if buffer is None:
+        return (await get_async_messages_collection().insert_one(doc)).inserted_id
+    future, backlogged = buffer.submit(doc)
+    if _must_wait(backlogged):
+        return await asyncio.wrap_future(future)
+    return doc["_id"]
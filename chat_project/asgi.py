@@ -13,9 +13,10 @@ django.setup()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
+from chat.metrics import MetricsEndpoint
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": MetricsEndpoint(get_asgi_application()),
     "websocket": URLRouter(websocket_urlpatterns)
 })
@@ -88,6 +88,15 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Shared cache (user directory pages, ...). Must be shared by every worker
+# so invalidation on user changes is seen everywhere.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    }
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -104,10 +113,30 @@ MONGODB_SETTINGS = {
     'connectTimeoutMS': 30000,
     'socketTimeoutMS': 30000,
     'ssl': True,
+    # Connection pool (one client per process, see chat.mongo_utils)
+    'maxPoolSize': 100,
+    'minPoolSize': 0,
+    'maxIdleTimeMS': 60000,
+    'waitQueueTimeoutMS': 5000,
+    'serverSelectionTimeoutMS': 5000,
+    # Read concern. The write concern comes from the URI (w=majority);
+    # a 'w' key here would override it.
+    'readConcernLevel': 'local',
+}
+# Create the indexes declared in chat.indexes when the app loads. The
+# `ensure_indexes` management command does the same on demand.
+MONGODB_ENSURE_INDEXES = False
+# Chat tunables; see chat.conf.DEFAULTS for the full list.
+CHAT_SETTINGS = {
+    'PENDING_BATCH_SIZE': 100,
+    'ATTACHMENT_STORAGE': 'gridfs',
+    'ATTACHMENT_ROOT': BASE_DIR / 'attachments',
+    'REDIS_URL': 'redis://127.0.0.1:6379/0',
+    'PRESENCE_BACKEND': 'redis',
 }
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.authtoken.views import obtain_auth_token
-from chat.views import UserCreateView, CustomAuthToken, UserListView, RoomCreateView, MessageCreateView, MessageHistoryView
+from chat.views import UserCreateView, CustomAuthToken, UserListView, RoomCreateView, MessageCreateView, MessageHistoryView, MessageExportView, MessageSearchView, ConversationListView, AttachmentUploadView, AttachmentDownloadView
 from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
@@ -14,4 +14,9 @@ urlpatterns = [
     path('api/rooms/', RoomCreateView.as_view(), name='room-create'),
     path('api/messages/', MessageCreateView.as_view(), name='message-list'),
     path('api/messages/history/', MessageHistoryView.as_view(), name='message-history'),
+    path('api/messages/export/', MessageExportView.as_view(), name='message-export'),
+    path('api/messages/search/', MessageSearchView.as_view(), name='message-search'),
+    path('api/conversations/', ConversationListView.as_view(), name='conversation-list'),
+    path('api/attachments/', AttachmentUploadView.as_view(), name='attachment-upload'),
+    path('api/attachments/<str:file_id>/', AttachmentDownloadView.as_view(), name='attachment-download'),
 ]
\ No newline at end of file